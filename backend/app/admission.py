@@ -0,0 +1,178 @@
+"""
+准入控制
+按排队深度和最近的完成速率决定是否接受新的生成任务：处理能力跟不上时尽早拒绝（429/503 + Retry-After），
+让已接受的任务能在合理时间内完成，而不是所有任务一起排队超时。
+
+超载时（降级模式）如有相同需求的已完成行程，直接复用该结果，不再占用生成能力。
+"""
+import hashlib
+import json
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .database import settings
+from .db_models import Task
+
+logger = logging.getLogger(__name__)
+
+# Retry-After 的取值范围（秒）；完成速率未知时使用默认值
+RETRY_AFTER_MIN_SECONDS = 5
+RETRY_AFTER_MAX_SECONDS = 600
+RETRY_AFTER_DEFAULT_SECONDS = 30
+
+
+class QueueStats(BaseModel):
+    """队列统计快照"""
+    pending: int  # 排队中的任务数
+    processing: int  # 处理中的任务数
+    completed_recently: int  # 统计窗口内完成的任务数
+    window_seconds: int
+
+    @property
+    def completion_rate(self) -> float:
+        """最近的完成速率（个/秒）"""
+        return self.completed_recently / self.window_seconds if self.window_seconds > 0 else 0.0
+
+    @property
+    def service_seconds(self) -> Optional[float]:
+        """单个任务的平均处理时长（Little 定律：处理中任务数 / 完成速率），速率未知时返回 None"""
+        rate = self.completion_rate
+        if rate <= 0:
+            return None
+        return max(self.processing, 1) / rate
+
+    @property
+    def expected_wait_seconds(self) -> Optional[float]:
+        """新任务的预计排队时间，没有排队或速率未知时返回 None"""
+        rate = self.completion_rate
+        if self.pending <= 0 or rate <= 0:
+            return None
+        return self.pending / rate
+
+
+class AdmissionRejected(Exception):
+    """超过准入限制，status_code 为 429（单个提交者超限）或 503（整体超载）"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float], reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.reason = reason
+        if retry_after is None:
+            retry_after = RETRY_AFTER_DEFAULT_SECONDS
+        self.retry_after = int(min(max(math.ceil(retry_after), RETRY_AFTER_MIN_SECONDS), RETRY_AFTER_MAX_SECONDS))
+
+
+class AdmissionController:
+    """生成任务的准入控制"""
+
+    def __init__(
+        self,
+        max_queue_depth: int = settings.ADMISSION_MAX_QUEUE_DEPTH,
+        max_expected_wait_seconds: int = settings.ADMISSION_MAX_EXPECTED_WAIT_SECONDS,
+        max_pending_per_user: int = settings.ADMISSION_MAX_PENDING_PER_USER,
+        rate_window_seconds: int = settings.ADMISSION_RATE_WINDOW_SECONDS,
+        stats_ttl_seconds: float = settings.ADMISSION_STATS_TTL_SECONDS,
+    ):
+        self.max_queue_depth = max(1, max_queue_depth)
+        self.max_expected_wait_seconds = max_expected_wait_seconds
+        self.max_pending_per_user = max(1, max_pending_per_user)
+        self.rate_window_seconds = max(1, rate_window_seconds)
+        self.stats_ttl_seconds = stats_ttl_seconds
+        self._stats: Optional[QueueStats] = None
+        self._stats_at = 0.0
+
+    def queue_stats(self, db: Session) -> QueueStats:
+        """统计排队深度和最近的完成速率（短时间缓存，高并发提交时不必每个请求都统计）"""
+        if self._stats is not None and time.monotonic() - self._stats_at < self.stats_ttl_seconds:
+            return self._stats
+
+        counts = dict(
+            db.query(Task.status, func.count(Task.id))
+            .filter(Task.status.in_(("pending", "processing")))
+            .group_by(Task.status)
+            .all()
+        )
+        since = datetime.utcnow() - timedelta(seconds=self.rate_window_seconds)
+        completed = db.query(func.count(Task.id)).filter(
+            Task.status == "completed",
+            Task.completed_at >= since
+        ).scalar()
+
+        stats = QueueStats(
+            pending=counts.get("pending", 0),
+            processing=counts.get("processing", 0),
+            completed_recently=completed or 0,
+            window_seconds=self.rate_window_seconds,
+        )
+        self._stats = stats
+        self._stats_at = time.monotonic()
+        metrics.set_gauge("task_queue_pending", stats.pending)
+        metrics.set_gauge("task_queue_processing", stats.processing)
+        metrics.set_gauge("task_completion_rate_per_minute", round(stats.completion_rate * 60, 2))
+        return stats
+
+    def check(self, db: Session, owner_key: str):
+        """检查是否接受提交者的新任务，超过限制时抛出 AdmissionRejected"""
+        stats = self.queue_stats(db)
+
+        owner_pending = db.query(func.count(Task.id)).filter(
+            Task.status == "pending",
+            Task.owner_key == owner_key
+        ).scalar() or 0
+        if owner_pending >= self.max_pending_per_user:
+            # 该提交者的任务按 max_in_flight 并行处理，等到排队数降到上限以下
+            service = stats.service_seconds
+            retry_after = None
+            if service is not None:
+                excess = owner_pending - self.max_pending_per_user + 1
+                retry_after = excess * service / max(1, settings.TASK_MAX_IN_FLIGHT_PER_USER)
+            raise AdmissionRejected(429, "您提交的任务过多，请等待当前任务完成后再试", retry_after, "user_pending")
+
+        rate = stats.completion_rate
+        if stats.pending >= self.max_queue_depth:
+            retry_after = (stats.pending - self.max_queue_depth + 1) / rate if rate > 0 else None
+            raise AdmissionRejected(503, "当前排队的任务过多，请稍后再试", retry_after, "queue_depth")
+
+        expected_wait = stats.expected_wait_seconds
+        if expected_wait is not None and expected_wait > self.max_expected_wait_seconds:
+            # 预计等待时间降到上限以下所需的时间
+            raise AdmissionRejected(
+                503, "服务繁忙，预计等待时间过长，请稍后再试",
+                expected_wait - self.max_expected_wait_seconds, "expected_wait"
+            )
+
+
+# ============ 降级模式 ============
+
+def request_fingerprint(request_data: Dict[str, Any]) -> str:
+    """请求参数指纹（不含行程名称，偏好不区分顺序），相同需求生成的行程可以互相复用"""
+    data = {key: value for key, value in request_data.items() if key != "agentName"}
+    if isinstance(data.get("preferences"), list):
+        data["preferences"] = sorted(str(item) for item in data["preferences"])
+    canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def find_cached_result(
+    db: Session,
+    fingerprint: str,
+    max_age_hours: int = settings.ADMISSION_CACHE_MAX_AGE_HOURS
+) -> Optional[Task]:
+    """最近完成（含图片）的相同需求任务"""
+    cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+    return db.query(Task).filter(
+        Task.request_hash == fingerprint,
+        Task.status == "completed",
+        Task.image_status == "completed",
+        Task.result_hash.isnot(None),
+        Task.completed_at >= cutoff
+    ).order_by(Task.completed_at.desc()).first()
@@ -2,11 +2,14 @@
 TravelPlanGPT Agent - Core Planning Logic
 """
 import os
+import re
 import json
+import unicodedata
 import logging
 import asyncio
+import time
 import aiohttp
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
@@ -16,7 +19,7 @@ from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.pydantic_v1 import BaseModel as PydanticBaseModel
 from app.models import (
-    TravelRequest, TravelItinerary, DailyPlan, Activity,
+    TravelRequest, TravelItinerary, DailyPlan, Activity, ActivityImage,
     HiddenGem, PracticalTips, BudgetOverview, BudgetItem
 )
 from app.tools import (
@@ -25,8 +28,9 @@ from app.tools import (
     get_place_images,
     get_weather_info
 )
-from app.image_search import get_image_for_activity
+from app.image_search import get_image_for_activity, image_url
 from app.database import settings
+from app.timings import stage_timer, record_stage, STAGE_LLM, STAGE_PARSE, STAGE_VALIDATE
 
 logger = logging.getLogger(__name__)
 
@@ -148,6 +152,11 @@ class DirectLLMCaller:
                         else:
                             raise last_error
 
+            except asyncio.CancelledError:
+                # 任务被取消：退出 async with 时连接随之关闭，不再等待 LLM 返回
+                logger.info(f"[Attempt {attempt}/{self.max_retries}] LLM 请求已取消")
+                raise
+
             except asyncio.TimeoutError as e:
                 error_msg = f"LLM API timeout after {self.timeout}s (attempt {attempt}/{self.max_retries})"
                 logger.error(error_msg)
@@ -383,8 +392,21 @@ class TravelPlanningAgent:
         
         return prompt
     
-    async def generate_itinerary(self, request: TravelRequest) -> TravelItinerary:
-        """生成旅行行程"""
+    async def generate_itinerary(
+        self,
+        request: TravelRequest,
+        enrich_images: bool = True,
+        reuse_images: Optional[Dict[str, List[ActivityImage]]] = None
+    ) -> TravelItinerary:
+        """
+        生成旅行行程
+
+        Args:
+            request: 旅行请求
+            enrich_images: 是否在返回前同步完成图片补全。
+                后台任务传入 False，先返回文字行程，再单独调用 enrich_itinerary_images()
+            reuse_images: 重新生成时沿用的旧图片（见 collect_reusable_images）
+        """
         
         # 构建输入
         user_input = f"""
@@ -583,15 +605,16 @@ class TravelPlanningAgent:
             print("\n🤖 调用 LLM...")
 
             # 根据配置选择调用方式
-            if hasattr(self, 'use_direct_call') and self.use_direct_call:
-                # 使用直接调用方式（绕过LangChain兼容性问题）
-                print("使用直接API调用（NVIDIA/DashScope）...")
-                output = await self.direct_caller.call(detailed_prompt, temperature=0.7)
-            else:
-                # 使用LangChain调用
-                print("使用LangChain调用（Ollama）...")
-                response = await self.llm.ainvoke(detailed_prompt)
-                output = response.content if hasattr(response, 'content') else str(response)
+            with stage_timer(STAGE_LLM):
+                if hasattr(self, 'use_direct_call') and self.use_direct_call:
+                    # 使用直接调用方式（绕过LangChain兼容性问题）
+                    print("使用直接API调用（NVIDIA/DashScope）...")
+                    output = await self.direct_caller.call(detailed_prompt, temperature=0.7)
+                else:
+                    # 使用LangChain调用
+                    print("使用LangChain调用（Ollama）...")
+                    response = await self.llm.ainvoke(detailed_prompt)
+                    output = response.content if hasattr(response, 'content') else str(response)
 
             print(f"✅ LLM response received, length: {len(output)}")
             print(f"📝 Response preview (first 200 chars): {output[:200]}...")
@@ -599,7 +622,14 @@ class TravelPlanningAgent:
             # 解析结果
             print("\n📋 开始解析 LLM 输出...")
             itinerary = self._parse_agent_output(output, request)
-            print("✅ 解析完成，准备返回行程")
+            print("✅ 解析完成")
+
+            if enrich_images:
+                itinerary = await self.enrich_itinerary_images(
+                    itinerary, request.destination, reuse_images=reuse_images
+                )
+
+            print("✅ 准备返回行程")
             return itinerary
             
         except Exception as e:
@@ -614,6 +644,7 @@ class TravelPlanningAgent:
         print("\n" + "="*70)
         print("📋 _parse_agent_output 被调用")
         print("="*70)
+        parse_started = time.perf_counter()
         try:
             # 尝试查找JSON字符串（处理可能的Markdown代码块）
             text = output.strip()
@@ -674,10 +705,12 @@ class TravelPlanningAgent:
                 raise ValueError("Missing required fields")
             
             print(f"5️⃣ 验证字段通过")
+            record_stage(STAGE_PARSE, time.perf_counter() - parse_started)
             
             # 构建 TravelItinerary 对象
             print(f"6️⃣ 构建 TravelItinerary 对象...")
-            itinerary = TravelItinerary(**data)
+            with stage_timer(STAGE_VALIDATE):
+                itinerary = TravelItinerary(**data)
             print(f"✅ TravelItinerary 创建成功: {len(itinerary.dailyPlans)} 天行程")
             
             # 🔍 调试：检查LLM是否生成了images字段
@@ -689,18 +722,14 @@ class TravelPlanningAgent:
                         llm_has_images = True
                         print(f"⚠️  警告：LLM为 '{activity.title}' 生成了 {len(activity.images)} 个images:")
                         for img in activity.images[:2]:
-                            print(f"     - {img[:80]}...")
+                            print(f"     - {img.url[:80]}...")
             
             if not llm_has_images:
                 print(f"✅ LLM未生成images字段（符合预期）")
             else:
                 print(f"❌ LLM生成了images字段（违反了Prompt指示）")
             
-            # 为每个活动添加真实图片
-            print(f"\n7️⃣ 准备调用 _add_images_to_itinerary()...")
-            itinerary = self._add_images_to_itinerary(itinerary, request.destination)
-            print(f"✅ 图片添加完成")
-            
+            # 图片补全作为独立阶段，由 generate_itinerary / 后台任务调用 enrich_itinerary_images()
             return itinerary
             
         except json.JSONDecodeError as e:
@@ -761,130 +790,169 @@ class TravelPlanningAgent:
     
 
     
-    def _add_images_to_itinerary(self, itinerary: TravelItinerary, destination: str) -> TravelItinerary:
-        """为行程中的每个活动添加真实图片（纯同步方式，带全局去重）"""
-        import logging
-        logger = logging.getLogger(__name__)
-        
-        print("\n" + "="*60)
-        print("🖼️  _add_images_to_itinerary 被调用!")
-        print(f"   目的地: {destination}")
-        print("="*60)
-        
+    async def enrich_itinerary_images(
+        self,
+        itinerary: TravelItinerary,
+        destination: str,
+        on_progress: Optional[Callable[[TravelItinerary, int, int], Awaitable[None]]] = None,
+        reuse_images: Optional[Dict[str, List[ActivityImage]]] = None,
+        resume: bool = False
+    ) -> TravelItinerary:
+        """
+        图片补全阶段：为行程中的每个活动添加真实图片（带全局去重）
+
+        图片搜索使用同步的 requests，这里放到线程池中执行，避免阻塞事件循环。
+
+        Args:
+            itinerary: 已解析的文字行程
+            destination: 目的地
+            on_progress: 每完成一个活动后回调 (itinerary, 已完成数, 总数)，用于就地更新任务和数据库
+            reuse_images: 旧行程的 {标题+目的地 -> 图片}，命中的活动直接沿用，不调用图片 API
+            resume: 恢复中断的图片补全，已有图片的活动（上次已写入）直接计为完成，不再搜索
+        """
         logger.info("\n" + "="*60)
-        logger.info("🖼️  开始为活动添加真实图片...")
+        logger.info(f"🖼️  开始为活动添加真实图片... 目的地: {destination}")
         logger.info("="*60)
-        
-        # 全局已使用图片集合（用于去重）
+
+        activities = [activity for daily_plan in itinerary.dailyPlans for activity in daily_plan.activities]
+        total = len(activities)
         used_images: set = set()
-        
-        # 🔧 第一步：强制清除所有LLM可能生成的图片
-        print("🧹 第一步：清除所有现有图片...")
-        logger.info("🧹 第一步：清除所有现有图片...")
-        cleaned_count = 0
-        for daily_plan in itinerary.dailyPlans:
-            for activity in daily_plan.activities:
-                if hasattr(activity, 'images') and activity.images:
-                    old_images = activity.images.copy()
-                    activity.images = []
-                    cleaned_count += 1
-                    print(f"   ⚠️  清除了 '{activity.title}' 的 {len(old_images)} 张图片")
-                    logger.warning(f"   ⚠️  清除了 '{activity.title}' 的 {len(old_images)} 张图片:")
-                    for img in old_images[:1]:
-                        if 'picsum' in img or 'placeholder' in img or 'placehold' in img:
-                            print(f"      ❌ 占位图: {img[:60]}...")
-                            logger.warning(f"      ❌ 占位图: {img[:60]}...")
-                        else:
-                            print(f"      🗑️  其他: {img[:60]}...")
-                            logger.info(f"      🗑️  其他: {img[:60]}...")
-        
-        if cleaned_count > 0:
-            print(f"✅ 已清除 {cleaned_count} 个活动的原有图片")
-            logger.info(f"✅ 已清除 {cleaned_count} 个活动的原有图片")
+        reuse_images = reuse_images or {}
+        reused_count = 0
+        reported = 0
+
+        # 🔧 第一步：强制清除所有LLM可能生成的图片（恢复时已有的图片是上次补全写入的，保留并参与去重）
+        if resume:
+            kept_count = 0
+            for activity in activities:
+                if activity.images:
+                    self._dedupe_images([img.model_dump() for img in activity.images], used_images)
+                    kept_count += 1
+            logger.info(f"✅ 恢复图片补全，{kept_count} 个活动已有图片")
         else:
-            print(f"✅ 无需清除（LLM未生成图片）")
-            logger.info(f"✅ 无需清除（LLM未生成图片）")
-        
-        # 🔧 第二步：同步获取图片（带全局去重）
-        print("\n📸 第二步：从 API 获取真实图片...")
-        
-        for daily_plan in itinerary.dailyPlans:
-            print(f"\n📅 Day {daily_plan.day}: {daily_plan.title}")
-            logger.info(f"\n📅 Day {daily_plan.day}: {daily_plan.title}")
-            print("-" * 60)
-            logger.info("-" * 60)
-            
-            for idx, activity in enumerate(daily_plan.activities, 1):
-                print(f"\n🎯 处理活动 {idx}: {activity.title}")
-                logger.info(f"\n🎯 处理活动 {idx}: {activity.title}")
-                
-                # 确定活动类型
-                category = ""
-                if "餐" in activity.title or "吃" in activity.title or "美食" in activity.title:
-                    category = "美食"
-                elif "博物" in activity.title or "寺" in activity.title or "庙" in activity.title:
-                    category = "博物馆"
-                elif "公园" in activity.title or "花园" in activity.title:
-                    category = "公园"
-                elif "购物" in activity.title or "商场" in activity.title:
-                    category = "购物"
+            cleaned_count = self._clear_llm_images(itinerary)
+            if cleaned_count > 0:
+                logger.info(f"✅ 已清除 {cleaned_count} 个活动的原有图片")
+            else:
+                logger.info(f"✅ 无需清除（LLM未生成图片）")
+
+        # 🔧 第二步：逐个活动获取图片（带全局去重）
+        for done, activity in enumerate(activities, 1):
+            if resume and activity.images:
+                continue
+            logger.info(f"\n🎯 处理活动 {done}/{total}: {activity.title}")
+
+            previous_images = reuse_images.get(self._image_reuse_key(activity.title, destination))
+            if previous_images:
+                activity.images = [
+                    ActivityImage(**img)
+                    for img in self._dedupe_images([img.model_dump() for img in previous_images], used_images)
+                ]
+                if activity.images:
+                    reused_count += 1
+                    logger.info(f"   ♻️  沿用上次生成的 {len(activity.images)} 张图片")
+                    if on_progress:
+                        await on_progress(itinerary, done, total)
+                        reported = done
+                    continue
+
+            try:
+                images = await asyncio.to_thread(
+                    get_image_for_activity,
+                    activity_name=activity.title,
+                    location=destination,
+                    category=self._classify_activity(activity.title),
+                    detailed=True
+                )
+                activity.images = [ActivityImage(**img) for img in self._dedupe_images(images, used_images)]
+
+                if activity.images:
+                    logger.info(f"   ✅ 成功添加 {len(activity.images)} 张唯一图片")
                 else:
-                    category = "景点"
-                
-                print(f"   📂 分类: {category}")
-                logger.debug(f"   📂 分类: {category}")
-                
-                # 获取图片（不使用占位图）
-                try:
-                    images = get_image_for_activity(
-                        activity_name=activity.title,
-                        location=destination,
-                        category=category
-                    )
-                    
-                    # 全局去重：过滤掉已经在其他活动中使用过的图片
-                    if images:
-                        unique_images = []
-                        for img in images:
-                            # 提取图片ID（Pexels格式：包含数字ID）
-                            img_id = self._extract_image_id(img)
-                            if img_id not in used_images:
-                                unique_images.append(img)
-                                used_images.add(img_id)
-                            else:
-                                print(f"   🔄 跳过重复图片: ...{img[-50:]}")
-                                logger.info(f"   🔄 跳过重复图片: ...{img[-50:]}")
-                        
-                        images = unique_images
-                    
-                    activity.images = images if images else []
-                    
-                    if images:
-                        print(f"   ✅ 成功添加 {len(images)} 张唯一图片")
-                        logger.info(f"   ✅ 成功添加 {len(images)} 张唯一图片")
-                        for i, img in enumerate(images[:2], 1):
-                            print(f"      {i}. {img[:70]}...")
-                    else:
-                        print(f"   ⚠️  未找到唯一图片（将不显示图片）")
-                        logger.warning(f"   ⚠️  未找到唯一图片（将不显示图片）")
-                        
-                except Exception as e:
-                    print(f"   ❌ 获取图片失败: {e}")
-                    logger.error(f"   ❌ 获取图片失败: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    activity.images = []
-        
-        print("\n" + "="*60)
-        print("✅ 图片添加完成！")
-        print(f"   共使用 {len(used_images)} 张唯一图片")
-        print("="*60 + "\n")
+                    logger.warning(f"   ⚠️  未找到唯一图片（将不显示图片）")
+            except Exception as e:
+                logger.error(f"   ❌ 获取图片失败: {e}")
+                activity.images = []
+
+            if on_progress:
+                await on_progress(itinerary, done, total)
+                reported = done
+
+        # 恢复时末尾的活动都已有图片，补报一次进度
+        if on_progress and reported < total:
+            await on_progress(itinerary, total, total)
+
         logger.info("\n" + "="*60)
         logger.info("✅ 图片添加完成！")
-        logger.info(f"   共使用 {len(used_images)} 张唯一图片")
+        logger.info(f"   共使用 {len(used_images)} 张唯一图片，{reused_count} 个活动沿用旧图片")
         logger.info("="*60 + "\n")
-        
+
         return itinerary
+
+    def collect_reusable_images(self, itinerary_data: Dict[str, Any], destination: str) -> Dict[str, List[ActivityImage]]:
+        """
+        从已保存的行程数据中收集 {标题+目的地 -> 图片}，供重新生成时沿用
+
+        直接遍历字典而不做完整校验，旧格式或部分损坏的数据也能尽量复用。
+        """
+        reusable: Dict[str, List[ActivityImage]] = {}
+        for daily_plan in itinerary_data.get("dailyPlans") or []:
+            for activity in daily_plan.get("activities") or []:
+                images = activity.get("images")
+                title = activity.get("title")
+                if not images or not title:
+                    continue
+                try:
+                    reusable[self._image_reuse_key(title, destination)] = [
+                        ActivityImage(url=img) if isinstance(img, str) else ActivityImage(**img) for img in images
+                    ]
+                except Exception as e:
+                    logger.warning(f"   ⚠️  跳过无法解析的旧图片 '{title}': {e}")
+        return reusable
+
+    def _image_reuse_key(self, title: str, destination: str) -> str:
+        """标题+目的地归一化（全半角、大小写、空白和标点）后作为复用键"""
+        def normalize(text: str) -> str:
+            return re.sub(r"[\W_]+", "", unicodedata.normalize("NFKC", text or "").lower())
+
+        return f"{normalize(destination)}|{normalize(title)}"
+
+    def _clear_llm_images(self, itinerary: TravelItinerary) -> int:
+        """清除LLM可能生成的图片（占位图等），返回被清除的活动数"""
+        cleaned_count = 0
+        for daily_plan in itinerary.dailyPlans:
+            for activity in daily_plan.activities:
+                if activity.images:
+                    logger.warning(f"   ⚠️  清除了 '{activity.title}' 的 {len(activity.images)} 张图片")
+                    activity.images = []
+                    cleaned_count += 1
+        return cleaned_count
+
+    def _classify_activity(self, title: str) -> str:
+        """根据活动名称确定图片搜索类别"""
+        if "餐" in title or "吃" in title or "美食" in title:
+            return "美食"
+        elif "博物" in title or "寺" in title or "庙" in title:
+            return "博物馆"
+        elif "公园" in title or "花园" in title:
+            return "公园"
+        elif "购物" in title or "商场" in title:
+            return "购物"
+        return "景点"
+
+    def _dedupe_images(self, images: List[Dict[str, Any]], used_images: set) -> List[Dict[str, Any]]:
+        """全局去重：过滤掉已经在其他活动中使用过的图片"""
+        unique_images = []
+        for img in images or []:
+            # 提取图片ID（Pexels格式：包含数字ID）
+            url = image_url(img)
+            img_id = self._extract_image_id(url)
+            if img_id not in used_images:
+                unique_images.append(img)
+                used_images.add(img_id)
+            else:
+                logger.info(f"   🔄 跳过重复图片: ...{url[-50:]}")
+        return unique_images
     
     def _extract_image_id(self, url: str) -> str:
         """从图片URL中提取唯一标识符，用于去重"""
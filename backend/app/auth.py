@@ -8,10 +8,11 @@ from passlib.context import CryptContext
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 import random
 import string
-from .database import get_db
+from .database import get_db, get_async_db
 from .db_models import User, EmailVerification
 from .email_utils import send_email
 
@@ -80,12 +81,8 @@ def decode_access_token(token: str) -> dict:
         )
 
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """获取当前登录用户（依赖注入）"""
-    token = credentials.credentials
+def _user_id_from_token(token: str) -> int:
+    """从 token 中解析用户ID，无效时抛出 401"""
     payload = decode_access_token(token)
     
     user_id_str = payload.get("sub")
@@ -97,23 +94,32 @@ def get_current_user(
     
     # 转换字符串 ID 为整数
     try:
-        user_id = int(user_id_str)
+        return int(user_id_str)
     except (ValueError, TypeError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="无效的用户ID"
         )
-    
-    user = db.query(User).filter(User.id == user_id).first()
+
+
+def _ensure_user(user: Optional[User]) -> User:
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户不存在"
         )
-    
     return user
 
 
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    """获取当前登录用户（依赖注入）"""
+    user_id = _user_id_from_token(credentials.credentials)
+    return _ensure_user(db.query(User).filter(User.id == user_id).first())
+
+
 def get_current_user_optional(
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
     db: Session = Depends(get_db)
@@ -128,6 +134,45 @@ def get_current_user_optional(
         return None
 
 
+async def get_current_user_async(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_async_db)
+) -> User:
+    """获取当前登录用户（异步会话，与接口共用同一个会话）"""
+    user_id = _user_id_from_token(credentials.credentials)
+    return _ensure_user(await db.get(User, user_id))
+
+
+async def get_current_user_optional_async(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
+    db: AsyncSession = Depends(get_async_db)
+) -> Optional[User]:
+    """获取当前用户（可选，异步会话）"""
+    if credentials is None:
+        return None
+    
+    try:
+        return await get_current_user_async(credentials, db)
+    except HTTPException:
+        return None
+
+
+def get_current_user_id_optional(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))
+) -> Optional[int]:
+    """
+    只从 token 中解析用户ID（可选，不查询数据库）
+    用于 SSE 等长连接接口，避免在整个连接期间占用数据库会话
+    """
+    if credentials is None:
+        return None
+
+    try:
+        return int(decode_access_token(credentials.credentials).get("sub"))
+    except (HTTPException, ValueError, TypeError):
+        return None
+
+
 def get_user_by_email(db: Session, email: str) -> Optional[User]:
     """根据邮箱获取用户"""
     return db.query(User).filter(User.email == email).first()
@@ -0,0 +1,48 @@
+"""
+行程 JSON 的压缩存储
+内容表 itinerary_blobs 的 data 为压缩后的字节，compression 列记录算法（zstd / zlib / none）。
+旧的内联 JSON 列（Itinerary.itinerary_data 等）新数据一律写入空字符串，只由迁移脚本读取，不做压缩。
+
+新写入的内容使用 STORAGE_COMPRESSION 指定的算法，已有数据可以用 migrate_itinerary_blobs.py 分批转换
+"""
+import zlib
+from typing import Optional, Tuple
+
+import zstandard
+
+from .database import settings
+
+CODEC_ZSTD = "zstd"
+CODEC_ZLIB = "zlib"
+CODEC_NONE = "none"
+CODECS = (CODEC_ZSTD, CODEC_ZLIB, CODEC_NONE)
+
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+
+def storage_codec() -> str:
+    """新写入内容使用的压缩算法"""
+    codec = settings.STORAGE_COMPRESSION.lower()
+    return codec if codec in CODECS else CODEC_ZLIB
+
+
+def compress(raw: bytes, codec: Optional[str] = None) -> Tuple[bytes, str]:
+    """压缩数据，返回压缩后的字节和使用的算法"""
+    codec = codec or storage_codec()
+    if codec == CODEC_ZSTD:
+        # 压缩上下文不是线程安全的，每次调用单独创建
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), codec
+    if codec == CODEC_ZLIB:
+        return zlib.compress(raw, ZLIB_LEVEL), codec
+    return raw, CODEC_NONE
+
+
+def decompress(data: bytes, codec: Optional[str]) -> bytes:
+    """按存储的算法解压（未知算法按未压缩处理）"""
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    return data
+
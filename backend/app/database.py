@@ -2,15 +2,28 @@
 数据库配置和会话管理
 使用 SQLAlchemy 作为 ORM
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
 from pydantic_settings import BaseSettings
 from functools import lru_cache
 
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./travel_gpt.db"
+    ASYNC_DATABASE_URL: str = ""  # 异步引擎的连接串，留空时按 DATABASE_URL 推断（sqlite+aiosqlite / postgresql+asyncpg）
+    
+    # SQLite 生产配置：WAL 和调优的 PRAGMA，写入经由唯一的写连接串行执行，读取使用连接池
+    SQLITE_PRODUCTION_PROFILE: bool = True
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000  # 数据库被其他进程（如独立 worker）锁住时的等待时间
+    SQLITE_MMAP_SIZE: int = 268435456  # 内存映射读取的大小（字节）
+    SQLITE_CACHE_SIZE_KB: int = 65536  # 每个连接的页缓存大小
+    SQLITE_READ_POOL_SIZE: int = 8  # 读连接池大小
+    SQLITE_WRITE_TIMEOUT_SECONDS: int = 30  # 等待写连接的最长时间
     
     # LLM Configuration (新方式)
     LLM_PROVIDER: str = ""  # "nvidia", "ollama", or "dashscope"
@@ -34,6 +47,10 @@ class Settings(BaseSettings):
     # 图片搜索 API
     UNSPLASH_ACCESS_KEY: str = ""
     PEXELS_API_KEY: str = ""
+    IMAGE_PROVIDERS: str = "unsplash,pexels"  # 图片 Provider 顺序：unsplash, pexels, local
+    LOCAL_IMAGE_DIR: str = ""  # 本地图片库目录（离线 Provider）
+    LOCAL_IMAGE_INDEX_PATH: str = ""  # 本地图片库索引文件，为空时放在临时目录
+    LOCAL_IMAGE_BASE_URL: str = "http://localhost:8000/local-images"  # 本地图片对外访问地址
     
     # 天气 API
     OPENWEATHER_API_KEY: str = ""
@@ -54,6 +71,51 @@ class Settings(BaseSettings):
     DEFAULT_EMAIL_ACCOUNT: str = ""
     DEFAULT_EMAIL_PASSWORD: str = ""
     
+    # 生成任务队列（基于 tasks 表的持久化队列）
+    TASK_WORKER_CONCURRENCY: int = 4  # 同时处理的生成任务数
+    TASK_LEASE_SECONDS: int = 60  # 租约时长，worker 崩溃后超过该时间任务可被重新领取
+    TASK_HEARTBEAT_SECONDS: int = 15  # 心跳续约间隔
+    TASK_MAX_ATTEMPTS: int = 3  # 最大尝试次数（含首次）
+    TASK_RETRY_DELAY_SECONDS: int = 10  # 重试基础延迟（指数退避）
+    TASK_POLL_SECONDS: float = 2.0  # 空闲时轮询 tasks 表的间隔
+    TASK_WORKER_EMBEDDED: bool = True  # API 进程内是否运行 worker；独立部署 worker.py 时设为 false，API 只负责入队和查询
+    TASK_EVENT_POLL_SECONDS: float = 1.0  # API 进程检查被订阅任务版本变化的间隔（发现其他进程中处理的任务的变化）
+    TASK_MAX_IN_FLIGHT_PER_USER: int = 2  # 每个用户（游客按 IP）同时处理的任务上限
+    TASK_PRIORITY_USER: int = 10  # 登录用户任务的优先级（数值大的先执行）
+    TASK_PRIORITY_GUEST: int = 0  # 游客任务的优先级
+    TASK_SHORTEST_JOB_FIRST: bool = False  # 同一优先级内按最近的阶段耗时估算，预计耗时短的任务先执行（等待时间会抵消差距）
+    TRUST_FORWARDED_FOR: bool = False  # 部署在反向代理后时，使用 X-Forwarded-For 识别游客 IP
+    
+    # 准入控制：按排队深度和最近的完成速率拒绝新任务，避免所有任务一起超时
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_QUEUE_DEPTH: int = 100  # 排队中任务数上限，超过时返回 503
+    ADMISSION_MAX_EXPECTED_WAIT_SECONDS: int = 300  # 按完成速率估算的排队等待上限，超过时返回 503
+    ADMISSION_MAX_PENDING_PER_USER: int = 5  # 每个用户（游客按 IP）排队中的任务上限，超过时返回 429
+    ADMISSION_RATE_WINDOW_SECONDS: int = 300  # 统计完成速率的时间窗口
+    ADMISSION_STATS_TTL_SECONDS: float = 2.0  # 队列统计的缓存时间，避免每个请求都统计
+    ADMISSION_DEGRADED_MODE: bool = True  # 超载时如有相同需求的已完成行程，直接返回该行程
+    ADMISSION_CACHE_MAX_AGE_HOURS: int = 72  # 降级模式可复用结果的最长时间
+    
+    # 行程内容的压缩算法：zstd / zlib / none（已有数据用 migrate_itinerary_blobs.py 转换）
+    STORAGE_COMPRESSION: str = "zstd"
+    
+    # 历史行程全文检索（SQLite FTS5 / PostgreSQL tsvector），关闭或不可用时历史搜索使用 LIKE
+    SEARCH_INDEX_ENABLED: bool = True
+    
+    # 分享链接解析结果的进程内缓存（修改分享或行程时失效，其他进程中的修改在 TTL 后生效；TTL 为 0 时关闭）
+    SHARE_CACHE_TTL_SECONDS: float = 30.0
+    SHARE_CACHE_MAX_ENTRIES: int = 1024
+    
+    # 数据保留策略（后台定期清理）
+    RETENTION_ENABLED: bool = True
+    RETENTION_INTERVAL_SECONDS: int = 3600  # 清理周期
+    RETENTION_BATCH_SIZE: int = 500  # 每批删除的行数（小批量提交，避免长时间锁住 SQLite）
+    RETENTION_BATCH_PAUSE_SECONDS: float = 0.1  # 批次之间的间隔，让出写锁
+    RETENTION_COMPLETED_TASK_DAYS: int = 7  # 已完成任务保留天数（<=0 表示不清理）
+    RETENTION_FAILED_TASK_DAYS: int = 3  # 失败和已取消任务的保留天数（<=0 表示不清理）
+    RETENTION_TEMPORARY_SHARE_GRACE_DAYS: int = 0  # 临时分享过期后再保留的天数
+    RETENTION_ARCHIVE_DIR: str = ""  # 设置后，清理的任务先归档为 JSON Lines（gzip）
+    
     # Security
     SECRET_KEY: str = "your-super-secret-key-for-jwt-change-this-in-production"
     
@@ -69,14 +131,149 @@ def get_settings():
 
 settings = get_settings()
 
-# 创建数据库引擎
-engine = create_engine(
-    settings.DATABASE_URL, 
-    connect_args={"check_same_thread": False} if settings.DATABASE_URL.startswith("sqlite") else {}
-)
+
+def _is_sqlite_file(url: str) -> bool:
+    return url.startswith("sqlite") and ":memory:" not in url and "mode=memory" not in url
+
+
+# 是否启用 SQLite 生产配置（内存数据库无法在多个连接间共享，不启用）
+SQLITE_PROFILE = settings.SQLITE_PRODUCTION_PROFILE and _is_sqlite_file(settings.DATABASE_URL)
+
+
+def _apply_sqlite_pragmas(dbapi_connection):
+    """
+    每个新连接的 PRAGMA：
+    WAL 让读取和写入互不阻塞；synchronous=NORMAL 在 WAL 下只在检查点时 fsync；
+    busy_timeout 让跨进程的写入排队等待而不是立即报 database is locked
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size={-int(settings.SQLITE_CACHE_SIZE_KB)}")
+    finally:
+        cursor.close()
+
+
+def _configure_sqlite_writer(writer):
+    @event.listens_for(writer, "connect")
+    def _connect_writer(dbapi_connection, connection_record):
+        _apply_sqlite_pragmas(dbapi_connection)
+        # 由下面的 begin 事件显式开始事务，不使用 pysqlite 在第一条 DML 前隐式发出的 BEGIN
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(writer, "begin")
+    def _begin_writer(conn):
+        # 事务开始时即取得写锁（其他进程持有写锁时按 busy_timeout 等待），避免读事务中途升级为写事务时的锁冲突
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _configure_sqlite_reader(reader):
+    @event.listens_for(reader, "connect")
+    def _connect_reader(dbapi_connection, connection_record):
+        _apply_sqlite_pragmas(dbapi_connection)
+
+
+def _async_database_url(url: str) -> str:
+    """异步引擎的连接串：SQLite 使用 aiosqlite，PostgreSQL 使用 asyncpg"""
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    scheme, rest = url.split(":", 1)
+    if scheme == "sqlite":
+        return f"sqlite+aiosqlite:{rest}"
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        return f"postgresql+asyncpg:{rest}"
+    return url
+
+
+ASYNC_DATABASE_URL = _async_database_url(settings.DATABASE_URL)
+
+# 创建数据库引擎（engine 用于同步会话，async_engine 用于异步会话）
+if SQLITE_PROFILE:
+    # 写连接：每个引擎只有一个，需要写入的会话依次取得（写入在进程内串行执行，
+    # 同步和异步两个写连接之间以及跨进程由 BEGIN IMMEDIATE + busy_timeout 串行）
+    writer_options = {"pool_size": 1, "max_overflow": 0, "pool_timeout": settings.SQLITE_WRITE_TIMEOUT_SECONDS}
+    # 读连接池：事务中写入之前的查询使用
+    reader_options = {
+        "pool_size": max(1, settings.SQLITE_READ_POOL_SIZE),
+        "max_overflow": max(0, settings.SQLITE_READ_POOL_SIZE),
+    }
+    sqlite_connect_args = {"check_same_thread": False}
+
+    engine = create_engine(settings.DATABASE_URL, connect_args=sqlite_connect_args, **writer_options)
+    read_engine = create_engine(settings.DATABASE_URL, connect_args=sqlite_connect_args, **reader_options)
+    # aiosqlite 默认不使用连接池（NullPool），这里同样使用固定大小的连接池
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, connect_args=sqlite_connect_args, **writer_options
+    )
+    async_read_engine = create_async_engine(
+        ASYNC_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, connect_args=sqlite_connect_args, **reader_options
+    )
+    for writer in (engine, async_engine.sync_engine):
+        _configure_sqlite_writer(writer)
+    for reader in (read_engine, async_read_engine.sync_engine):
+        _configure_sqlite_reader(reader)
+else:
+    engine = create_engine(
+        settings.DATABASE_URL, 
+        connect_args={"check_same_thread": False} if settings.DATABASE_URL.startswith("sqlite") else {}
+    )
+    read_engine = engine
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    async_read_engine = async_engine
+
+
+def _is_write_statement(clause) -> bool:
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith(("SELECT", "PRAGMA"))
+    # SELECT ... FOR UPDATE 表示随后要写入
+    return getattr(clause, "_for_update_arg", None) is not None
+
+
+class RoutingSession(Session):
+    """
+    SQLite 生产配置下的会话：事务中第一次写入之前的查询使用读连接池；
+    写入（flush、INSERT/UPDATE/DELETE）及同一事务中之后的语句都使用写连接，保证能读到本事务已写入的数据。
+    事务结束（提交或回滚）后归还写连接，下一个事务重新从读连接开始
+    """
+    writer_bind = engine
+    reader_bind = read_engine
+    _writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._writing or self._flushing or _is_write_statement(clause):
+            self._writing = True
+            return self.writer_bind
+        return self.reader_bind
+
+
+class AsyncRoutingSession(RoutingSession):
+    """异步会话内部使用的同步会话（按同样的规则选择异步引擎的读写连接）"""
+    writer_bind = async_engine.sync_engine
+    reader_bind = async_read_engine.sync_engine
+
+
+def _release_writer(session, transaction):
+    if transaction.parent is None:
+        session._writing = False
+
+
+for session_class in (RoutingSession, AsyncRoutingSession):
+    event.listen(session_class, "after_transaction_end", _release_writer)
+
 
 # 创建会话工厂
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 异步会话提交后不使对象过期：异步访问过期属性时无法隐式重新加载
+if SQLITE_PROFILE:
+    SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False)
+    AsyncSessionLocal = async_sessionmaker(sync_session_class=AsyncRoutingSession, autoflush=False, expire_on_commit=False)
+else:
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 # 声明基类
 Base = declarative_base()
@@ -88,3 +285,43 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def dispose_async_engines():
+    """关闭异步引擎的连接（aiosqlite 的连接线程不关闭时进程无法退出）"""
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+
+# 依赖注入：获取异步数据库会话（查询不阻塞事件循环；需要复用同步函数时使用 await db.run_sync(...)）
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def ensure_schema(bind=None):
+    """
+    轻量级迁移：为已存在的表补充模型中新增的列和索引
+
+    create_all 只会创建缺失的表，不会修改已有表结构。
+    新增列均为可空或带标量默认值，可以安全地 ALTER TABLE ADD COLUMN。
+    """
+    bind = bind or engine
+    # 在同一个连接上检查和修改（SQLite 生产配置下写连接只有一个）
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=bind.dialect)}"
+                if column.default is not None and column.default.is_scalar:
+                    value = column.default.arg
+                    ddl += f" DEFAULT {value!r}" if isinstance(value, str) else f" DEFAULT {int(value) if isinstance(value, bool) else value}"
+                conn.execute(text(ddl))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -2,10 +2,13 @@
 数据库模型定义
 包含用户表和旅行计划表
 """
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, UniqueConstraint
+from typing import Optional
+
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, UniqueConstraint, Index, LargeBinary, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
+from .compression import decompress
 
 class User(Base):
     """用户表"""
@@ -17,10 +20,30 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
+    # 列表页的总数（见 app/user_counters.py），为空表示尚未统计
+    itinerary_count = Column(Integer, nullable=True)
+    favorite_count = Column(Integer, nullable=True)
+    
     # 关联历史记录
     itineraries = relationship("Itinerary", back_populates="user", cascade="all, delete-orphan")
 
 
+class ItineraryBlob(Base):
+    """行程内容表（内容寻址：按 JSON 的 sha256 哈希存储压缩后的数据，相同内容只存一份）"""
+    __tablename__ = "itinerary_blobs"
+    
+    hash = Column(String(64), primary_key=True)  # 原始 JSON（UTF-8）的 sha256
+    data = Column(LargeBinary, nullable=False)  # 压缩后的 JSON
+    compression = Column(String(16), nullable=False, default="zlib")  # zstd / zlib / none
+    size = Column(Integer, nullable=False)  # 压缩前的字节数
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    @property
+    def json_text(self) -> str:
+        """解压后的 JSON 文本"""
+        return decompress(self.data, self.compression).decode("utf-8")
+
+
 class Itinerary(Base):
     """旅行计划表"""
     __tablename__ = "itineraries"
@@ -38,17 +61,78 @@ class Itinerary(Base):
     extra_requirements = Column(Text)
     
     # 生成的行程（JSON 格式）
-    itinerary_data = Column(Text, nullable=False)  # 完整的 JSON 数据
+    itinerary_data = Column(Text, nullable=False, default="")  # 旧数据的内联 JSON；新数据存放在 itinerary_blobs，此处为空
+    itinerary_hash = Column(String(64), ForeignKey("itinerary_blobs.hash"), nullable=True, index=True)  # 行程内容哈希
+    content_hash = Column(String(64), nullable=True)  # 请求参数 + 行程内容的哈希，用于去重（见 app/itinerary_dedupe.py）
     
     # 快速检索字段
     total_budget = Column(Float)
     
+    # 列表页的摘要（保存行程内容时提取，见 app/itinerary_plans.py），为空表示尚未提取
+    activity_count = Column(Integer, nullable=True)
+    cover_image = Column(String(1000), nullable=True)  # 第一张活动图片（小图）
+    day_titles = Column(Text, nullable=True)  # 每日标题的 JSON 数组
+    
     # 时间戳
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
+    # 历史列表按用户筛选后排序分页
+    __table_args__ = (
+        Index('ix_itineraries_user_created', 'user_id', 'created_at'),
+        Index('ix_itineraries_user_budget', 'user_id', 'total_budget'),
+        Index('ix_itineraries_user_days', 'user_id', 'days'),
+        # 同一用户不保存重复的行程（旧数据 content_hash 为空，不受限制）
+        Index('uq_itineraries_user_content', 'user_id', 'content_hash', unique=True),
+    )
+    
     # 关联用户
     user = relationship("User", back_populates="itineraries")
+    # 行程内容
+    blob = relationship("ItineraryBlob")
+    
+    @property
+    def itinerary_json(self) -> str:
+        """行程 JSON（优先读取内容表，兼容旧的内联数据）"""
+        return self.blob.json_text if self.blob is not None else self.itinerary_data
+
+
+class ItineraryDay(Base):
+    """行程的每日计划（从行程内容中提取，见 app/itinerary_plans.py）"""
+    __tablename__ = "daily_plans"
+    
+    id = Column(Integer, primary_key=True)
+    itinerary_id = Column(Integer, ForeignKey("itineraries.id", ondelete="CASCADE"), nullable=False)
+    day = Column(Integer, nullable=False)
+    title = Column(String(255))
+    activity_count = Column(Integer, nullable=False, default=0)
+    total_cost = Column(Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('ix_daily_plans_itinerary_day', 'itinerary_id', 'day'),
+    )
+
+
+class ItineraryActivity(Base):
+    """行程中的活动（从行程内容中提取，city 为行程的目的地）"""
+    __tablename__ = "activities"
+    
+    id = Column(Integer, primary_key=True)
+    itinerary_id = Column(Integer, ForeignKey("itineraries.id", ondelete="CASCADE"), nullable=False)
+    day = Column(Integer, nullable=False)
+    position = Column(Integer, nullable=False, default=0)  # 当天的第几个活动
+    time = Column(String(32))
+    title = Column(String(255))
+    address = Column(String(500))
+    city = Column(String(255))
+    duration = Column(String(64))
+    cost = Column(Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        Index('ix_activities_itinerary_day', 'itinerary_id', 'day', 'position'),
+        Index('ix_activities_city_title', 'city', 'title'),  # 按城市统计热门地点
+        Index('ix_activities_title', 'title'),
+    )
 
 
 class EmailVerification(Base):
@@ -58,7 +142,7 @@ class EmailVerification(Base):
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String(255), index=True, nullable=False)
     verification_code = Column(String(255), nullable=False)
-    expires_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
@@ -89,6 +173,7 @@ class Favorite(Base):
     # 唯一约束：一个用户不能重复收藏同一个行程
     __table_args__ = (
         UniqueConstraint('user_id', 'itinerary_id', name='uq_user_itinerary'),
+        Index('ix_favorites_user_created', 'user_id', 'created_at', 'id'),  # 收藏列表按收藏时间分页
     )
 
 
@@ -98,9 +183,18 @@ class TemporaryShare(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     share_token = Column(String(64), unique=True, index=True, nullable=False)
-    itinerary_data = Column(Text, nullable=False)  # 完整的行程数据（JSON格式）
-    expires_at = Column(DateTime(timezone=True), nullable=False)  # 必须设置过期时间
+    itinerary_data = Column(Text, nullable=False, default="")  # 旧数据的内联 JSON；新数据存放在 itinerary_blobs，此处为空
+    itinerary_hash = Column(String(64), ForeignKey("itinerary_blobs.hash"), nullable=True, index=True)  # 行程内容哈希
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)  # 必须设置过期时间
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # 行程内容
+    blob = relationship("ItineraryBlob")
+    
+    @property
+    def itinerary_json(self) -> str:
+        """行程 JSON（优先读取内容表，兼容旧的内联数据）"""
+        return self.blob.json_text if self.blob is not None else self.itinerary_data
 
 
 class Task(Base):
@@ -110,10 +204,45 @@ class Task(Base):
     id = Column(Integer, primary_key=True, index=True)
     task_id = Column(String(64), unique=True, index=True, nullable=False)  # 唯一任务ID
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)  # 可为空，支持游客用户
-    status = Column(String(20), nullable=False, default="pending")  # pending, processing, completed, failed
+    status = Column(String(20), nullable=False, default="pending")  # pending, processing, completed, failed, cancelled
     request_data = Column(Text, nullable=False)  # 请求参数（JSON格式）
-    result_data = Column(Text, nullable=True)  # 结果数据（JSON格式，完成后填充）
+    request_hash = Column(String(64), nullable=True)  # 请求参数指纹，超载时据此复用相同需求的已完成结果
+    result_data = Column(Text, nullable=True)  # 旧数据的内联结果 JSON；新结果存放在 itinerary_blobs
+    result_hash = Column(String(64), ForeignKey("itinerary_blobs.hash"), nullable=True, index=True)  # 结果内容哈希
     error_message = Column(Text, nullable=True)  # 错误信息
+    itinerary_id = Column(Integer, ForeignKey("itineraries.id"), nullable=True)  # 登录用户保存的行程ID
+    itinerary_created = Column(Boolean, nullable=True)  # 行程记录是否由本任务新建（去重复用已有记录时为 False）
+    # 图片补全阶段（文字行程完成后异步进行）
+    image_status = Column(String(20), nullable=True)  # pending, processing, completed, failed, cancelled
+    image_progress = Column(Integer, default=0)  # 已处理的活动数
+    image_total = Column(Integer, default=0)  # 需要处理的活动总数
+    # 持久化任务队列：租约（lease）与重试
+    attempts = Column(Integer, default=0)  # 已开始处理的次数
+    lease_owner = Column(String(128), nullable=True)  # 持有租约的 worker 标识
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)  # 租约到期时间（待重试任务表示最早可执行时间）
+    version = Column(Integer, default=0)  # 状态版本号，每次客户端可见的变化都递增（用于长轮询）
+    # 公平调度：按提交者分组（登录用户 user:<id>，游客 ip:<地址>），高优先级先执行
+    owner_key = Column(String(128), nullable=True)
+    priority = Column(Integer, default=0)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)  # 完成时间
+    started_at = Column(DateTime(timezone=True), nullable=True)  # 最近一次被领取（开始处理）的时间
+    available_at = Column(DateTime(timezone=True), nullable=True)  # 最近一次重新入队（重试、释放租约）后可被领取的时间，为空时按创建时间
+    timings = Column(Text, nullable=True)  # 各阶段耗时（毫秒，紧凑 JSON，见 app/timings.py）
+    
+    __table_args__ = (
+        Index('ix_tasks_status_lease', 'status', 'lease_expires_at'),
+        Index('ix_tasks_status_created', 'status', 'created_at'),  # 数据保留策略按状态和创建时间清理
+        Index('ix_tasks_status_owner', 'status', 'owner_key'),  # 公平调度统计每个提交者的任务
+        Index('ix_tasks_status_completed', 'status', 'completed_at'),  # 准入控制统计最近的完成速率
+        Index('ix_tasks_request_hash', 'request_hash', 'completed_at'),  # 降级模式查找相同需求的结果
+    )
+    
+    # 结果内容
+    result_blob = relationship("ItineraryBlob")
+    
+    @property
+    def result_json(self) -> Optional[str]:
+        """结果 JSON（优先读取内容表，兼容旧的内联数据）"""
+        return self.result_blob.json_text if self.result_blob is not None else self.result_data
@@ -0,0 +1,162 @@
+"""
+任务完成时间预估
+根据最近完成任务的阶段耗时（Task.timings）按行程天数估算生成耗时和每个活动的图片补全耗时，
+结合排队位置给出预计完成时间。客户端据此安排轮询间隔，调度器也可以据此让预计耗时短的任务先执行。
+
+历史数据只取最近一段时间，反映当前 LLM Provider 和负载下的实际耗时。
+"""
+import json
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from statistics import median
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import settings
+from .db_models import Task
+from .timings import STAGE_IMAGES, STAGE_LLM, STAGE_PARSE, STAGE_VALIDATE, parse_timings, seconds_since, seconds_until
+
+# 没有历史数据时的默认耗时（秒）
+DEFAULT_GENERATE_SECONDS = 60.0
+DEFAULT_IMAGE_SECONDS_PER_ACTIVITY = 3.0
+# 某个天数的样本少于该值时使用全部任务的耗时
+MIN_SAMPLES_PER_DAYS = 3
+# 统计的历史范围
+HISTORY_HOURS = 24
+HISTORY_LIMIT = 500
+THROUGHPUT_WINDOW_SECONDS = 900
+# 估算模型的刷新间隔（秒）
+MODEL_REFRESH_SECONDS = 60
+# 已超出预计耗时的任务，至少再预留的时间（秒）
+MIN_REMAINING_SECONDS = 5
+
+GENERATE_STAGES = (STAGE_LLM, STAGE_PARSE, STAGE_VALIDATE)
+
+
+def task_days(request_data: Optional[str]) -> int:
+    """任务请求中的行程天数"""
+    try:
+        return int(json.loads(request_data or "{}").get("days") or 2)
+    except (TypeError, ValueError):
+        return 2
+
+
+class EtaModel:
+    """按最近完成任务统计的耗时模型"""
+
+    def __init__(
+        self,
+        generate_by_days: Dict[int, float],
+        generate_overall: float,
+        image_seconds_per_activity: float,
+        throughput: float,
+        samples: int,
+    ):
+        self.generate_by_days = generate_by_days
+        self.generate_overall = generate_overall
+        self.image_seconds_per_activity = image_seconds_per_activity
+        self.throughput = throughput  # 最近的完成速率（个/秒）
+        self.samples = samples
+
+    def generate_seconds(self, days: int) -> float:
+        """生成文字行程的预计耗时（LLM 调用 + 解析 + 校验）"""
+        return self.generate_by_days.get(days, self.generate_overall)
+
+
+class EtaEstimator:
+    """任务预计完成时间的估算（模型定期从数据库刷新）"""
+
+    def __init__(self, refresh_seconds: float = MODEL_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._model: Optional[EtaModel] = None
+        self._model_at = 0.0
+        self._lock = threading.Lock()
+
+    def model(self, db: Session) -> EtaModel:
+        with self._lock:
+            if self._model is not None and time.monotonic() - self._model_at < self.refresh_seconds:
+                return self._model
+        model = self._build_model(db)
+        with self._lock:
+            self._model = model
+            self._model_at = time.monotonic()
+        return model
+
+    def _build_model(self, db: Session) -> EtaModel:
+        now = datetime.utcnow()
+        rows = db.query(Task.request_data, Task.timings, Task.image_total).filter(
+            Task.status == "completed",
+            Task.completed_at >= now - timedelta(hours=HISTORY_HOURS),
+            Task.timings.isnot(None)
+        ).order_by(Task.completed_at.desc()).limit(HISTORY_LIMIT).all()
+
+        generate_samples: Dict[int, List[float]] = {}
+        all_generate: List[float] = []
+        image_samples: List[float] = []
+        for request_data, timings_json, image_total in rows:
+            timings = parse_timings(timings_json)
+            if STAGE_LLM in timings:
+                seconds = sum(timings.get(stage, 0) for stage in GENERATE_STAGES) / 1000
+                generate_samples.setdefault(task_days(request_data), []).append(seconds)
+                all_generate.append(seconds)
+            if STAGE_IMAGES in timings and image_total:
+                image_samples.append(timings[STAGE_IMAGES] / 1000 / image_total)
+
+        completed_recently = db.query(func.count(Task.id)).filter(
+            Task.status == "completed",
+            Task.completed_at >= now - timedelta(seconds=THROUGHPUT_WINDOW_SECONDS)
+        ).scalar() or 0
+
+        return EtaModel(
+            generate_by_days={
+                days: median(samples) for days, samples in generate_samples.items()
+                if len(samples) >= MIN_SAMPLES_PER_DAYS
+            },
+            generate_overall=median(all_generate) if all_generate else DEFAULT_GENERATE_SECONDS,
+            image_seconds_per_activity=median(image_samples) if image_samples else DEFAULT_IMAGE_SECONDS_PER_ACTIVITY,
+            throughput=completed_recently / THROUGHPUT_WINDOW_SECONDS,
+            samples=len(rows),
+        )
+
+    def remaining_seconds(self, db: Session, task: Task, position: Optional[int] = None) -> Optional[float]:
+        """
+        距离下一个结果可用的预计秒数：排队中 / 生成中为文字行程，图片补全中为图片全部完成；任务已结束返回 None
+        """
+        model = self.model(db)
+        generate = model.generate_seconds(task_days(task.request_data))
+
+        if task.status == "pending":
+            position = position or 1
+            # 按 worker 数分批执行，与按最近完成速率估算取较小值（多个 worker 进程时后者更准）
+            wait = math.ceil(position / max(1, settings.TASK_WORKER_CONCURRENCY)) * generate
+            if model.throughput > 0:
+                wait = min(wait, position / model.throughput)
+            # 待重试的任务要等到可执行时间之后
+            if task.lease_expires_at is not None:
+                wait = max(wait, seconds_until(task.lease_expires_at))
+            return wait + generate
+
+        if task.status == "processing":
+            # 领取任务时写入 started_at（续租不会修改），旧任务没有时退回 updated_at
+            started_at = task.started_at or task.updated_at
+            return max(generate - seconds_since(started_at), MIN_REMAINING_SECONDS)
+
+        if task.status == "completed" and task.image_status in ("pending", "processing"):
+            remaining = max((task.image_total or 0) - (task.image_progress or 0), 0)
+            return max(remaining * model.image_seconds_per_activity, MIN_REMAINING_SECONDS)
+
+        return None
+
+    def estimate(self, db: Session, task: Task, position: Optional[int] = None) -> Optional[datetime]:
+        """预计完成时间（UTC），任务已结束返回 None"""
+        remaining = self.remaining_seconds(db, task, position)
+        if remaining is None:
+            return None
+        return datetime.utcnow() + timedelta(seconds=remaining)
+
+
+eta_estimator = EtaEstimator()
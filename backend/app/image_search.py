@@ -4,19 +4,89 @@
 支持的 API：
 1. Unsplash API (推荐首选) - 数百万专业旅行照片
 2. Pexels API (并列首选) - 完全免费无限请求
+3. 本地图片库 (离线) - 索引本地目录中带标签的照片，零网络请求
+
+通过 IMAGE_PROVIDERS 配置选择并排序 Provider（默认 unsplash,pexels），
+例如 IMAGE_PROVIDERS=local 可在离线环境下运行并获得确定性的结果。
 
 API 获取指南：
 - Unsplash: https://unsplash.com/developers (免费 50 requests/hour)
 - Pexels: https://www.pexels.com/api/ (完全免费无限制)
 """
 import os
+import re
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import threading
 import urllib.parse
 import requests
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, Union, Callable
 import time
 
+from .database import settings
+
+
+# 响应式图片尺寸（宽度，px）：前端据此生成 srcset，PDF 使用 small
+IMAGE_VARIANT_WIDTHS = {
+    "small": 400,
+    "medium": 800,
+    "large": 1080,
+}
+
+
+def _unsplash_image(photo: Dict[str, Any]) -> Dict[str, Any]:
+    """把 Unsplash 结果转换为带多尺寸版本的图片对象（基于 raw URL 的 w 参数）"""
+    urls = photo["urls"]
+    raw = urls.get("raw")
+    variants = {}
+    for name, width in IMAGE_VARIANT_WIDTHS.items():
+        if raw:
+            separator = "&" if "?" in raw else "?"
+            variants[name] = f"{raw}{separator}w={width}&q=80&fm=jpg&fit=max"
+    if not variants:
+        variants = {"small": urls.get("small", urls["regular"]), "large": urls["regular"]}
+    return {"url": urls["regular"], "source": "unsplash", "variants": variants}
+
+
+def _pexels_image(photo: Dict[str, Any]) -> Dict[str, Any]:
+    """把 Pexels 结果转换为带多尺寸版本的图片对象（基于 original URL 的 w 参数）"""
+    src = photo["src"]
+    original = src.get("original")
+    variants = {}
+    for name, width in IMAGE_VARIANT_WIDTHS.items():
+        if original:
+            separator = "&" if "?" in original else "?"
+            variants[name] = f"{original}{separator}auto=compress&cs=tinysrgb&w={width}"
+    if not variants:
+        variants = {"small": src.get("medium", src["large"]), "large": src["large"]}
+    return {"url": src["large"], "source": "pexels", "variants": variants}
+
+
+def image_url(image: Union[str, Dict[str, Any]], size: str = "") -> str:
+    """
+    取图片URL，兼容旧的纯字符串格式和新的图片对象格式
+
+    Args:
+        image: 图片URL字符串或图片对象（url/source/variants）
+        size: 需要的尺寸（small/medium/large），为空或不存在时返回默认 url
+    """
+    if isinstance(image, str):
+        return image
+    if not isinstance(image, dict):
+        image = image.model_dump() if hasattr(image, "model_dump") else {}
+    variants = image.get("variants") or {}
+    return variants.get(size) or image.get("url", "")
 
-def get_image_for_activity(activity_name: str, location: str = "", category: str = "") -> List[str]:
+
+def get_image_for_activity(
+    activity_name: str,
+    location: str = "",
+    category: str = "",
+    detailed: bool = False
+) -> List[Union[str, Dict[str, Any]]]:
     """
     根据活动名称和位置获取真实景点图片（优先使用 Unsplash/Pexels API）
     
@@ -24,9 +94,10 @@ def get_image_for_activity(activity_name: str, location: str = "", category: str
         activity_name: 活动名称，如"故宫"、"南翔馒头店"
         location: 位置，如"北京"、"上海"
         category: 类别，如"景点"、"餐厅"、"酒店"
+        detailed: 为 True 时返回带多尺寸版本的图片对象，否则返回URL字符串
     
     Returns:
-        图片URL列表（2-3张真实照片），如果找不到相关图片返回空列表
+        图片列表（2-3张真实照片），如果找不到相关图片返回空列表
     """
     import logging
     logger = logging.getLogger(__name__)
@@ -164,36 +235,30 @@ def get_image_for_activity(activity_name: str, location: str = "", category: str
             
         logger.info(f"\n📸 尝试查询 {i+1}/{len(queries)}: '{query}'")
         
-        # 先尝试 Unsplash
-        unsplash_images = search_unsplash(query, count=3 - len(images))
-        if unsplash_images:
-            images.extend(unsplash_images)
-            logger.info(f"   Unsplash: 获得 {len(unsplash_images)} 张")
-        
-        # 如果还不够，尝试 Pexels
-        if len(images) < 3:
-            pexels_images = search_pexels(query, count=3 - len(images))
-            if pexels_images:
-                # 过滤重复图片
-                for img in pexels_images:
-                    if img not in images:
-                        images.append(img)
-                logger.info(f"   Pexels: 获得 {len(pexels_images)} 张")
-    
-    # 去重
-    images = list(dict.fromkeys(images))
+        # 按 IMAGE_PROVIDERS 顺序尝试（默认先 Unsplash 再 Pexels）
+        for provider in get_image_providers():
+            if len(images) >= 3:
+                break
+            provider_images = provider(query, count=3 - len(images), detailed=True)
+            if provider_images:
+                images.extend(provider_images)
+                logger.info(f"   {provider.__name__}: 获得 {len(provider_images)} 张")
+    
+    # 按默认URL去重
+    images = list({image_url(img): img for img in images}.values())
     
     final_count = len(images)
     logger.info(f"\n{'='*70}")
     if images:
         logger.info(f"✅ 最终结果: 成功获取 {final_count} 张图片")
         for i, img in enumerate(images[:3], 1):
-            logger.info(f"   {i}. {img[:100]}...")
+            logger.info(f"   {i}. {image_url(img)[:100]}...")
     else:
         logger.warning(f"⚠️  最终结果: 未找到相关图片（返回空数组）")
     logger.info(f"{'='*70}\n")
     
-    return images[:3] if images else []
+    images = images[:3]
+    return images if detailed else [image_url(img) for img in images]
 
 
 def extract_food_keywords(name: str, location: str) -> str:
@@ -268,13 +333,8 @@ def get_image_for_location(location: str, image_type: str = "cityscape") -> str:
     """
     query = f"{location} {image_type} travel"
     
-    # 优先 Unsplash
-    images = search_unsplash(query, count=1)
-    if images:
-        return images[0]
-    
-    # 备用 Pexels
-    images = search_pexels(query, count=1)
+    # 按 IMAGE_PROVIDERS 顺序搜索（默认优先 Unsplash，备用 Pexels）
+    images = search_images(query, count=1)
     if images:
         return images[0]
     
@@ -282,7 +342,7 @@ def get_image_for_location(location: str, image_type: str = "cityscape") -> str:
     return ""
 
 
-def search_unsplash(query: str, count: int = 3) -> List[str]:
+def search_unsplash(query: str, count: int = 3, detailed: bool = False) -> List[Union[str, Dict[str, Any]]]:
     """
     使用 Unsplash API 搜索真实旅行照片
     
@@ -298,9 +358,10 @@ def search_unsplash(query: str, count: int = 3) -> List[str]:
     Args:
         query: 搜索关键词（如 "Eiffel Tower Paris landmark"）
         count: 返回图片数量
+        detailed: 为 True 时返回图片对象（url + small/medium/large 尺寸版本）
     
     Returns:
-        图片URL列表（regular 尺寸，约 1080px）
+        图片URL列表（regular 尺寸，约 1080px），或图片对象列表
     """
     import logging
     logger = logging.getLogger(__name__)
@@ -344,17 +405,17 @@ def search_unsplash(query: str, count: int = 3) -> List[str]:
         
         logger.debug(f"   📊 API返回: total={total}, results={len(results)}")
         
-        # 返回 regular 尺寸（约1080px），适合网页显示
-        images = [photo["urls"]["regular"] for photo in results]
+        # 默认 regular 尺寸（约1080px），适合网页显示；detailed 时附带多尺寸版本
+        images = [_unsplash_image(photo) for photo in results]
         
         if images:
             logger.debug(f"   ✅ 成功获取 {len(images)} 张图片")
             for i, img in enumerate(images[:2], 1):
-                logger.debug(f"      {i}. {img[:80]}...")
+                logger.debug(f"      {i}. {img['url'][:80]}...")
         else:
             logger.debug(f"   ⚠️  未找到图片")
         
-        return images
+        return images if detailed else [img["url"] for img in images]
     
     except requests.exceptions.Timeout:
         logger.warning(f"   ❌ 请求超时 (>10秒)")
@@ -371,7 +432,7 @@ def search_unsplash(query: str, count: int = 3) -> List[str]:
         return []
 
 
-def search_pexels(query: str, count: int = 3) -> List[str]:
+def search_pexels(query: str, count: int = 3, detailed: bool = False) -> List[Union[str, Dict[str, Any]]]:
     """
     使用 Pexels API 搜索真实旅行照片（完全免费）
     
@@ -387,9 +448,10 @@ def search_pexels(query: str, count: int = 3) -> List[str]:
     Args:
         query: 搜索关键词（如 "Grand Palace Bangkok hotel"）
         count: 返回图片数量
+        detailed: 为 True 时返回图片对象（url + small/medium/large 尺寸版本）
     
     Returns:
-        图片URL列表（large 尺寸）
+        图片URL列表（large 尺寸），或图片对象列表
     """
     import logging
     logger = logging.getLogger(__name__)
@@ -432,17 +494,17 @@ def search_pexels(query: str, count: int = 3) -> List[str]:
         
         logger.debug(f"   📊 API返回: total_results={total}, photos={len(photos)}")
         
-        # 返回 large 尺寸图片
-        images = [photo["src"]["large"] for photo in photos]
+        # 默认 large 尺寸图片；detailed 时附带多尺寸版本
+        images = [_pexels_image(photo) for photo in photos]
         
         if images:
             logger.debug(f"   ✅ 成功获取 {len(images)} 张图片")
             for i, img in enumerate(images[:2], 1):
-                logger.debug(f"      {i}. {img[:80]}...")
+                logger.debug(f"      {i}. {img['url'][:80]}...")
         else:
             logger.debug(f"   ⚠️  未找到图片")
         
-        return images
+        return images if detailed else [img["url"] for img in images]
     
     except requests.exceptions.Timeout:
         logger.warning(f"   ❌ 请求超时 (>10秒)")
@@ -482,3 +544,281 @@ def get_placeholder_images(text: str, count: int = 3) -> List[str]:
         images.append(f"https://placehold.co/800x600/{color}/ffffff?text={encoded_text}")
     
     return images
+
+
+# ============ 本地图片库（离线 Provider） ============
+#
+# 用于开发、离线环境和 API 配额耗尽时：索引本地目录中带标签的旅行照片。
+# 标签来源：
+#   1. 相对路径中的目录名和文件名（按 _ - . 空格 等切分），如 北京/故宫_landmark_01.jpg
+#   2. 目录下可选的 tags.json：{"北京/故宫_01.jpg": ["故宫", "palace", "beijing"]}
+#
+# 倒排索引在启动时构建并写入紧凑的二进制文件，之后通过 mmap 只读访问，
+# 目录内容未变化时直接复用已有索引文件。
+
+LOCAL_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+LOCAL_IMAGE_MANIFEST = "tags.json"
+
+_LOCAL_INDEX_MAGIC = b"TGIMGIX1"
+_LOCAL_INDEX_HEADER = struct.Struct("<8sIIQ")    # magic, term_count, image_count, signature
+_LOCAL_INDEX_TERM = struct.Struct("<IHII")       # term_offset, term_len, postings_offset, postings_count
+_LOCAL_INDEX_IMAGE = struct.Struct("<IH")        # path_offset, path_len
+_LOCAL_INDEX_POSTING = struct.Struct("<I")       # image_id
+
+_TOKEN_SPLIT = re.compile(r"[\s_\-.,，、/\\()（）]+")
+
+
+def _tokenize(text: str) -> List[str]:
+    """把查询或标签切分为小写关键词"""
+    return [token for token in _TOKEN_SPLIT.split(text.lower()) if token]
+
+
+class LocalImageIndex:
+    """
+    本地图片库的倒排索引（关键词 -> 图片编号），通过 mmap 只读访问
+
+    文件布局（小端）：
+        header   magic, term_count, image_count, signature
+        terms    term_count 个定长条目，按关键词的 UTF-8 字节升序排列（用于二分查找）
+        images   image_count 个定长条目（相对路径的位置）
+        postings 每个关键词对应的图片编号（uint32）
+        strings  关键词和相对路径的 UTF-8 字节
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.term_count, self.image_count, self.signature = _LOCAL_INDEX_HEADER.unpack_from(self._mm, 0)
+        if magic != _LOCAL_INDEX_MAGIC:
+            self._mm.close()
+            raise ValueError(f"无效的本地图片索引文件: {index_path}")
+        self._terms_offset = _LOCAL_INDEX_HEADER.size
+        self._images_offset = self._terms_offset + self.term_count * _LOCAL_INDEX_TERM.size
+
+    @staticmethod
+    def scan(image_dir: str) -> Dict[str, List[str]]:
+        """扫描图片目录，返回 {相对路径: 关键词列表}"""
+        manifest = {}
+        manifest_path = os.path.join(image_dir, LOCAL_IMAGE_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+
+        images = {}
+        for root, _, files in os.walk(image_dir):
+            for name in files:
+                if os.path.splitext(name)[1].lower() not in LOCAL_IMAGE_EXTENSIONS:
+                    continue
+                rel_path = os.path.relpath(os.path.join(root, name), image_dir).replace(os.sep, "/")
+                tokens = _tokenize(os.path.splitext(rel_path)[0])
+                for tag in manifest.get(rel_path, []):
+                    tokens.extend(_tokenize(tag))
+                images[rel_path] = sorted(set(tokens))
+        return dict(sorted(images.items()))
+
+    @staticmethod
+    def compute_signature(image_dir: str, images: Dict[str, List[str]]) -> int:
+        """根据文件列表、大小、修改时间和标签计算目录签名，用于判断索引是否需要重建"""
+        digest = hashlib.blake2b(digest_size=8)
+        for rel_path, tokens in images.items():
+            stat = os.stat(os.path.join(image_dir, rel_path))
+            digest.update(f"{rel_path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{' '.join(tokens)}\n".encode("utf-8"))
+        return int.from_bytes(digest.digest(), "little")
+
+    @classmethod
+    def build(cls, image_dir: str, index_path: str) -> "LocalImageIndex":
+        """扫描目录并构建索引；目录未变化时直接打开已有索引文件"""
+        images = cls.scan(image_dir)
+        signature = cls.compute_signature(image_dir, images)
+
+        if os.path.exists(index_path):
+            try:
+                index = cls(index_path)
+                if index.signature == signature:
+                    return index
+                index.close()
+            except (ValueError, OSError, struct.error):
+                pass
+
+        paths = list(images.keys())
+        postings: Dict[bytes, List[int]] = {}
+        for image_id, rel_path in enumerate(paths):
+            for token in images[rel_path]:
+                postings.setdefault(token.encode("utf-8"), []).append(image_id)
+        terms = sorted(postings.keys())
+
+        terms_size = len(terms) * _LOCAL_INDEX_TERM.size
+        images_size = len(paths) * _LOCAL_INDEX_IMAGE.size
+        postings_offset = _LOCAL_INDEX_HEADER.size + terms_size + images_size
+        strings_offset = postings_offset + sum(len(ids) for ids in postings.values()) * _LOCAL_INDEX_POSTING.size
+
+        term_table = bytearray()
+        posting_data = bytearray()
+        strings = bytearray()
+        for term in terms:
+            ids = postings[term]
+            term_table += _LOCAL_INDEX_TERM.pack(
+                strings_offset + len(strings), len(term),
+                postings_offset + len(posting_data), len(ids)
+            )
+            strings += term
+            for image_id in ids:
+                posting_data += _LOCAL_INDEX_POSTING.pack(image_id)
+
+        image_table = bytearray()
+        for rel_path in paths:
+            encoded = rel_path.encode("utf-8")
+            image_table += _LOCAL_INDEX_IMAGE.pack(strings_offset + len(strings), len(encoded))
+            strings += encoded
+
+        # 先写临时文件再原子替换，避免其他进程读到半成品
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_LOCAL_INDEX_HEADER.pack(_LOCAL_INDEX_MAGIC, len(terms), len(paths), signature))
+            f.write(term_table)
+            f.write(image_table)
+            f.write(posting_data)
+            f.write(strings)
+        os.replace(tmp_path, index_path)
+        return cls(index_path)
+
+    def close(self):
+        self._mm.close()
+
+    def _term_at(self, position: int):
+        term_offset, term_len, postings_offset, postings_count = _LOCAL_INDEX_TERM.unpack_from(
+            self._mm, self._terms_offset + position * _LOCAL_INDEX_TERM.size
+        )
+        return self._mm[term_offset:term_offset + term_len], postings_offset, postings_count
+
+    def postings(self, token: str) -> List[int]:
+        """二分查找关键词，返回包含该关键词的图片编号"""
+        target = token.encode("utf-8")
+        low, high = 0, self.term_count - 1
+        while low <= high:
+            mid = (low + high) // 2
+            term, postings_offset, postings_count = self._term_at(mid)
+            if term == target:
+                return [
+                    _LOCAL_INDEX_POSTING.unpack_from(self._mm, postings_offset + i * _LOCAL_INDEX_POSTING.size)[0]
+                    for i in range(postings_count)
+                ]
+            if term < target:
+                low = mid + 1
+            else:
+                high = mid - 1
+        return []
+
+    def path(self, image_id: int) -> str:
+        """图片编号 -> 相对路径"""
+        path_offset, path_len = _LOCAL_INDEX_IMAGE.unpack_from(
+            self._mm, self._images_offset + image_id * _LOCAL_INDEX_IMAGE.size
+        )
+        return self._mm[path_offset:path_offset + path_len].decode("utf-8")
+
+    def search(self, query: str, count: int = 3) -> List[str]:
+        """按命中的关键词数排序（相同得分按编号），结果是确定性的"""
+        scores: Dict[int, int] = {}
+        for token in set(_tokenize(query)):
+            for image_id in self.postings(token):
+                scores[image_id] = scores.get(image_id, 0) + 1
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:count]
+        return [self.path(image_id) for image_id, _ in ranked]
+
+
+_local_index: Optional[LocalImageIndex] = None
+_local_index_lock = threading.Lock()
+
+
+def load_local_image_index(force: bool = False) -> Optional[LocalImageIndex]:
+    """
+    构建（或复用）本地图片库索引，未配置 LOCAL_IMAGE_DIR 时返回 None
+
+    服务启动时调用一次；search_local 首次使用时也会按需加载。
+    """
+    global _local_index
+    import logging
+    logger = logging.getLogger(__name__)
+
+    image_dir = settings.LOCAL_IMAGE_DIR
+    if not image_dir:
+        return None
+
+    with _local_index_lock:
+        if _local_index is not None and not force:
+            return _local_index
+        if not os.path.isdir(image_dir):
+            logger.warning(f"   ❌ LOCAL_IMAGE_DIR 不存在: {image_dir}")
+            return None
+
+        index_path = settings.LOCAL_IMAGE_INDEX_PATH or os.path.join(
+            tempfile.gettempdir(),
+            f"travelgpt_image_index_{hashlib.md5(os.path.abspath(image_dir).encode('utf-8')).hexdigest()[:12]}.bin"
+        )
+        started = time.perf_counter()
+        index = LocalImageIndex.build(image_dir, index_path)
+        if _local_index is not None:
+            _local_index.close()
+        _local_index = index
+        logger.info(
+            f"🗂️  本地图片库索引就绪: {index.image_count} 张图片, {index.term_count} 个关键词, "
+            f"耗时 {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+        return _local_index
+
+
+def search_local(query: str, count: int = 3, detailed: bool = False) -> List[Union[str, Dict[str, Any]]]:
+    """
+    在本地图片库中搜索照片（零网络请求，与 search_unsplash/search_pexels 接口一致）
+
+    配置：
+        LOCAL_IMAGE_DIR=/path/to/photos
+        LOCAL_IMAGE_BASE_URL=http://localhost:8000/local-images  # 图片对外访问地址（后端自动挂载）
+
+    Args:
+        query: 搜索关键词
+        count: 返回图片数量
+        detailed: 为 True 时返回图片对象
+
+    Returns:
+        图片URL列表，或图片对象列表
+    """
+    index = load_local_image_index()
+    if index is None:
+        return []
+
+    base_url = settings.LOCAL_IMAGE_BASE_URL.rstrip("/")
+    images = [
+        {"url": f"{base_url}/{urllib.parse.quote(rel_path)}", "source": "local", "variants": {}}
+        for rel_path in index.search(query, count)
+    ]
+    return images if detailed else [img["url"] for img in images]
+
+
+# ============ 图片 Provider 注册表 ============
+
+IMAGE_PROVIDERS: Dict[str, Callable[..., List[Union[str, Dict[str, Any]]]]] = {
+    "unsplash": search_unsplash,
+    "pexels": search_pexels,
+    "local": search_local,
+}
+
+
+def get_image_providers() -> List[Callable[..., List[Union[str, Dict[str, Any]]]]]:
+    """按 IMAGE_PROVIDERS 配置（逗号分隔，默认 unsplash,pexels）返回启用的搜索函数"""
+    names = settings.IMAGE_PROVIDERS
+    return [IMAGE_PROVIDERS[name.strip()] for name in names.split(",") if name.strip() in IMAGE_PROVIDERS]
+
+
+def search_images(query: str, count: int = 3, detailed: bool = False) -> List[Union[str, Dict[str, Any]]]:
+    """依次使用启用的 Provider 搜索，直到凑够 count 张图片"""
+    images: List[Union[str, Dict[str, Any]]] = []
+    for provider in get_image_providers():
+        if len(images) >= count:
+            break
+        for img in provider(query, count=count - len(images), detailed=detailed):
+            if image_url(img) not in {image_url(existing) for existing in images}:
+                images.append(img)
+    return images[:count]
@@ -0,0 +1,298 @@
+"""
+行程去重
+Itinerary.content_hash 为规范化的请求参数（与降级模式的请求指纹相同，不含行程名称）加上行程内容（不含图片）的哈希，
+(user_id, content_hash) 上有唯一索引：保存行程时同一用户已有相同内容的记录则直接返回该记录，不再重复插入。
+
+已有数据由 dedupe_itineraries.py 处理：流式计算旧记录的 content_hash 写入临时表，
+再用集合操作找出重复记录（每组保留最新的一条），把任务、收藏和分享链接改为指向保留的记录后分批删除
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import column, delete, exists, func, insert, select, table, text, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+
+from .admission import request_fingerprint
+from .compression import decompress
+from .db_models import Favorite, Itinerary, ItineraryBlob, ShareLink, Task
+from .itinerary_plans import remove_itinerary_plans
+from .itinerary_store import purge_orphaned_itinerary_blobs
+from .search_index import index_itineraries, remove_from_search_index
+from .user_counters import adjust_user_counters, recount_user_counters
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE = "itinerary_dedupe"
+
+staging = table(
+    STAGING_TABLE,
+    column("id"),
+    column("user_id"),
+    column("content_hash"),
+    column("created_at"),
+    column("keep_id"),
+)
+
+
+# ============ 内容哈希 ============
+def content_hash(request_data: Dict[str, Any], content: Dict[str, Any]) -> str:
+    """请求参数 + 行程内容（去掉活动图片，图片补全前后哈希不变）的哈希"""
+    payload = dict(content)
+    payload["dailyPlans"] = [
+        {**plan, "activities": [
+            {key: value for key, value in activity.items() if key != "images"}
+            for activity in plan.get("activities") or [] if isinstance(activity, dict)
+        ]}
+        for plan in content.get("dailyPlans") or [] if isinstance(plan, dict)
+    ]
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(request_fingerprint(request_data).encode("ascii"))
+    digest.update(canonical.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def itinerary_request_data(itinerary) -> Dict[str, Any]:
+    """从行程记录（或包含相同字段的查询结果）还原请求参数"""
+    try:
+        preferences = json.loads(itinerary.preferences) if itinerary.preferences else []
+    except (TypeError, ValueError):
+        preferences = []
+    return {
+        "destination": itinerary.destination,
+        "days": itinerary.days,
+        "budget": itinerary.budget,
+        "travelers": itinerary.travelers,
+        "preferences": preferences,
+        "extraRequirements": itinerary.extra_requirements,
+    }
+
+
+def _parse_content(itinerary_json: Optional[str]) -> Dict[str, Any]:
+    try:
+        content = json.loads(itinerary_json or "{}")
+    except (TypeError, ValueError):
+        return {}
+    return content if isinstance(content, dict) else {}
+
+
+def refresh_content_hash(itinerary: Itinerary, content: Optional[Dict[str, Any]] = None):
+    """修改请求参数或重新生成后重新计算 content_hash"""
+    if content is None:
+        content = _parse_content(itinerary.itinerary_json)
+    itinerary.content_hash = content_hash(itinerary_request_data(itinerary), content)
+
+
+# ============ 保存 ============
+def save_itinerary_record(db: Session, itinerary: Itinerary) -> Tuple[Itinerary, bool]:
+    """
+    保存新的行程记录（需已设置 content_hash）：同一用户已有相同内容时不插入，返回已有记录
+    使用 INSERT ... ON CONFLICT DO NOTHING，并发保存相同内容时同样只保留一条。返回 (行程记录, 是否新插入)
+    """
+    if itinerary.blob is not None:
+        itinerary.itinerary_hash = itinerary.blob.hash
+    values = {
+        attr.key: getattr(itinerary, attr.key)
+        for attr in Itinerary.__table__.columns
+        if getattr(itinerary, attr.key) is not None
+    }
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        statement = sqlite_insert(Itinerary)
+    elif dialect == "postgresql":
+        statement = postgresql_insert(Itinerary)
+    else:
+        existing = db.query(Itinerary).filter(
+            Itinerary.user_id == itinerary.user_id,
+            Itinerary.content_hash == itinerary.content_hash
+        ).first()
+        if existing is not None:
+            return existing, False
+        db.add(itinerary)
+        db.flush()
+        return itinerary, True
+
+    new_id = db.execute(
+        statement.values(**values)
+        .on_conflict_do_nothing(index_elements=["user_id", "content_hash"])
+        .returning(Itinerary.id)
+    ).scalar()
+    if new_id is None:
+        existing = db.query(Itinerary).filter(
+            Itinerary.user_id == itinerary.user_id,
+            Itinerary.content_hash == itinerary.content_hash
+        ).one()
+        return existing, False
+    record = db.get(Itinerary, new_id)
+    # 不经过 ORM 的插入不会触发 after_flush，直接写入全文索引和更新计数
+    index_itineraries(db, [record])
+    adjust_user_counters(db, record.user_id, itineraries=1)
+    return record, True
+
+
+# ============ 已有数据去重 ============
+def dedupe_itineraries(db: Session, batch_size: int = 1000) -> Dict[str, int]:
+    """计算旧记录的 content_hash 并删除重复的行程（每组保留最新的一条），返回各步骤处理的行数"""
+    db.execute(text(f"DROP TABLE IF EXISTS {STAGING_TABLE}"))
+    db.execute(text(
+        f"CREATE TABLE {STAGING_TABLE} ("
+        "id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, content_hash VARCHAR(64), "
+        "created_at TIMESTAMP, keep_id INTEGER)"
+    ))
+    db.execute(text(
+        f"CREATE INDEX ix_{STAGING_TABLE}_group ON {STAGING_TABLE} (user_id, content_hash, created_at, id)"
+    ))
+    db.execute(insert(staging).from_select(
+        ["id", "user_id", "content_hash", "created_at"],
+        select(Itinerary.id, Itinerary.user_id, Itinerary.content_hash, Itinerary.created_at)
+    ))
+    db.commit()
+    try:
+        hashed = _hash_missing(db, batch_size)
+        duplicates = _mark_duplicates(db)
+        deleted = _delete_duplicates(db, batch_size)
+        filled = _fill_content_hashes(db, batch_size)
+    finally:
+        db.rollback()
+        db.execute(text(f"DROP TABLE IF EXISTS {STAGING_TABLE}"))
+        db.commit()
+    purged = purge_orphaned_itinerary_blobs(db)
+    return {"hashed": hashed, "duplicates": duplicates, "deleted": deleted, "filled": filled, "purged_blobs": purged}
+
+
+def _hash_missing(db: Session, batch_size: int) -> int:
+    """按 ID 分批读取没有 content_hash 的记录，计算后写入临时表（同一份内容只解压解析一次）"""
+    content_digests: Dict[str, Dict[str, Any]] = {}
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(
+                Itinerary.id, Itinerary.destination, Itinerary.days, Itinerary.budget, Itinerary.travelers,
+                Itinerary.preferences, Itinerary.extra_requirements, Itinerary.itinerary_hash,
+                Itinerary.itinerary_data, ItineraryBlob.data, ItineraryBlob.compression,
+            )
+            .outerjoin(ItineraryBlob, ItineraryBlob.hash == Itinerary.itinerary_hash)
+            .where(Itinerary.id > last_id, Itinerary.content_hash.is_(None))
+            .order_by(Itinerary.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return count
+        params = []
+        for row in rows:
+            if row.data is not None:
+                content = content_digests.get(row.itinerary_hash)
+                if content is None:
+                    content = _parse_content(decompress(row.data, row.compression).decode("utf-8"))
+                    content_digests[row.itinerary_hash] = content
+            else:
+                content = _parse_content(row.itinerary_data)
+            params.append({"row_id": row.id, "row_hash": content_hash(itinerary_request_data(row), content)})
+        db.execute(text(f"UPDATE {STAGING_TABLE} SET content_hash = :row_hash WHERE id = :row_id"), params)
+        db.commit()
+        last_id = rows[-1].id
+        count += len(rows)
+        logger.info(f"🧮 [行程去重] 已计算 {count} 条记录的内容哈希")
+
+
+def _mark_duplicates(db: Session) -> int:
+    """每组相同 (user_id, content_hash) 的记录中最新的一条为保留记录，返回重复（将被删除）的记录数"""
+    keep = staging.alias("keep")
+    newest = select(keep.c.id).where(
+        keep.c.user_id == staging.c.user_id,
+        keep.c.content_hash == staging.c.content_hash
+    ).order_by(keep.c.created_at.desc(), keep.c.id.desc()).limit(1).scalar_subquery()
+    db.execute(update(staging).where(staging.c.content_hash.isnot(None)).values(keep_id=newest))
+    db.commit()
+    return db.execute(
+        select(func.count()).select_from(staging).where(staging.c.keep_id != staging.c.id)
+    ).scalar() or 0
+
+
+def _delete_duplicates(db: Session, batch_size: int) -> int:
+    """
+    分批删除重复记录：任务、分享链接改为指向保留的记录（已分享的链接继续有效），
+    收藏改为指向保留的记录（同一用户已收藏同组其他记录时删除多余的收藏），再删除派生数据和行程本身，
+    最后重新统计涉及用户的计数
+    """
+    count = 0
+    while True:
+        rows = db.execute(
+            select(staging.c.id, staging.c.user_id)
+            .where(staging.c.keep_id != staging.c.id)
+            .order_by(staging.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return count
+        ids = [row.id for row in rows]
+        for model in (Task, ShareLink):
+            _repoint(db, model, ids)
+
+        # 同一用户在同一组中已收藏保留的记录或有更早的收藏时，删除这条收藏，其余收藏改为指向保留的记录
+        other = aliased(Favorite)
+        own_group = staging.alias("own_group")
+        other_group = staging.alias("other_group")
+        redundant = db.execute(
+            select(Favorite.id)
+            .join(own_group, own_group.c.id == Favorite.itinerary_id)
+            .where(
+                Favorite.itinerary_id.in_(ids),
+                exists().where(
+                    other.user_id == Favorite.user_id,
+                    other.id != Favorite.id,
+                    other_group.c.id == other.itinerary_id,
+                    other_group.c.keep_id == own_group.c.keep_id,
+                    (other_group.c.id == other_group.c.keep_id) | (other.id < Favorite.id)
+                )
+            )
+        ).scalars().all()
+        if redundant:
+            db.execute(delete(Favorite).where(Favorite.id.in_(redundant)).execution_options(synchronize_session=False))
+        _repoint(db, Favorite, ids)
+
+        remove_itinerary_plans(db, ids)
+        remove_from_search_index(db, ids)
+        db.execute(delete(Itinerary).where(Itinerary.id.in_(ids)).execution_options(synchronize_session=False))
+        db.execute(delete(staging).where(staging.c.id.in_(ids)))
+        recount_user_counters(db, {row.user_id for row in rows})
+        db.commit()
+        count += len(ids)
+        logger.info(f"🗑️ [行程去重] 已删除 {count} 条重复记录")
+
+
+def _repoint(db: Session, model, ids: List[int]):
+    """把引用重复记录的行改为引用保留的记录"""
+    keep_id = select(staging.c.keep_id).where(staging.c.id == model.itinerary_id).scalar_subquery()
+    db.execute(
+        update(model).where(model.itinerary_id.in_(ids)).values(itinerary_id=keep_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _fill_content_hashes(db: Session, batch_size: int) -> int:
+    """把临时表中计算的 content_hash 分批写回保留的记录"""
+    count = 0
+    last_id = 0
+    while True:
+        ids: List[int] = db.execute(
+            select(staging.c.id)
+            .where(staging.c.id > last_id, staging.c.content_hash.isnot(None))
+            .order_by(staging.c.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return count
+        computed = select(staging.c.content_hash).where(staging.c.id == Itinerary.id).scalar_subquery()
+        count += db.execute(
+            update(Itinerary)
+            .where(Itinerary.id.in_(ids), Itinerary.content_hash.is_(None))
+            .values(content_hash=computed)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        last_id = ids[-1]
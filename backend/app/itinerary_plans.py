@@ -0,0 +1,175 @@
+"""
+行程内容的规范化存储
+保存、更新和重新生成行程时把每日计划和活动写入 daily_plans / activities 表（与行程在同一事务中），
+只需要部分内容的读取（每天的活动数和花费）和跨行程的统计（某个城市的热门地点）直接查询这两张表，
+不需要解析整份行程 JSON。活动的城市取行程的目的地
+
+列表页需要的摘要（活动总数、封面图、每日标题）在写入行程内容时提取到 itineraries 表的列上
+"""
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import delete, exists, insert
+from sqlalchemy.orm import Session, selectinload
+
+from .db_models import Itinerary, ItineraryActivity, ItineraryDay
+
+logger = logging.getLogger(__name__)
+
+
+def _text(value: Any, length: int) -> Optional[str]:
+    return value[:length] if isinstance(value, str) and value else None
+
+
+def _number(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+
+def _plans(content: Any):
+    plans = content.get("dailyPlans") if isinstance(content, dict) else None
+    return [plan for plan in plans or [] if isinstance(plan, dict)]
+
+
+def _activities(plan: Dict[str, Any]):
+    return [activity for activity in plan.get("activities") or [] if isinstance(activity, dict)]
+
+
+# ============ 摘要 ============
+def cover_image(content: Optional[Dict[str, Any]]) -> Optional[str]:
+    """第一张活动图片（优先小图），图片补全前为 None"""
+    for plan in _plans(content):
+        for activity in _activities(plan):
+            for image in activity.get("images") or []:
+                if isinstance(image, str) and image:
+                    return _text(image, 1000)
+                if isinstance(image, dict):
+                    variants = image.get("variants") if isinstance(image.get("variants"), dict) else {}
+                    url = _text(variants.get("small"), 1000) or _text(image.get("url"), 1000)
+                    if url:
+                        return url
+    return None
+
+
+def fill_itinerary_summary(itinerary: Itinerary, content: Optional[Dict[str, Any]]):
+    """按行程内容设置列表页的摘要列（只修改对象，由调用方保存）"""
+    plans = _plans(content)
+    itinerary.activity_count = sum(len(_activities(plan)) for plan in plans)
+    itinerary.cover_image = cover_image(content)
+    itinerary.day_titles = json.dumps(
+        [plan.get("title") if isinstance(plan.get("title"), str) else "" for plan in plans],
+        ensure_ascii=False
+    )
+
+
+def day_titles(itinerary) -> list:
+    """摘要中的每日标题（尚未提取时为空列表）"""
+    try:
+        titles = json.loads(itinerary.day_titles) if itinerary.day_titles else []
+    except (TypeError, ValueError):
+        return []
+    return titles if isinstance(titles, list) else []
+
+
+# ============ 每日计划和活动 ============
+def save_itinerary_plans(db: Session, itinerary: Itinerary, content: Optional[Dict[str, Any]] = None):
+    """
+    按行程内容重写该行程的每日计划和活动（行程需已 flush 得到 ID）
+    content 为行程数据，未提供时从行程记录读取；只写入当前事务，由调用方提交
+    """
+    if content is None:
+        try:
+            content = json.loads(itinerary.itinerary_json or "{}")
+        except (TypeError, ValueError):
+            content = {}
+    remove_itinerary_plans(db, [itinerary.id])
+
+    city = _text(itinerary.destination, 255)
+    days = []
+    activities = []
+    for index, plan in enumerate(_plans(content)):
+        day = plan.get("day") if isinstance(plan.get("day"), int) else index + 1
+        day_activities = _activities(plan)
+        days.append({
+            "itinerary_id": itinerary.id,
+            "day": day,
+            "title": _text(plan.get("title"), 255),
+            "activity_count": len(day_activities),
+            "total_cost": sum(_number(activity.get("cost")) for activity in day_activities),
+        })
+        activities.extend({
+            "itinerary_id": itinerary.id,
+            "day": day,
+            "position": position,
+            "time": _text(activity.get("time"), 32),
+            "title": _text(activity.get("title"), 255),
+            "address": _text(activity.get("address"), 500),
+            "city": city,
+            "duration": _text(activity.get("duration"), 64),
+            "cost": _number(activity.get("cost")),
+        } for position, activity in enumerate(day_activities))
+
+    if days:
+        db.execute(insert(ItineraryDay), days)
+    if activities:
+        db.execute(insert(ItineraryActivity), activities)
+
+
+def update_itinerary_city(db: Session, itinerary: Itinerary):
+    """行程目的地修改后同步活动的城市"""
+    db.query(ItineraryActivity).filter(ItineraryActivity.itinerary_id == itinerary.id).update(
+        {ItineraryActivity.city: _text(itinerary.destination, 255)}, synchronize_session=False
+    )
+
+
+def remove_itinerary_plans(db: Session, itinerary_ids: Iterable[int]):
+    """删除行程的每日计划和活动（只写入当前事务，由调用方提交）"""
+    ids = list(itinerary_ids)
+    if not ids:
+        return
+    db.execute(delete(ItineraryActivity).where(ItineraryActivity.itinerary_id.in_(ids)))
+    db.execute(delete(ItineraryDay).where(ItineraryDay.itinerary_id.in_(ids)))
+
+
+def backfill_itinerary_plans(db: Session, batch_size: int = 200) -> int:
+    """为还没有每日计划记录的行程分批补充（可重复执行），返回处理的行程数"""
+    count = 0
+    last_id = 0
+    while True:
+        itineraries = db.query(Itinerary).options(selectinload(Itinerary.blob)).filter(
+            Itinerary.id > last_id,
+            ~exists().where(ItineraryDay.itinerary_id == Itinerary.id)
+        ).order_by(Itinerary.id).limit(batch_size).all()
+        if not itineraries:
+            return count
+        for itinerary in itineraries:
+            save_itinerary_plans(db, itinerary)
+        last_id = itineraries[-1].id
+        count += len(itineraries)
+        db.commit()
+        db.expunge_all()
+        logger.info(f"📦 [每日计划] 已处理 {count} 个行程")
+
+
+def backfill_itinerary_summaries(db: Session, batch_size: int = 200) -> int:
+    """为还没有摘要的行程分批提取（可重复执行），返回处理的行程数"""
+    count = 0
+    last_id = 0
+    while True:
+        itineraries = db.query(Itinerary).options(selectinload(Itinerary.blob)).filter(
+            Itinerary.id > last_id,
+            Itinerary.activity_count.is_(None)
+        ).order_by(Itinerary.id).limit(batch_size).all()
+        if not itineraries:
+            return count
+        for itinerary in itineraries:
+            try:
+                content = json.loads(itinerary.itinerary_json or "{}")
+            except (TypeError, ValueError):
+                content = {}
+            fill_itinerary_summary(itinerary, content)
+        last_id = itineraries[-1].id
+        count += len(itineraries)
+        db.commit()
+        db.expunge_all()
+        logger.info(f"📦 [行程摘要] 已处理 {count} 个行程")
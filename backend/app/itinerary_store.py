@@ -0,0 +1,158 @@
+"""
+行程内容寻址存储
+行程 JSON 按 sha256 哈希压缩后只存一份（itinerary_blobs 表），Itinerary / Task / TemporaryShare 通过哈希引用，
+同一份结果只需序列化一次，多处引用也不会重复存储
+"""
+import hashlib
+import logging
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import exists
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .compression import compress, decompress, storage_codec
+from .db_models import ItineraryBlob, Itinerary, Task, TemporaryShare
+
+logger = logging.getLogger(__name__)
+
+
+def itinerary_hash(itinerary_json: str) -> str:
+    """计算行程 JSON 的内容哈希"""
+    return hashlib.sha256(itinerary_json.encode("utf-8")).hexdigest()
+
+
+def store_itinerary_json(db: Session, itinerary_json: str) -> ItineraryBlob:
+    """
+    保存行程 JSON 并返回对应的内容记录（已存在相同内容时直接复用）
+    只写入当前事务，由调用方提交
+    """
+    raw = itinerary_json.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()
+    blob = db.get(ItineraryBlob, digest)
+    if blob is not None:
+        return blob
+
+    data, codec = compress(raw)
+    values = {
+        "hash": digest,
+        "data": data,
+        "compression": codec,
+        "size": len(raw),
+    }
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        db.execute(sqlite_insert(ItineraryBlob).values(**values).on_conflict_do_nothing(index_elements=["hash"]))
+    elif dialect == "postgresql":
+        db.execute(postgresql_insert(ItineraryBlob).values(**values).on_conflict_do_nothing(index_elements=["hash"]))
+    else:
+        db.add(ItineraryBlob(**values))
+        db.flush()
+    return db.get(ItineraryBlob, digest)
+
+
+def _unreferenced(digest_column):
+    """内容未被任何行程、任务或临时分享引用"""
+    return (
+        ~exists().where(Itinerary.itinerary_hash == digest_column),
+        ~exists().where(Task.result_hash == digest_column),
+        ~exists().where(TemporaryShare.itinerary_hash == digest_column),
+    )
+
+
+def release_itinerary_json(db: Session, digest: Optional[str]) -> bool:
+    """
+    引用被替换或删除后调用：内容不再被引用时删除
+    单条带条件的 DELETE，避免先查后删之间被其他记录重新引用
+    """
+    return release_itinerary_blobs(db, [digest]) > 0
+
+
+def release_itinerary_blobs(db: Session, digests: Iterable[Optional[str]]) -> int:
+    """批量版本的 release_itinerary_json，返回删除数量"""
+    digests = {digest for digest in digests if digest}
+    if not digests:
+        return 0
+    db.flush()
+    return db.query(ItineraryBlob).filter(
+        ItineraryBlob.hash.in_(digests),
+        *_unreferenced(ItineraryBlob.hash)
+    ).delete(synchronize_session=False)
+
+
+def purge_orphaned_itinerary_blobs(db: Session, batch_size: int = 500) -> int:
+    """分批删除所有未被引用的内容，返回删除数量"""
+    total = 0
+    while True:
+        orphaned = [
+            digest for (digest,) in db.query(ItineraryBlob.hash)
+            .filter(*_unreferenced(ItineraryBlob.hash))
+            .limit(batch_size)
+            .all()
+        ]
+        if not orphaned:
+            return total
+        total += db.query(ItineraryBlob).filter(
+            ItineraryBlob.hash.in_(orphaned),
+            *_unreferenced(ItineraryBlob.hash)
+        ).delete(synchronize_session=False)
+        db.commit()
+
+
+def migrate_inline_itineraries(db: Session, batch_size: int = 200) -> Dict[str, int]:
+    """把旧数据中内联的行程 JSON 分批迁移到内容表，返回各表迁移的行数"""
+    targets = (
+        ("itineraries", Itinerary, "itinerary_data", "itinerary_hash"),
+        ("temporary_shares", TemporaryShare, "itinerary_data", "itinerary_hash"),
+        ("tasks", Task, "result_data", "result_hash"),
+    )
+    migrated = {}
+    for name, model, data_attr, hash_attr in targets:
+        data_column = getattr(model, data_attr)
+        hash_column = getattr(model, hash_attr)
+        count = 0
+        last_id = 0
+        while True:
+            rows = db.query(model.id, data_column).filter(
+                model.id > last_id,
+                hash_column.is_(None),
+                data_column.isnot(None),
+                data_column != ""
+            ).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row_id, itinerary_json in rows:
+                blob = store_itinerary_json(db, itinerary_json)
+                db.query(model).filter(model.id == row_id).update({
+                    hash_column: blob.hash,
+                    # Task.result_data 可为空，其余两张表的旧列不可为空
+                    data_column: None if model is Task else "",
+                }, synchronize_session=False)
+            last_id = rows[-1][0]
+            count += len(rows)
+            db.commit()
+            logger.info(f"📦 [行程存储] {name}: 已迁移 {count} 行")
+        migrated[name] = count
+    return migrated
+
+
+def recompress_itinerary_blobs(db: Session, codec: Optional[str] = None, batch_size: int = 200) -> int:
+    """把使用其他算法压缩的内容分批转换为指定算法（默认 STORAGE_COMPRESSION），返回转换的行数"""
+    codec = codec or storage_codec()
+    count = 0
+    last_hash = ""
+    while True:
+        blobs = db.query(ItineraryBlob).filter(
+            ItineraryBlob.hash > last_hash,
+            ItineraryBlob.compression != codec
+        ).order_by(ItineraryBlob.hash).limit(batch_size).all()
+        if not blobs:
+            return count
+        for blob in blobs:
+            blob.data, blob.compression = compress(decompress(blob.data, blob.compression), codec)
+        last_hash = blobs[-1].hash
+        count += len(blobs)
+        db.commit()
+        db.expunge_all()
+        logger.info(f"📦 [行程存储] itinerary_blobs: 已转换 {count} 行为 {codec}")
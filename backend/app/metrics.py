@@ -0,0 +1,68 @@
+"""
+进程内指标
+简单的计数器、数值指标和分布（最近的样本及分位数），线程安全，通过 /api/metrics 查看
+"""
+import threading
+from collections import deque
+from typing import Deque, Dict, List
+
+# 每个分布保留的最近样本数
+SUMMARY_MAX_SAMPLES = 1000
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_samples: Dict[str, Deque[float]] = {}
+
+
+def _key(name: str, labels: Dict[str, object]) -> str:
+    """指标名 + 标签，例如 retention_deleted_total{table="tasks"}"""
+    if not labels:
+        return name
+    label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{label_text}}}"
+
+
+def increment(name: str, value: float = 1, **labels):
+    """累加计数器"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    """设置数值指标（覆盖旧值）"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    """记录一个样本（例如耗时），快照中给出最近样本的分位数"""
+    key = _key(name, labels)
+    with _lock:
+        samples = _samples.get(key)
+        if samples is None:
+            samples = _samples[key] = deque(maxlen=SUMMARY_MAX_SAMPLES)
+        samples.append(value)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩法分位数（sorted_values 已排序且非空）"""
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """当前所有指标的快照"""
+    with _lock:
+        samples = {key: sorted(values) for key, values in _samples.items()}
+        result = {"counters": dict(_counters), "gauges": dict(_gauges)}
+    result["summaries"] = {
+        key: {
+            "count": len(values),
+            **{f"p{p}": round(percentile(values, p), 3) for p in SUMMARY_PERCENTILES},
+        }
+        for key, values in samples.items() if values
+    }
+    return result
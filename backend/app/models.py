@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator
+from typing import List, Optional, Dict
 
 
 class TravelRequest(BaseModel):
@@ -19,6 +19,13 @@ class BudgetItem(BaseModel):
     amount: float
 
 
+class ActivityImage(BaseModel):
+    """活动图片（默认URL + 多尺寸版本，用于前端 srcset 和 PDF 小图）"""
+    url: str
+    source: str = ""
+    variants: Dict[str, str] = Field(default_factory=dict, description="尺寸名(small/medium/large) -> URL")
+
+
 class Activity(BaseModel):
     """活动项目"""
     time: str
@@ -28,7 +35,15 @@ class Activity(BaseModel):
     cost: float
     address: str
     reason: str
-    images: Optional[List[str]] = []
+    images: Optional[List[ActivityImage]] = []
+
+    @field_validator("images", mode="before")
+    @classmethod
+    def _coerce_images(cls, value):
+        """兼容旧数据：纯字符串URL转换为图片对象"""
+        if not value:
+            return []
+        return [{"url": img} if isinstance(img, str) else img for img in value]
 
 
 class DailyPlan(BaseModel):
@@ -19,6 +19,8 @@ import tempfile
 from typing import Dict, Any, List, Optional
 from urllib.parse import quote
 
+from app.image_search import image_url
+
 logger = logging.getLogger(__name__)
 
 # 中文字体配置
@@ -280,7 +282,9 @@ def generate_pdf(itinerary_data: Dict[str, Any], destination: str, days: int) ->
                         images = activity.get('images', [])
                         if images:
                             image_row = []
-                            for img_url in images[:2]:  # 最多显示2张图片
+                            for image in images[:2]:  # 最多显示2张图片
+                                # PDF 中图片只有半页宽，使用小尺寸版本以减少下载量
+                                img_url = image_url(image, size="small")
                                 img_data = download_image(img_url)
                                 if img_data:
                                     try:
@@ -0,0 +1,185 @@
+"""
+数据保留策略
+后台定期清理过期数据，避免表无限增长：
+- 已完成 / 失败 / 已取消的任务：超过保留天数后删除（可选先归档为 gzip 压缩的 JSON Lines）
+- 过期的临时分享
+- 过期的邮箱验证码
+- 不再被引用的行程内容
+
+每批删除少量行并立即提交，批次之间稍作停顿，避免长时间占用 SQLite 写锁。
+清理数量记录在进程内指标中（/api/metrics）。
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .database import SessionLocal, settings
+from .db_models import EmailVerification, Task, TemporaryShare
+from .itinerary_store import purge_orphaned_itinerary_blobs, release_itinerary_blobs
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """定期执行数据保留策略的后台任务"""
+
+    def __init__(
+        self,
+        interval_seconds: int = settings.RETENTION_INTERVAL_SECONDS,
+        batch_size: int = settings.RETENTION_BATCH_SIZE,
+        batch_pause_seconds: float = settings.RETENTION_BATCH_PAUSE_SECONDS,
+        completed_task_days: int = settings.RETENTION_COMPLETED_TASK_DAYS,
+        failed_task_days: int = settings.RETENTION_FAILED_TASK_DAYS,
+        temporary_share_grace_days: int = settings.RETENTION_TEMPORARY_SHARE_GRACE_DAYS,
+        archive_dir: str = settings.RETENTION_ARCHIVE_DIR,
+    ):
+        self.interval_seconds = interval_seconds
+        self.batch_size = max(1, batch_size)
+        self.batch_pause_seconds = batch_pause_seconds
+        self.completed_task_days = completed_task_days
+        self.failed_task_days = failed_task_days
+        self.temporary_share_grace_days = temporary_share_grace_days
+        self.archive_dir = archive_dir
+        self._loop_task: Optional[asyncio.Task] = None
+
+    # ============ 生命周期 ============
+
+    async def start(self):
+        self._loop_task = asyncio.create_task(self._run_loop())
+        logger.info(f"🧹 [数据保留] 已启动，每 {self.interval_seconds} 秒清理一次")
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+    async def _run_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                metrics.increment("retention_errors_total")
+                logger.error(f"❌ [数据保留] 清理失败: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    # ============ 清理 ============
+
+    def run_once(self) -> Dict[str, int]:
+        """执行一轮清理，返回各类数据的删除数量"""
+        started = time.monotonic()
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            deleted = {
+                "completed_tasks": self._purge_tasks(db, "completed", self.completed_task_days, now),
+                "failed_tasks": self._purge_tasks(db, "failed", self.failed_task_days, now),
+                "cancelled_tasks": self._purge_tasks(db, "cancelled", self.failed_task_days, now),
+                "temporary_shares": self._purge_temporary_shares(db, now),
+                "verification_codes": self._delete_in_batches(
+                    db, EmailVerification, EmailVerification.expires_at < now
+                ),
+                "itinerary_blobs": purge_orphaned_itinerary_blobs(db, self.batch_size),
+            }
+        finally:
+            db.close()
+
+        for name, count in deleted.items():
+            metrics.increment("retention_deleted_total", count, kind=name)
+        metrics.increment("retention_runs_total")
+        metrics.set_gauge("retention_last_run_timestamp", time.time())
+        metrics.set_gauge("retention_last_run_seconds", round(time.monotonic() - started, 3))
+        if any(deleted.values()):
+            logger.info(f"🧹 [数据保留] 清理完成: {deleted}")
+        return deleted
+
+    def _purge_tasks(self, db: Session, task_status: str, days: int, now: datetime) -> int:
+        if days <= 0:
+            return 0
+        criteria = (
+            Task.status == task_status,
+            Task.created_at < now - timedelta(days=days),
+            # 图片补全仍在进行的任务不清理
+            or_(Task.image_status.is_(None), Task.image_status.in_(("completed", "failed", "cancelled"))),
+        )
+        return self._delete_in_batches(db, Task, *criteria, before_delete=self._before_delete_tasks)
+
+    def _purge_temporary_shares(self, db: Session, now: datetime) -> int:
+        cutoff = now - timedelta(days=max(0, self.temporary_share_grace_days))
+        return self._delete_in_batches(
+            db, TemporaryShare, TemporaryShare.expires_at < cutoff,
+            before_delete=lambda db, rows: self._collect_hashes(rows, "itinerary_hash")
+        )
+
+    def _before_delete_tasks(self, db: Session, rows: List[Task]) -> List[str]:
+        if self.archive_dir:
+            self._archive_tasks(rows)
+        return self._collect_hashes(rows, "result_hash")
+
+    @staticmethod
+    def _collect_hashes(rows, attr: str) -> List[str]:
+        return [getattr(row, attr) for row in rows if getattr(row, attr)]
+
+    def _delete_in_batches(
+        self,
+        db: Session,
+        model,
+        *criteria,
+        before_delete: Optional[Callable[[Session, list], List[str]]] = None
+    ) -> int:
+        """
+        按主键分批删除满足条件的行，每批单独提交
+        before_delete 可做归档，并返回这批行引用的行程内容哈希（删除后释放不再被引用的内容）
+        """
+        total = 0
+        while True:
+            if before_delete:
+                rows = db.query(model).filter(*criteria).order_by(model.id).limit(self.batch_size).all()
+                ids = [row.id for row in rows]
+            else:
+                rows = []
+                ids = [row_id for (row_id,) in db.query(model.id).filter(*criteria).order_by(model.id).limit(self.batch_size).all()]
+            if not ids:
+                return total
+
+            hashes = before_delete(db, rows) if before_delete else []
+            total += db.query(model).filter(model.id.in_(ids), *criteria).delete(synchronize_session=False)
+            release_itinerary_blobs(db, hashes)
+            db.commit()
+            db.expunge_all()
+
+            if len(ids) < self.batch_size:
+                return total
+            if self.batch_pause_seconds > 0:
+                time.sleep(self.batch_pause_seconds)
+
+    def _archive_tasks(self, tasks: List[Task]):
+        """把即将删除的任务追加到当天的归档文件（每批一个 gzip 成员，可直接用 zcat 读取）"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"tasks-{datetime.utcnow():%Y-%m-%d}.jsonl.gz")
+        lines = []
+        for task in tasks:
+            lines.append(json.dumps({
+                "task_id": task.task_id,
+                "user_id": task.user_id,
+                "status": task.status,
+                "request": task.request_data,
+                "result": task.result_json,
+                "error_message": task.error_message,
+                "itinerary_id": task.itinerary_id,
+                "attempts": task.attempts,
+                "created_at": str(task.created_at),
+                "completed_at": str(task.completed_at) if task.completed_at else None,
+            }, ensure_ascii=False))
+        with gzip.open(path, "at", encoding="utf-8") as archive:
+            archive.write("\n".join(lines) + "\n")
+        metrics.increment("retention_archived_total", len(tasks), kind="tasks")
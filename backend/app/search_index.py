@@ -0,0 +1,260 @@
+"""
+行程全文检索索引
+从行程中提取目的地、行程名称以及每日标题、活动标题和地址、隐藏宝石标题，写入索引表 itinerary_search：
+SQLite 使用 FTS5 虚拟表（rowid 为行程 ID），PostgreSQL 使用 tsvector 列 + GIN 索引，其他数据库不建索引（历史搜索退回 LIKE）。
+
+中文没有空格分词，写入和查询前都先把连续的中日韩字符切分为单字和相邻两字（bigram），其余文字按单词转小写，
+再用空格连接交给 FTS5 的 unicode61 分词器 / 直接作为 tsvector 的词位，不依赖数据库的分词扩展和 locale。
+
+行程新增、修改和删除时由会话的 after_flush 事件在同一事务中更新索引；
+不经过 ORM 的批量删除需要调用 remove_from_search_index
+"""
+import json
+import logging
+import re
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import Float, Integer, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, selectinload
+
+from .database import SessionLocal, engine, settings
+from .db_models import Itinerary
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = "itinerary_search"
+BACKEND_FTS5 = "fts5"
+BACKEND_TSVECTOR = "tsvector"
+
+# FTS5 bm25 的列权重：目的地和行程名称命中的排在只有活动内容命中的前面
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+# 影响索引内容的字段（blob 为行程内容的引用）
+INDEXED_ATTRIBUTES = ("user_id", "destination", "agent_name", "itinerary_data", "itinerary_hash", "blob")
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"  # 日文假名、中日韩汉字、韩文
+_WORD_PATTERN = re.compile(rf"[{_CJK}]+|[^\W_{_CJK}]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK}]")
+
+# 当前进程中可用的索引实现，由 ensure_search_index 检查后设置（未设置时不维护索引）
+_backend: Optional[str] = None
+
+
+# ============ 分词 ============
+def tokenize(content: str) -> List[str]:
+    """索引用的词：中日韩字符切分为单字和相邻两字，其余按单词（小写）"""
+    tokens = []
+    for word in _WORD_PATTERN.findall(content.lower()):
+        if _CJK_PATTERN.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def query_terms(query: str) -> List[Tuple[str, bool]]:
+    """查询用的词和是否按前缀匹配：中日韩字符取相邻两字（只有一个字时为单字），其余单词按前缀匹配"""
+    terms = []
+    for word in _WORD_PATTERN.findall(query.lower()):
+        if not _CJK_PATTERN.match(word):
+            terms.append((word, True))
+        elif len(word) == 1:
+            terms.append((word, False))
+        else:
+            terms.extend((word[i:i + 2], False) for i in range(len(word) - 1))
+    return list(dict.fromkeys(terms))
+
+
+# ============ 索引内容 ============
+def search_fields(destination: Optional[str], agent_name: Optional[str], itinerary_json: Optional[str]) -> Tuple[str, str]:
+    """索引的两部分内容：名称（目的地、行程名称）和行程内容（每日标题、活动标题和地址、隐藏宝石标题）"""
+    title = " ".join(value for value in (destination, agent_name) if value)
+    try:
+        data = json.loads(itinerary_json or "{}")
+    except (TypeError, ValueError):
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    parts = []
+    for plan in data.get("dailyPlans") or []:
+        if not isinstance(plan, dict):
+            continue
+        parts.append(plan.get("title"))
+        for activity in plan.get("activities") or []:
+            if isinstance(activity, dict):
+                parts.extend((activity.get("title"), activity.get("address")))
+    for gem in data.get("hiddenGems") or []:
+        if isinstance(gem, dict):
+            parts.append(gem.get("title"))
+    body = " ".join(part for part in parts if isinstance(part, str) and part)
+    return title, body
+
+
+def index_itineraries(db: Session, itineraries: Iterable[Itinerary]):
+    """写入（覆盖）行程的索引内容"""
+    rows = []
+    for itinerary in itineraries:
+        title, body = search_fields(itinerary.destination, itinerary.agent_name, itinerary.itinerary_json)
+        rows.append({
+            "itinerary_id": itinerary.id,
+            "user_id": itinerary.user_id,
+            "title": " ".join(tokenize(title)),
+            "body": " ".join(tokenize(body)),
+        })
+    if not rows:
+        return
+    if _backend == BACKEND_FTS5:
+        remove_from_search_index(db, [row["itinerary_id"] for row in rows])
+        db.execute(text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, body, user_id) VALUES (:itinerary_id, :title, :body, :user_id)"
+        ), rows)
+    elif _backend == BACKEND_TSVECTOR:
+        # 词位已经切分好，直接转换为 tsvector（不经过数据库的分词器）
+        for row in rows:
+            row["title"] = _tsvector_literal(row["title"].split())
+            row["body"] = _tsvector_literal(row["body"].split())
+        db.execute(text(
+            f"INSERT INTO {SEARCH_TABLE} (itinerary_id, user_id, document) "
+            "VALUES (:itinerary_id, :user_id, "
+            "setweight(CAST(:title AS tsvector), 'A') || setweight(CAST(:body AS tsvector), 'B')) "
+            "ON CONFLICT (itinerary_id) DO UPDATE SET user_id = EXCLUDED.user_id, document = EXCLUDED.document"
+        ), rows)
+
+
+def _tsvector_literal(tokens: Iterable[str]) -> str:
+    # 分词结果只含字母和数字，不需要转义
+    return " ".join(f"'{token}'" for token in dict.fromkeys(tokens))
+
+
+def remove_from_search_index(db: Session, itinerary_ids: Iterable[int]):
+    """删除行程的索引内容（只写入当前事务，由调用方提交）"""
+    ids = [int(itinerary_id) for itinerary_id in itinerary_ids]
+    if _backend is None or not ids:
+        return
+    key = "rowid" if _backend == BACKEND_FTS5 else "itinerary_id"
+    db.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE {key} = :itinerary_id"), [{"itinerary_id": i} for i in ids])
+
+
+def _needs_reindex(itinerary: Itinerary) -> bool:
+    state = inspect(itinerary)
+    return any(state.attrs[name].history.has_changes() for name in INDEXED_ATTRIBUTES)
+
+
+@event.listens_for(Session, "after_flush")
+def _sync_search_index(session: Session, flush_context):
+    """在写入行程的同一事务中更新索引"""
+    if _backend is None:
+        return
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Itinerary)]
+    changed = [obj for obj in session.new if isinstance(obj, Itinerary)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Itinerary) and _needs_reindex(obj)]
+    remove_from_search_index(session, deleted)
+    index_itineraries(session, changed)
+
+
+# ============ 建表和重建 ============
+def ensure_search_index(bind=None) -> Optional[str]:
+    """
+    创建索引表（已存在时跳过）并启用当前进程的索引维护，返回使用的实现；
+    索引表是新建的时候为已有行程建立索引
+    """
+    global _backend
+    bind = bind or engine
+    if not settings.SEARCH_INDEX_ENABLED:
+        _backend = None
+        return None
+
+    dialect = bind.dialect.name
+    try:
+        with bind.begin() as conn:
+            created = not inspect(conn).has_table(SEARCH_TABLE)
+            if dialect == "sqlite":
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                    "USING fts5(title, body, user_id UNINDEXED, tokenize='unicode61')"
+                ))
+                backend = BACKEND_FTS5
+            elif dialect == "postgresql":
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+                    "itinerary_id INTEGER PRIMARY KEY REFERENCES itineraries(id) ON DELETE CASCADE, "
+                    "user_id INTEGER NOT NULL, "
+                    "document TSVECTOR NOT NULL)"
+                ))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_user ON {SEARCH_TABLE} (user_id)"))
+                backend = BACKEND_TSVECTOR
+            else:
+                logger.info(f"ℹ️ [全文检索] {dialect} 不支持全文索引，历史搜索使用 LIKE")
+                _backend = None
+                return None
+    except OperationalError as e:
+        # SQLite 编译时未启用 FTS5
+        logger.warning(f"⚠️ [全文检索] 无法创建索引表，历史搜索使用 LIKE: {e}")
+        _backend = None
+        return None
+
+    _backend = backend
+    if created:
+        db = SessionLocal()
+        try:
+            count = rebuild_search_index(db)
+            logger.info(f"🔎 [全文检索] 已为 {count} 个行程建立索引")
+        finally:
+            db.close()
+    return backend
+
+
+def rebuild_search_index(db: Session, batch_size: int = 200) -> int:
+    """按 ID 分批为所有行程重建索引（可重复执行），返回行程数"""
+    if _backend is None:
+        return 0
+    count = 0
+    last_id = 0
+    while True:
+        itineraries = db.query(Itinerary).options(selectinload(Itinerary.blob)).filter(
+            Itinerary.id > last_id
+        ).order_by(Itinerary.id).limit(batch_size).all()
+        if not itineraries:
+            return count
+        index_itineraries(db, itineraries)
+        last_id = itineraries[-1].id
+        count += len(itineraries)
+        db.commit()
+        db.expunge_all()
+
+
+# ============ 查询 ============
+def search_backend() -> Optional[str]:
+    """当前进程可用的索引实现（None 表示不可用）"""
+    return _backend
+
+
+def match_subquery(user_id: int, query: str):
+    """
+    用户的行程中匹配关键词的 ID 和相关度（itinerary_id, score，score 越大越相关）
+    索引不可用或关键词中没有可检索的词时返回 None
+    """
+    terms = query_terms(query)
+    if _backend is None or not terms:
+        return None
+    if _backend == BACKEND_FTS5:
+        # 词用双引号括起，避免被当作 FTS5 的运算符；多个词之间为 AND
+        match = " ".join(f'"{term}"' + ("*" if prefix else "") for term, prefix in terms)
+        statement = text(
+            f"SELECT rowid AS itinerary_id, -bm25({SEARCH_TABLE}, {TITLE_WEIGHT}, {BODY_WEIGHT}) AS score "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match AND user_id = :user_id"
+        )
+    else:
+        match = " & ".join(f"'{term}'" + (":*" if prefix else "") for term, prefix in terms)
+        statement = text(
+            "SELECT itinerary_id, ts_rank(document, CAST(:match AS tsquery)) AS score "
+            f"FROM {SEARCH_TABLE} WHERE document @@ CAST(:match AS tsquery) AND user_id = :user_id"
+        )
+    return statement.bindparams(match=match, user_id=user_id).columns(
+        itinerary_id=Integer, score=Float
+    ).subquery("search_matches")
@@ -0,0 +1,233 @@
+"""
+分享令牌解析
+永久分享（share_links + itineraries）和临时分享（temporary_shares）在一条 UNION ALL 查询中按 share_token 的唯一索引解析，
+连同行程内容一起返回，一次往返即可得到分享页所需的全部数据。
+
+解析结果缓存在进程内（带 TTL 的 LRU），热门分享链接不再每次访问都查询数据库和解析 JSON。
+修改分享设置、编辑 / 重新生成 / 删除行程时由调用方使相关缓存失效；
+其他进程（如独立 worker）中的修改在 TTL 后生效
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import literal, null, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .compression import decompress
+from .database import settings
+from .db_models import Itinerary, ItineraryBlob, ShareLink, TemporaryShare
+from .timings import seconds_since
+
+KIND_LINK = "link"
+KIND_TEMPORARY = "temporary"
+
+
+class ResolvedShare:
+    """分享令牌对应的行程（永久分享或临时分享）"""
+
+    def __init__(
+        self,
+        share_token: str,
+        kind: str,
+        is_public: bool,
+        expires_at: Optional[datetime],
+        itinerary_id: Optional[int],
+        destination: Optional[str],
+        days: Optional[int],
+        created_at: Optional[datetime],
+        itinerary_data: Optional[Dict[str, Any]],
+    ):
+        self.share_token = share_token
+        self.kind = kind
+        self.is_public = is_public
+        self.expires_at = expires_at
+        self.itinerary_id = itinerary_id
+        self.destination = destination
+        self.days = days
+        self.created_at = created_at
+        self.itinerary_data = itinerary_data  # 永久分享的行程已被删除时为 None
+
+    @property
+    def is_temporary(self) -> bool:
+        return self.kind == KIND_TEMPORARY
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and seconds_since(self.expires_at) > 0
+
+    def to_response(self) -> Dict[str, Any]:
+        """分享页的响应内容"""
+        return {
+            "id": self.itinerary_id,
+            "destination": self.destination,
+            "days": self.days,
+            "created_at": str(self.created_at),
+            "itinerary_data": self.itinerary_data,
+            "share_info": {
+                "is_public": self.is_public,
+                "expires_at": str(self.expires_at) if self.expires_at else None,
+                "is_temporary": self.is_temporary
+            }
+        }
+
+
+class ShareCache:
+    """分享解析结果的进程内缓存（TTL + LRU，同时缓存不存在的令牌）"""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Optional[ResolvedShare]]]" = OrderedDict()
+        self._tokens_by_itinerary: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, share_token: str) -> Tuple[bool, Optional[ResolvedShare]]:
+        """返回 (是否命中, 解析结果)"""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(share_token)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._discard(share_token)
+                return False, None
+            self._entries.move_to_end(share_token)
+            return True, entry[1]
+
+    def put(self, share_token: str, share: Optional[ResolvedShare]):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._discard(share_token)
+            self._entries[share_token] = (time.monotonic() + self.ttl_seconds, share)
+            if share is not None and share.itinerary_id is not None:
+                self._tokens_by_itinerary.setdefault(share.itinerary_id, set()).add(share_token)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, share_token: str):
+        """分享设置修改或新建令牌后调用"""
+        with self._lock:
+            self._discard(share_token)
+
+    def invalidate_itinerary(self, itinerary_id: int):
+        """行程内容或基本信息修改、行程删除后调用"""
+        with self._lock:
+            for share_token in list(self._tokens_by_itinerary.get(itinerary_id, ())):
+                self._discard(share_token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_itinerary.clear()
+
+    def _discard(self, share_token: str):
+        entry = self._entries.pop(share_token, None)
+        if entry is None or entry[1] is None or entry[1].itinerary_id is None:
+            return
+        tokens = self._tokens_by_itinerary.get(entry[1].itinerary_id)
+        if tokens is not None:
+            tokens.discard(share_token)
+            if not tokens:
+                del self._tokens_by_itinerary[entry[1].itinerary_id]
+
+
+share_cache = ShareCache(settings.SHARE_CACHE_TTL_SECONDS, settings.SHARE_CACHE_MAX_ENTRIES)
+
+
+def _lookup_statement(share_token: str):
+    """按令牌同时查找永久分享和临时分享（两边都使用 share_token 的唯一索引），连同行程内容一起返回"""
+    links = select(
+        literal(KIND_LINK).label("kind"),
+        ShareLink.is_public.label("is_public"),
+        ShareLink.expires_at.label("expires_at"),
+        Itinerary.id.label("itinerary_id"),
+        Itinerary.destination.label("destination"),
+        Itinerary.days.label("days"),
+        Itinerary.created_at.label("created_at"),
+        Itinerary.itinerary_data.label("itinerary_data"),
+        ItineraryBlob.data.label("blob_data"),
+        ItineraryBlob.compression.label("blob_compression"),
+    ).select_from(ShareLink).outerjoin(
+        Itinerary, Itinerary.id == ShareLink.itinerary_id
+    ).outerjoin(
+        ItineraryBlob, ItineraryBlob.hash == Itinerary.itinerary_hash
+    ).where(ShareLink.share_token == share_token)
+
+    temporary = select(
+        literal(KIND_TEMPORARY),
+        literal(1),
+        TemporaryShare.expires_at,
+        null(),
+        null(),
+        null(),
+        TemporaryShare.created_at,
+        TemporaryShare.itinerary_data,
+        ItineraryBlob.data,
+        ItineraryBlob.compression,
+    ).select_from(TemporaryShare).outerjoin(
+        ItineraryBlob, ItineraryBlob.hash == TemporaryShare.itinerary_hash
+    ).where(TemporaryShare.share_token == share_token)
+
+    return union_all(links, temporary)
+
+
+def _resolved(share_token: str, row) -> Optional[ResolvedShare]:
+    if row is None:
+        return None
+    if row.blob_data is not None:
+        itinerary_json = decompress(row.blob_data, row.blob_compression).decode("utf-8")
+    else:
+        itinerary_json = row.itinerary_data
+    itinerary_data = json.loads(itinerary_json) if itinerary_json else None
+
+    if row.kind == KIND_TEMPORARY:
+        # 临时分享没有行程记录：目的地可能在行程数据顶层（前端传递时），天数按 dailyPlans 推断
+        itinerary_data = itinerary_data or {}
+        return ResolvedShare(
+            share_token, row.kind, True, row.expires_at, None,
+            itinerary_data.get("destination") or "未知目的地",
+            len(itinerary_data.get("dailyPlans", [])) or 1,
+            row.created_at, itinerary_data,
+        )
+    return ResolvedShare(
+        share_token, row.kind, row.is_public == 1, row.expires_at, row.itinerary_id,
+        row.destination, row.days, row.created_at,
+        itinerary_data if row.itinerary_id is not None else None,
+    )
+
+
+def _cached(share_token: str) -> Tuple[bool, Optional[ResolvedShare]]:
+    hit, share = share_cache.get(share_token)
+    metrics.increment("share_cache_total", result="hit" if hit else "miss")
+    return hit, share
+
+
+def resolve_share(db: Session, share_token: str) -> Optional[ResolvedShare]:
+    """解析分享令牌，不存在时返回 None（过期与否由调用方根据 expired 判断）"""
+    hit, share = _cached(share_token)
+    if hit:
+        return share
+    share = _resolved(share_token, db.execute(_lookup_statement(share_token)).first())
+    share_cache.put(share_token, share)
+    return share
+
+
+async def resolve_share_async(db: AsyncSession, share_token: str) -> Optional[ResolvedShare]:
+    """resolve_share 的异步版本"""
+    hit, share = _cached(share_token)
+    if hit:
+        return share
+    share = _resolved(share_token, (await db.execute(_lookup_statement(share_token))).first())
+    share_cache.put(share_token, share)
+    return share
@@ -0,0 +1,147 @@
+"""
+任务事件通知中心
+后台任务处理过程中发布状态变化、进度和结果，SSE 等订阅方实时接收，避免客户端反复轮询数据库
+
+任务在其他进程中处理时（独立部署的 worker，或多个 API 进程各自内嵌的 worker）进程内收不到事件，
+由 TaskVersionWatcher 定期批量检查被订阅任务的版本号，
+发现变化时发布 changed 事件，订阅方收到后重新读取任务状态
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from .database import SessionLocal, settings
+from .db_models import Task
+
+logger = logging.getLogger(__name__)
+
+# 事件类型
+EVENT_STATUS = "status"      # 状态变化（pending / processing / failed ...）
+EVENT_RESULT = "result"      # 文字行程完成，附带完整结果（只推送一次）
+EVENT_PROGRESS = "progress"  # 图片补全进度（只包含计数）
+EVENT_IMAGES = "images"      # 图片补全完成，附带带图片的最终结果
+EVENT_CHANGED = "changed"    # 任务在其他进程中发生了变化（只含版本号，订阅方需重新读取）
+
+# 订阅队列上限：消费过慢时丢弃最旧的事件，避免内存无限增长
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """格式化为 Server-Sent Events 报文"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class TaskEventHub:
+    """进程内的任务事件发布/订阅中心（只在事件循环线程中使用）"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        # 订阅方已读取到的最小版本号，版本监视器据此判断是否有新变化
+        self._known_versions: Dict[str, int] = {}
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.setdefault(task_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(task_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[task_id]
+            self._known_versions.pop(task_id, None)
+
+    def subscribed_task_ids(self) -> List[str]:
+        return list(self._subscribers)
+
+    def note_version(self, task_id: str, version: int):
+        """订阅方读取任务状态后登记已知版本（多个订阅方取最小值）"""
+        if task_id not in self._subscribers:
+            return
+        known = self._known_versions.get(task_id)
+        self._known_versions[task_id] = version if known is None else min(known, version)
+
+    def observe_version(self, task_id: str, version: int) -> bool:
+        """记录从数据库读到的版本，比已知版本新时返回 True（首次读到时只记录）"""
+        if task_id not in self._subscribers:
+            return False
+        known = self._known_versions.get(task_id)
+        if known is not None and version <= known:
+            return False
+        self._known_versions[task_id] = version
+        return known is not None
+
+    def publish(self, task_id: str, event: str, data: Dict[str, Any]):
+        """
+        发布事件；没有订阅者时几乎没有开销
+        事件带版本号时所有订阅方都会收到，登记为已知版本，版本监视器不再重复发布 changed
+        """
+        version = data.get("version")
+        if version is not None and task_id in self._subscribers:
+            known = self._known_versions.get(task_id)
+            self._known_versions[task_id] = version if known is None else max(known, version)
+        for queue in list(self._subscribers.get(task_id, ())):
+            if queue.full():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait((event, data))
+
+
+task_events = TaskEventHub()
+
+
+class TaskVersionWatcher:
+    """
+    跨进程的任务变化通知（在每个 API 进程中运行）
+    只在有订阅者时查询，每个周期一条批量 SQL，与订阅的客户端数量无关
+    """
+
+    def __init__(self, hub: TaskEventHub, interval_seconds: float = settings.TASK_EVENT_POLL_SECONDS):
+        self.hub = hub
+        self.interval_seconds = interval_seconds
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._loop_task = asyncio.create_task(self._run_loop())
+        logger.info(f"👀 [任务事件] 版本监视器已启动，间隔 {self.interval_seconds} 秒")
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+    async def _run_loop(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            task_ids = self.hub.subscribed_task_ids()
+            if not task_ids:
+                continue
+            try:
+                versions = await asyncio.to_thread(self._load_versions, task_ids)
+            except Exception as e:
+                logger.error(f"❌ [任务事件] 查询任务版本失败: {e}")
+                continue
+            for task_id, version in versions:
+                if self.hub.observe_version(task_id, version or 0):
+                    self.hub.publish(task_id, EVENT_CHANGED, {"task_id": task_id, "version": version or 0})
+
+    @staticmethod
+    def _load_versions(task_ids: List[str]):
+        db = SessionLocal()
+        try:
+            rows = []
+            for start in range(0, len(task_ids), 500):
+                chunk = task_ids[start:start + 500]
+                rows.extend(db.query(Task.task_id, Task.version).filter(Task.task_id.in_(chunk)).all())
+            return rows
+        finally:
+            db.close()
+
+
+task_version_watcher = TaskVersionWatcher(task_events)
@@ -0,0 +1,429 @@
+"""
+生成任务处理流程
+任务队列各阶段的处理函数（生成文字行程、补全图片），以及任务状态的对外结构。
+API 进程（内嵌 worker 模式）和独立的 worker 进程（worker.py）共用。
+"""
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .agent import TravelPlanningAgent
+from .database import SessionLocal
+from .db_models import Itinerary, ItineraryBlob, Task
+from .itinerary_store import store_itinerary_json, release_itinerary_json
+from .itinerary_plans import cover_image, fill_itinerary_summary, save_itinerary_plans
+from .itinerary_dedupe import refresh_content_hash, save_itinerary_record
+from .share_resolver import share_cache
+from .models import TravelRequest, TravelItinerary
+from .task_events import (
+    task_events,
+    EVENT_STATUS,
+    EVENT_RESULT,
+    EVENT_PROGRESS,
+    EVENT_IMAGES
+)
+from .task_queue import TaskQueue, TaskCancelledError, STAGE_GENERATE, STAGE_IMAGES, queue_position
+from .eta import eta_estimator
+from . import timings as stage_timings
+
+logger = logging.getLogger(__name__)
+
+# Initialize agent
+travel_agent = TravelPlanningAgent()
+
+
+# ============ 任务状态 ============
+class TaskStatusResponse(BaseModel):
+    task_id: str
+    status: str  # pending, processing, completed, failed, cancelled
+    result: Optional[dict] = None  # 完成后的结果数据
+    error_message: Optional[str] = None  # 失败时的错误信息
+    created_at: str
+    updated_at: str
+    completed_at: Optional[str] = None
+    itinerary_id: Optional[int] = None  # 登录用户保存的行程ID
+    image_status: Optional[str] = None  # pending, processing, completed, failed, cancelled
+    image_progress: int = 0  # 已补全图片的活动数
+    image_total: int = 0  # 需要补全图片的活动总数
+    version: int = 0  # 状态版本号，长轮询时作为 since 参数传回
+    queue_position: Optional[int] = None  # 排队中任务的大致位置（1 表示下一个执行）
+    timings: Optional[Dict[str, float]] = None  # 各阶段耗时（毫秒），查询时传 timings=true 才返回
+    # 预计完成时间（UTC）：排队中/生成中为文字行程，图片补全中为图片全部完成；任务结束后为空
+    estimated_completion_at: Optional[str] = None
+    estimated_seconds: Optional[int] = None  # 距预计完成的秒数，客户端可据此安排下次查询的时间
+
+
+def build_task_status_response(
+    task: Task,
+    position: Optional[int] = None,
+    include_timings: bool = False,
+    remaining_seconds: Optional[float] = None
+) -> TaskStatusResponse:
+    """
+    把 Task 记录转换为接口返回的状态结构
+    position 为排队位置（只对 pending 任务有意义），remaining_seconds 为预计剩余时间（见 app.eta）
+    """
+    result_data = None
+    result_json = task.result_json
+    if result_json:
+        try:
+            result_data = json.loads(result_json)
+        except:
+            result_data = None
+    
+    return TaskStatusResponse(
+        task_id=task.task_id,
+        status=task.status,
+        result=result_data,
+        error_message=task.error_message,
+        created_at=str(task.created_at),
+        updated_at=str(task.updated_at) if task.updated_at else str(task.created_at),
+        completed_at=str(task.completed_at) if task.completed_at else None,
+        itinerary_id=task.itinerary_id,
+        image_status=task.image_status,
+        image_progress=task.image_progress or 0,
+        image_total=task.image_total or 0,
+        version=task.version or 0,
+        queue_position=position,
+        timings=stage_timings.parse_timings(task.timings) if include_timings else None,
+        estimated_completion_at=(
+            str(datetime.utcnow() + timedelta(seconds=remaining_seconds)) if remaining_seconds is not None else None
+        ),
+        estimated_seconds=round(remaining_seconds) if remaining_seconds is not None else None
+    )
+
+
+def describe_task(db: Session, task: Task, include_timings: bool = False) -> TaskStatusResponse:
+    """查询接口使用的任务状态：附带排队位置和预计完成时间"""
+    position = queue_position(db, task)
+    return build_task_status_response(
+        task, position, include_timings=include_timings,
+        remaining_seconds=eta_estimator.remaining_seconds(db, task, position)
+    )
+
+
+def is_task_finished(task_status: Optional[str], image_status: Optional[str]) -> bool:
+    """任务是否已结束（失败、已取消，或文字行程和图片补全都已结束）"""
+    if task_status in ("failed", "cancelled"):
+        return True
+    return task_status == "completed" and image_status not in ("pending", "processing")
+
+
+# ============ 处理流程 ============
+def new_itinerary_record(
+    user_id: int,
+    travel_request: TravelRequest,
+    blob: ItineraryBlob,
+    total_budget: Optional[float]
+) -> Itinerary:
+    """登录用户的行程记录（引用已保存的行程内容）"""
+    return Itinerary(
+        user_id=user_id,
+        agent_name=travel_request.agentName,
+        destination=travel_request.destination,
+        days=travel_request.days,
+        budget=travel_request.budget,
+        travelers=travel_request.travelers,
+        preferences=json.dumps(travel_request.preferences, ensure_ascii=False),
+        extra_requirements=travel_request.extraRequirements,
+        blob=blob,
+        total_budget=total_budget
+    )
+
+
+def create_task_from_cached_result(db: Session, task: Task, travel_request: TravelRequest, source: Task) -> Task:
+    """
+    降级模式：新任务直接复用相同需求的已完成结果（引用同一份行程内容），不进入队列
+    登录用户同样保存一条行程记录
+    """
+    now = datetime.utcnow()
+    itinerary_id = None
+    created = False
+    if task.user_id:
+        content = json.loads(source.result_json)
+        overview = content.get("overview") or {}
+        itinerary_record = new_itinerary_record(task.user_id, travel_request, source.result_blob, overview.get("totalBudget"))
+        refresh_content_hash(itinerary_record, content)
+        fill_itinerary_summary(itinerary_record, content)
+        # 同一用户已保存过相同的行程时复用已有记录
+        itinerary_record, created = save_itinerary_record(db, itinerary_record)
+        if created:
+            save_itinerary_plans(db, itinerary_record, content)
+        itinerary_id = itinerary_record.id
+    
+    task.status = "completed"
+    task.result_hash = source.result_hash
+    task.itinerary_id = itinerary_id
+    task.itinerary_created = created
+    task.image_status = "completed"
+    task.image_progress = source.image_progress
+    task.image_total = source.image_total
+    task.completed_at = now
+    task.updated_at = now
+    db.add(task)
+    db.commit()
+    logger.info(f"♻️  [降级模式] 任务 {task.task_id} 复用任务 {source.task_id} 的结果")
+    return task
+
+
+async def process_travel_plan_task(task_id: str, request_data: dict, user_id: Optional[int] = None):
+    """
+    后台异步处理旅行计划生成任务（由任务队列领取后调用，此时任务已是 processing）
+
+    分两个阶段：
+    1. 文字行程：LLM 生成并解析成功后，任务立即标记为 completed（前端即可展示）
+    2. 图片补全：异步为每个活动搜索图片，通过 image_status / image_progress 单独汇报进度，
+       并更新 Task 和 Itinerary 引用的行程内容
+
+    文字行程失败时抛出异常，由任务队列决定重试或标记为 failed。
+    写回结果时任务已被取消（不再是 processing）则丢弃结果，抛出 TaskCancelledError。
+    """
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if not task:
+            logger.error(f"任务 {task_id} 不存在")
+            return
+        
+        logger.info(f"🤖 [后台任务] 开始处理任务 {task_id}")
+        timings = stage_timings.start_timings()
+        # 重试时只计最近一次入队后的等待，不含之前的尝试和退避
+        timings.add(stage_timings.STAGE_QUEUE, stage_timings.seconds_since(task.available_at or task.created_at))
+        
+        # 解析请求数据
+        travel_request = TravelRequest(**request_data)
+        
+        # 生成文字行程（图片补全在后面单独进行）
+        itinerary = await travel_agent.generate_itinerary(travel_request, enrich_images=False)
+        logger.info(f"✅ [后台任务] 任务 {task_id} 文字行程完成")
+        
+        # 写入数据库的耗时（提交后计入，耗时记录在图片阶段开始时随任务一起保存）
+        persist_started = time.perf_counter()
+        
+        # 只序列化一次，行程记录和任务结果引用同一份内容
+        itinerary_blob = store_itinerary_json(db, itinerary.model_dump_json())
+        
+        # 如果用户已登录，保存到数据库
+        itinerary_id = None
+        created = False
+        if user_id:
+            itinerary_record = new_itinerary_record(
+                user_id, travel_request, itinerary_blob,
+                itinerary.overview.totalBudget if itinerary.overview else None
+            )
+            content = itinerary.model_dump()
+            refresh_content_hash(itinerary_record, content)
+            fill_itinerary_summary(itinerary_record, content)
+            itinerary_record, created = save_itinerary_record(db, itinerary_record)
+            if created:
+                save_itinerary_plans(db, itinerary_record, content)
+            itinerary_id = itinerary_record.id
+        
+        # 更新任务状态为completed（文字行程已可用），图片进入待补全状态
+        # 只在任务仍是 processing 时写入，与取消互斥；行程记录和任务结果在同一个事务中提交
+        now = datetime.utcnow()
+        updated = db.query(Task).filter(
+            Task.task_id == task_id,
+            Task.status == "processing"
+        ).update({
+            Task.status: "completed",
+            Task.result_hash: itinerary_blob.hash,
+            Task.itinerary_id: itinerary_id,
+            Task.itinerary_created: created,
+            Task.image_status: "pending",
+            Task.image_progress: 0,
+            Task.image_total: sum(len(day.activities) for day in itinerary.dailyPlans),
+            Task.completed_at: now,
+            Task.updated_at: now,
+            Task.version: func.coalesce(Task.version, 0) + 1,
+        }, synchronize_session=False)
+        if not updated:
+            db.rollback()
+            raise TaskCancelledError(task_id)
+        db.commit()
+        timings.add(stage_timings.STAGE_PERSIST, time.perf_counter() - persist_started)
+        if user_id:
+            logger.info(f"[INFO] 已保存行程: 用户 {user_id}, 目的地 {travel_request.destination}")
+        
+        # 推送文字行程结果（完整结果只推送这一次，图片阶段只推送进度）
+        task_events.publish(task_id, EVENT_RESULT, describe_task(db, task).model_dump())
+        logger.info(f"✅ [后台任务] 任务 {task_id} 已保存结果")
+        
+    except TaskCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [后台任务] 任务 {task_id} 处理失败: {str(e)}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    # 去重复用的已有行程不随本任务的图片补全修改
+    await process_image_enrichment(task_id, itinerary, travel_request.destination, itinerary_id if created else None)
+
+
+async def process_image_enrichment(
+    task_id: str,
+    itinerary: TravelItinerary,
+    destination: str,
+    itinerary_id: Optional[int] = None,
+    resume: bool = False
+):
+    """
+    图片补全阶段：逐个活动搜索图片，每完成一个活动就把最新结果写入内容表，
+    并让 Task 和 Itinerary 引用新内容（旧内容不再被引用时删除），前端即可看到图片陆续出现
+    resume 为 True 时是恢复中断的补全，上次已写入图片的活动直接计入进度
+
+    每次写入都要求 image_status 仍是 processing，图片补全被取消后抛出 TaskCancelledError，
+    已写入的部分图片保留
+    """
+    db = SessionLocal()
+    # 紧接生成阶段时沿用其耗时记录；恢复中断的图片补全时从任务中读取
+    timings = stage_timings.current_timings()
+
+    def update_image_stage(values: dict, *expected_statuses: str):
+        """只在图片阶段仍处于预期状态时更新任务（同时保存阶段耗时），否则视为已取消；返回更新后的版本号"""
+        if timings is not None:
+            values[Task.timings] = timings.to_json()
+        values[Task.updated_at] = datetime.utcnow()
+        values[Task.version] = func.coalesce(Task.version, 0) + 1
+        updated = db.query(Task).filter(
+            Task.task_id == task_id,
+            Task.status == "completed",
+            Task.image_status.in_(expected_statuses or ("processing",))
+        ).update(values, synchronize_session=False)
+        if not updated:
+            db.rollback()
+            raise TaskCancelledError(task_id)
+        return db.query(Task.version).filter(Task.task_id == task_id).scalar()
+
+    try:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if not task:
+            logger.error(f"任务 {task_id} 不存在")
+            return
+        
+        if timings is None:
+            timings = stage_timings.start_timings(task.timings)
+        
+        result_hash = task.result_hash
+        version = update_image_stage({Task.image_status: "processing"}, "pending", "processing")
+        db.commit()
+        task_events.publish(task_id, EVENT_STATUS, {
+            "task_id": task_id, "status": "completed", "image_status": "processing", "version": version
+        })
+        
+        async def save_progress(current: TravelItinerary, done: int, total: int):
+            nonlocal result_hash
+            persist_started = time.perf_counter()
+            blob = store_itinerary_json(db, current.model_dump_json())
+            version = update_image_stage({
+                Task.result_hash: blob.hash,
+                Task.image_progress: done,
+                Task.image_total: total,
+            })
+            previous_itinerary_hash = None
+            if itinerary_id:
+                # 去重时行程记录可能是已有的记录，引用的内容不一定是本任务的结果
+                previous_itinerary_hash = db.query(Itinerary.itinerary_hash).filter(
+                    Itinerary.id == itinerary_id
+                ).scalar()
+                db.query(Itinerary).filter(Itinerary.id == itinerary_id).update(
+                    {
+                        Itinerary.itinerary_hash: blob.hash,
+                        Itinerary.itinerary_data: "",
+                        Itinerary.cover_image: cover_image(current.model_dump()),
+                    },
+                    synchronize_session=False
+                )
+            if result_hash != blob.hash:
+                release_itinerary_json(db, result_hash)
+                result_hash = blob.hash
+            if previous_itinerary_hash not in (None, blob.hash, result_hash):
+                release_itinerary_json(db, previous_itinerary_hash)
+            db.commit()
+            if itinerary_id:
+                share_cache.invalidate_itinerary(itinerary_id)
+            timings.add(stage_timings.STAGE_PERSIST, time.perf_counter() - persist_started)
+            task_events.publish(task_id, EVENT_PROGRESS, {
+                "task_id": task_id, "image_status": "processing", "image_progress": done, "image_total": total,
+                "version": version
+            })
+        
+        # 图片阶段耗时不含其中写入数据库的时间（已计入 persist）
+        enrich_started = time.perf_counter()
+        persist_before = timings.stages.get(stage_timings.STAGE_PERSIST, 0)
+        await travel_agent.enrich_itinerary_images(itinerary, destination, on_progress=save_progress, resume=resume)
+        persist_seconds = (timings.stages.get(stage_timings.STAGE_PERSIST, 0) - persist_before) / 1000
+        timings.add(stage_timings.STAGE_IMAGES, time.perf_counter() - enrich_started - persist_seconds)
+        
+        update_image_stage({Task.image_status: "completed"})
+        db.commit()
+        stage_timings.observe_timings(timings, *stage_timings.STAGES)
+        task_events.publish(task_id, EVENT_IMAGES, build_task_status_response(task).model_dump())
+        logger.info(f"🖼️  [后台任务] 任务 {task_id} 图片补全完成")
+        
+    except TaskCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ [后台任务] 任务 {task_id} 图片补全失败: {str(e)}")
+        db.rollback()
+        try:
+            version = update_image_stage({Task.image_status: "failed"})
+        except TaskCancelledError:
+            return
+        db.commit()
+        task_events.publish(task_id, EVENT_STATUS, {
+            "task_id": task_id, "status": "completed", "image_status": "failed", "version": version
+        })
+    finally:
+        db.close()
+
+
+async def run_generate_stage(task_id: str):
+    """任务队列 generate 阶段：读取请求参数并生成行程"""
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if not task:
+            logger.error(f"任务 {task_id} 不存在")
+            return
+        request_data = json.loads(task.request_data)
+        user_id = task.user_id
+    finally:
+        db.close()
+    
+    await process_travel_plan_task(task_id, request_data, user_id)
+
+
+async def run_image_stage(task_id: str):
+    """任务队列 images 阶段：恢复被中断的图片补全（正常情况下图片补全紧接在 generate 阶段之后执行）"""
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        result_json = task.result_json if task else None
+        if not result_json:
+            logger.error(f"任务 {task_id} 不存在或没有可补全图片的结果")
+            return
+        itinerary = TravelItinerary.model_validate_json(result_json)
+        destination = json.loads(task.request_data).get("destination", "")
+        # 升级前的任务（为空）都新建了自己的行程记录
+        itinerary_id = task.itinerary_id if task.itinerary_created is not False else None
+    finally:
+        db.close()
+    
+    await process_image_enrichment(task_id, itinerary, destination, itinerary_id, resume=True)
+
+
+def create_task_queue(**options) -> TaskQueue:
+    """创建处理生成任务的队列（参数见 TaskQueue，未指定时使用配置）"""
+    return TaskQueue({
+        STAGE_GENERATE: run_generate_stage,
+        STAGE_IMAGES: run_image_stage,
+    }, **options)
@@ -0,0 +1,551 @@
+"""
+持久化任务队列
+以 tasks 表作为队列存储，支持固定大小的 worker 池、租约 + 心跳、启动时恢复中断的任务和有限次重试
+
+任务阶段：
+- generate: status 为 pending（或租约已过期的 processing），生成文字行程
+- images:   status 为 completed 且 image_status 为 pending/processing（租约已过期），补全图片
+
+公平调度：
+- 中断后需要恢复的任务（租约过期的 processing / 图片补全）优先领取
+- 新任务按提交者（owner_key：登录用户 user:<id>，游客 ip:<地址>）轮转：每个提交者只取最早的一个任务参与排序，
+  按 优先级（高者先）→ 该提交者正在处理的任务数（少者先）→ 提交时间 排序
+- 开启 shortest_job_first 时，同一优先级内把提交时间换成 预计耗时 - 已等待时间（预计耗时短的先执行，
+  等待时间会抵消预计耗时的差距，长任务不会一直被插队）
+- 每个提交者同时处理的任务数不超过 max_in_flight（多个 worker 并发领取时为软上限）
+
+取消：cancel_task 在数据库中把任务标记为 cancelled 并清除租约。本进程内运行的任务立即取消协程
+（正在进行的 LLM 请求和图片搜索随之中止）；其他 worker 在下一次心跳续约失败或写回结果时发现并停止。
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from sqlalchemy import and_, case, func, or_, select
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal, settings
+from .db_models import Task
+from .eta import eta_estimator, task_days
+from .task_events import EVENT_STATUS, task_events
+from .timings import seconds_since
+
+logger = logging.getLogger(__name__)
+
+STAGE_GENERATE = "generate"
+STAGE_IMAGES = "images"
+
+# 单次领取时参与排序的提交者数量上限
+FAIR_SHARE_CANDIDATES = 200
+
+TaskHandler = Callable[[str], Awaitable[None]]
+
+# 可以取消的状态：排队中、生成中，以及文字行程已完成但图片仍在补全
+CANCELLABLE_STATUSES = ("pending", "processing")
+ACTIVE_IMAGE_STATUSES = ("pending", "processing")
+
+
+class TaskCancelledError(Exception):
+    """任务已被取消（处理函数写回结果时发现），由任务队列按取消处理，不重试"""
+
+
+def _lease_available(now: datetime):
+    """租约为空或已到期（对待重试的 pending 任务表示已到可执行时间）"""
+    return or_(Task.lease_expires_at.is_(None), Task.lease_expires_at <= now)
+
+
+def task_owner_key(user_id: Optional[int], client_ip: Optional[str]) -> str:
+    """任务的调度分组：登录用户按用户ID，游客按客户端 IP"""
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{client_ip or 'unknown'}"
+
+
+def task_priority(user_id: Optional[int]) -> int:
+    """任务优先级：登录用户高于游客"""
+    return settings.TASK_PRIORITY_USER if user_id else settings.TASK_PRIORITY_GUEST
+
+
+def _owner_column():
+    # 旧任务没有 owner_key，各自单独成组
+    return func.coalesce(Task.owner_key, Task.task_id)
+
+
+def _ranked_pending(*criteria):
+    """排队中的任务及其在所属提交者内的序号（1 表示该提交者最早的任务）"""
+    owner = _owner_column()
+    return select(
+        Task.id,
+        Task.task_id,
+        Task.status,
+        Task.attempts,
+        Task.created_at,
+        Task.request_data,
+        owner.label("owner"),
+        func.coalesce(Task.priority, 0).label("priority"),
+        func.row_number().over(partition_by=owner, order_by=(Task.created_at, Task.id)).label("owner_rank"),
+    ).where(Task.status == "pending", *criteria).subquery()
+
+
+def queue_position(db: Session, task: Task) -> Optional[int]:
+    """
+    排队中任务的大致位置（1 表示下一个执行），非 pending 任务返回 None
+    按与调度相同的轮转顺序估算：优先级 → 在所属提交者内的序号 → 提交时间
+    """
+    if task.status != "pending":
+        return None
+    # 在同一条 SQL 中与本任务比较，不把 created_at 取回再作为参数传入
+    # （SQLite 上默认值写入的时间不带微秒，与参数按字符串比较时会出错）
+    ranked = _ranked_pending()
+    me = select(ranked).where(ranked.c.id == task.id).subquery()
+    others = _ranked_pending()
+    found, ahead = db.execute(
+        select(func.count(me.c.id.distinct()), func.count(others.c.id))
+        .select_from(me)
+        .outerjoin(others, or_(
+            others.c.priority > me.c.priority,
+            and_(others.c.priority == me.c.priority, others.c.owner_rank < me.c.owner_rank),
+            and_(
+                others.c.priority == me.c.priority,
+                others.c.owner_rank == me.c.owner_rank,
+                or_(
+                    others.c.created_at < me.c.created_at,
+                    and_(others.c.created_at == me.c.created_at, others.c.id < me.c.id)
+                )
+            ),
+        ))
+    ).one()
+    if not found:
+        return None
+    return ahead + 1
+
+
+def cancel_task(db: Session, task_id: str) -> bool:
+    """
+    取消任务：生成阶段（排队中或生成中）标记为 cancelled；文字行程已完成时只取消图片补全
+    使用带条件的 UPDATE，与 worker 写回结果互斥；任务已结束时返回 False
+    """
+    now = datetime.utcnow()
+    released = {
+        Task.lease_owner: None,
+        Task.lease_expires_at: None,
+        Task.updated_at: now,
+        Task.version: func.coalesce(Task.version, 0) + 1,
+    }
+    cancelled = db.query(Task).filter(
+        Task.task_id == task_id,
+        Task.status.in_(CANCELLABLE_STATUSES)
+    ).update({
+        **released,
+        Task.status: "cancelled",
+        Task.error_message: "任务已取消",
+    }, synchronize_session=False)
+    if not cancelled:
+        cancelled = db.query(Task).filter(
+            Task.task_id == task_id,
+            Task.status == "completed",
+            Task.image_status.in_(ACTIVE_IMAGE_STATUSES)
+        ).update({
+            **released,
+            Task.image_status: "cancelled",
+        }, synchronize_session=False)
+    db.commit()
+    return cancelled > 0
+
+
+class TaskQueue:
+    """基于 tasks 表的持久化任务队列"""
+
+    def __init__(
+        self,
+        handlers: Dict[str, TaskHandler],
+        concurrency: int = settings.TASK_WORKER_CONCURRENCY,
+        lease_seconds: int = settings.TASK_LEASE_SECONDS,
+        heartbeat_seconds: int = settings.TASK_HEARTBEAT_SECONDS,
+        max_attempts: int = settings.TASK_MAX_ATTEMPTS,
+        retry_delay_seconds: int = settings.TASK_RETRY_DELAY_SECONDS,
+        poll_seconds: float = settings.TASK_POLL_SECONDS,
+        max_in_flight: int = settings.TASK_MAX_IN_FLIGHT_PER_USER,
+        shortest_job_first: bool = settings.TASK_SHORTEST_JOB_FIRST,
+    ):
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay_seconds = retry_delay_seconds
+        self.poll_seconds = poll_seconds
+        self.max_in_flight = max(1, max_in_flight)
+        self.shortest_job_first = shortest_job_first
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self._running_by_task: Dict[str, asyncio.Task] = {}
+
+    # ============ 生命周期 ============
+
+    async def start(self):
+        """恢复中断的任务并启动调度循环"""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        recovered = await asyncio.to_thread(self.recover_orphaned_tasks)
+        if any(recovered.values()):
+            logger.info(f"♻️  [任务队列] 恢复中断的任务: {recovered}")
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        logger.info(f"🧵 [任务队列] 已启动: worker={self.worker_id}, 并发={self.concurrency}")
+
+    async def stop(self):
+        """停止调度，取消正在运行的任务并释放租约，以便重启后立即被重新领取"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for running in list(self._running):
+            running.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        await asyncio.to_thread(self._release_leases)
+        logger.info(f"🧵 [任务队列] 已停止: worker={self.worker_id}")
+
+    def notify(self):
+        """有新任务入队时唤醒调度循环（无需等待下一次轮询）"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    def cancel_local(self, task_id: str) -> bool:
+        """取消本进程内正在运行的任务（数据库中的状态由 cancel_task 负责），返回是否找到"""
+        running = self._running_by_task.get(task_id)
+        if running is None or running.done():
+            return False
+        running.cancel()
+        logger.info(f"🛑 [任务队列] 已取消本地运行的任务 {task_id}")
+        return True
+
+    # ============ 调度 ============
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                claimed = await asyncio.to_thread(self.claim_next)
+            except Exception as e:
+                logger.error(f"❌ [任务队列] 领取任务失败: {e}")
+                claimed = None
+
+            if claimed is None:
+                self._slots.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task_id, stage = claimed
+            running = asyncio.create_task(self._run(task_id, stage))
+            self._running.add(running)
+            self._running_by_task[task_id] = running
+            running.add_done_callback(lambda done, task_id=task_id: self._on_done(task_id, done))
+
+    def _on_done(self, task_id: str, running: asyncio.Task):
+        self._running.discard(running)
+        if self._running_by_task.get(task_id) is running:
+            del self._running_by_task[task_id]
+        self._slots.release()
+        # 空出 worker 后立即尝试领取下一个任务
+        self._wakeup.set()
+
+    async def _run(self, task_id: str, stage: str):
+        heartbeat = asyncio.create_task(self._heartbeat(task_id, asyncio.current_task()))
+        if stage == STAGE_GENERATE:
+            task_events.publish(task_id, EVENT_STATUS, {"task_id": task_id, "status": "processing"})
+        try:
+            await self.handlers[stage](task_id)
+        except asyncio.CancelledError:
+            raise
+        except TaskCancelledError:
+            logger.info(f"🛑 [任务队列] 任务 {task_id} ({stage}) 已被取消，停止处理")
+        except Exception as e:
+            logger.error(f"❌ [任务队列] 任务 {task_id} ({stage}) 失败: {e}")
+            state = await asyncio.to_thread(self._handle_failure, task_id, stage, str(e))
+            if state:
+                task_events.publish(task_id, EVENT_STATUS, state)
+        else:
+            await asyncio.to_thread(self._clear_lease, task_id)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, task_id: str, running: asyncio.Task):
+        """定期续约；租约被其他 worker 接管或任务被取消时取消本地执行"""
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            renewed = await asyncio.to_thread(self._renew_lease, task_id)
+            if not renewed:
+                logger.warning(f"⚠️  [任务队列] 任务 {task_id} 的租约已丢失（被接管或已取消），停止本地执行")
+                running.cancel()
+                return
+
+    # ============ 数据库操作（同步，在线程池中执行） ============
+
+    def claim_next(self) -> Optional[Tuple[str, str]]:
+        """
+        领取下一个可执行的任务，返回 (task_id, stage)
+
+        使用带条件的 UPDATE 实现原子领取：只有在状态和租约仍满足条件时才会更新成功，
+        多个 worker 并发领取同一任务时只有一个能成功。Postgres 上先 SELECT ... FOR UPDATE SKIP LOCKED，
+        多台机器上的 worker 不会互相等待行锁。
+        """
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            for candidate in self._recovery_candidates(db, now):
+                claimed = self._try_claim(db, now, *candidate)
+                if claimed:
+                    return claimed
+            for candidate in self._fair_share_candidates(db, now):
+                claimed = self._try_claim(db, now, *candidate)
+                if claimed:
+                    return claimed
+            return None
+        finally:
+            db.close()
+
+    def _recovery_candidates(self, db: Session, now: datetime):
+        """租约已过期的处理中任务和待补全图片的任务（已被接纳过，优先恢复）"""
+        return db.query(Task.id, Task.task_id, Task.status, Task.attempts).filter(
+            or_(
+                Task.status == "processing",
+                and_(Task.status == "completed", Task.image_status.in_(("pending", "processing")))
+            ),
+            _lease_available(now)
+        ).order_by(Task.created_at, Task.id).limit(10).all()
+
+    def _fair_share_candidates(self, db: Session, now: datetime):
+        """每个提交者最早的排队任务，按优先级、该提交者正在处理的任务数和提交时间（或预计耗时）排序"""
+        owner = _owner_column()
+        in_flight = dict(
+            db.query(owner, func.count(Task.id)).filter(
+                Task.status == "processing",
+                Task.lease_expires_at > now
+            ).group_by(owner).all()
+        )
+
+        ranked = _ranked_pending(_lease_available(now))
+        heads = db.execute(
+            select(ranked).where(ranked.c.owner_rank == 1)
+            .order_by(ranked.c.priority.desc(), ranked.c.created_at, ranked.c.id)
+            .limit(FAIR_SHARE_CANDIDATES)
+        ).all()
+
+        heads = [head for head in heads if in_flight.get(head.owner, 0) < self.max_in_flight]
+        if self.shortest_job_first:
+            model = eta_estimator.model(db)
+            heads.sort(key=lambda head: (
+                -head.priority,
+                in_flight.get(head.owner, 0),
+                round(model.generate_seconds(task_days(head.request_data)) - seconds_since(head.created_at)),
+                head.id
+            ))
+        else:
+            heads.sort(key=lambda head: (-head.priority, in_flight.get(head.owner, 0), head.created_at, head.id))
+        return [(head.id, head.task_id, head.status, head.attempts) for head in heads[:10]]
+
+    def _try_claim(self, db: Session, now: datetime, pk: int, task_id: str, task_status: str, attempts: Optional[int]):
+        stage = STAGE_IMAGES if task_status == "completed" else STAGE_GENERATE
+        guard = (Task.id == pk, Task.status == task_status, _lease_available(now))
+        if stage == STAGE_IMAGES:
+            # 选出候选后图片补全可能已被取消，不能再改回 processing
+            guard += (Task.image_status.in_(ACTIVE_IMAGE_STATUSES),)
+
+        # 处理中被中断且已用完重试次数的任务直接标记失败
+        if task_status == "processing" and (attempts or 0) >= self.max_attempts:
+            db.query(Task).filter(*guard).update({
+                Task.status: "failed",
+                Task.error_message: "任务多次中断，已停止重试",
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.updated_at: now,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            db.commit()
+            return None
+
+        values = {
+            Task.lease_owner: self.worker_id,
+            Task.lease_expires_at: now + timedelta(seconds=self.lease_seconds),
+            Task.started_at: now,
+            Task.updated_at: now,
+            Task.version: func.coalesce(Task.version, 0) + 1,
+        }
+        if task_status == "processing":
+            # 接管租约已过期的任务：从租约到期（可被领取）时开始计算排队时间
+            values[Task.available_at] = Task.lease_expires_at
+        if stage == STAGE_GENERATE:
+            values[Task.status] = "processing"
+            values[Task.attempts] = func.coalesce(Task.attempts, 0) + 1
+        else:
+            values[Task.image_status] = "processing"
+
+        if db.get_bind().dialect.name == "postgresql":
+            # Postgres：先锁定行，已被其他 worker 锁定时直接跳过，不必等待对方提交
+            locked = db.query(Task.id).filter(*guard).with_for_update(skip_locked=True).first()
+            if locked is None:
+                db.rollback()
+                return None
+
+        claimed = db.query(Task).filter(*guard).update(values, synchronize_session=False)
+        db.commit()
+        if claimed:
+            logger.info(f"🧵 [任务队列] 领取任务 {task_id} ({stage})")
+            return task_id, stage
+        return None
+
+    def _renew_lease(self, task_id: str) -> bool:
+        db = SessionLocal()
+        try:
+            renewed = db.query(Task).filter(
+                Task.task_id == task_id,
+                Task.lease_owner == self.worker_id
+            ).update({
+                Task.lease_expires_at: datetime.utcnow() + timedelta(seconds=self.lease_seconds),
+                # 续租不是客户端可见的变化，不触发 updated_at 的 onupdate
+                Task.updated_at: Task.updated_at,
+            }, synchronize_session=False)
+            db.commit()
+            return renewed > 0
+        finally:
+            db.close()
+
+    def _clear_lease(self, task_id: str):
+        db = SessionLocal()
+        try:
+            db.query(Task).filter(
+                Task.task_id == task_id,
+                Task.lease_owner == self.worker_id
+            ).update({
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _handle_failure(self, task_id: str, stage: str, error: str) -> Optional[Dict[str, object]]:
+        """
+        生成阶段失败时按指数退避重试，超过次数后标记失败；图片阶段失败不影响已完成的行程
+
+        返回任务更新后的状态（用于发布事件），任务已不归本 worker 所有时返回 None
+        """
+        db = SessionLocal()
+        try:
+            task = db.query(Task).filter(Task.task_id == task_id, Task.lease_owner == self.worker_id).first()
+            if not task:
+                return None
+            now = datetime.utcnow()
+            task.lease_owner = None
+            task.updated_at = now
+            task.version = func.coalesce(Task.version, 0) + 1
+            if stage == STAGE_IMAGES:
+                task.image_status = "failed"
+                task.lease_expires_at = None
+            elif (task.attempts or 0) < self.max_attempts:
+                delay = self.retry_delay_seconds * (2 ** ((task.attempts or 1) - 1))
+                task.status = "pending"
+                task.error_message = error
+                task.lease_expires_at = now + timedelta(seconds=delay)
+                task.available_at = task.lease_expires_at
+                logger.info(f"🔁 [任务队列] 任务 {task_id} 将在 {delay} 秒后重试（第 {task.attempts} 次失败）")
+            else:
+                task.status = "failed"
+                task.error_message = error
+                task.lease_expires_at = None
+            db.commit()
+            return {
+                "task_id": task_id,
+                "status": task.status,
+                "image_status": task.image_status,
+                "error_message": task.error_message,
+                "version": task.version,
+            }
+        finally:
+            db.close()
+
+    def _release_leases(self):
+        """关闭时释放本 worker 持有的租约；被中断的生成任务不计入尝试次数"""
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.query(Task).filter(
+                Task.lease_owner == self.worker_id,
+                Task.status == "processing"
+            ).update({
+                Task.status: "pending",
+                Task.attempts: case((Task.attempts > 0, Task.attempts - 1), else_=0),
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.available_at: now,
+                Task.updated_at: now,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            db.query(Task).filter(
+                Task.lease_owner == self.worker_id,
+                Task.status == "completed"
+            ).update({
+                Task.image_status: "pending",
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.updated_at: now,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def recover_orphaned_tasks(self) -> Dict[str, int]:
+        """
+        启动时恢复中断的任务：
+        - 租约已过期（或没有租约）的 processing 任务：未用完重试次数的重新排队，否则标记失败
+        - 租约已过期的图片补全阶段：重新排队
+        """
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            orphaned = (Task.status == "processing", _lease_available(now))
+            failed = db.query(Task).filter(
+                *orphaned, func.coalesce(Task.attempts, 0) >= self.max_attempts
+            ).update({
+                Task.status: "failed",
+                Task.error_message: "任务多次中断，已停止重试",
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.updated_at: now,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            requeued = db.query(Task).filter(*orphaned).update({
+                Task.status: "pending",
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.available_at: now,
+                Task.updated_at: now,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            images = db.query(Task).filter(
+                Task.status == "completed",
+                Task.image_status == "processing",
+                _lease_available(now)
+            ).update({
+                Task.image_status: "pending",
+                Task.lease_owner: None,
+                Task.lease_expires_at: None,
+                Task.version: func.coalesce(Task.version, 0) + 1,
+            }, synchronize_session=False)
+            db.commit()
+            return {"requeued": requeued, "failed": failed, "images": images}
+        finally:
+            db.close()
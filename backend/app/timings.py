@@ -0,0 +1,130 @@
+"""
+任务阶段耗时
+处理生成任务时按阶段累计耗时（毫秒），保存在 Task.timings（紧凑 JSON），
+并可按最近完成的任务汇总出各阶段的分位数，用于判断时间花在哪里
+"""
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .db_models import Task
+
+STAGE_QUEUE = "queue"        # 排队等待（最近一次入队到开始生成）
+STAGE_LLM = "llm"            # LLM 调用（含重试）
+STAGE_PARSE = "parse"        # 提取、解析和修复 JSON
+STAGE_VALIDATE = "validate"  # pydantic 校验
+STAGE_IMAGES = "images"      # 图片补全（不含其中的数据库写入）
+STAGE_PERSIST = "persist"    # 写入数据库
+
+STAGES = (STAGE_QUEUE, STAGE_LLM, STAGE_PARSE, STAGE_VALIDATE, STAGE_IMAGES, STAGE_PERSIST)
+
+_current: ContextVar[Optional["StageTimings"]] = ContextVar("task_stage_timings", default=None)
+
+
+class StageTimings:
+    """一个任务各阶段的累计耗时（毫秒）"""
+
+    def __init__(self, initial: Optional[Dict[str, float]] = None):
+        self.stages: Dict[str, float] = dict(initial or {})
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds * 1000
+
+    def to_json(self) -> str:
+        return json.dumps({stage: round(ms) for stage, ms in self.stages.items()}, separators=(",", ":"))
+
+
+def start_timings(initial_json: Optional[str] = None) -> StageTimings:
+    """开始记录当前任务的阶段耗时（在任务协程中调用，之后的 stage_timer / record_stage 记入其中）"""
+    timings = StageTimings(parse_timings(initial_json))
+    _current.set(timings)
+    return timings
+
+
+def current_timings() -> Optional[StageTimings]:
+    return _current.get()
+
+
+def seconds_since(moment: Optional[datetime]) -> float:
+    """距 moment 的秒数（兼容带时区和不带时区的 UTC 时间）"""
+    if moment is None:
+        return 0.0
+    return max(0.0, (datetime.utcnow() - _naive_utc(moment)).total_seconds())
+
+
+def seconds_until(moment: Optional[datetime]) -> float:
+    """距 moment 还有的秒数（已过去时为 0）"""
+    if moment is None:
+        return 0.0
+    return max(0.0, (_naive_utc(moment) - datetime.utcnow()).total_seconds())
+
+
+def _naive_utc(moment: datetime) -> datetime:
+    """带时区的时间转换为不带时区的 UTC 时间"""
+    if moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def record_stage(stage: str, seconds: float):
+    """累计当前任务某个阶段的耗时（不在任务中时忽略）"""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """记录代码块的耗时（异常退出时同样记录）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def parse_timings(timings_json: Optional[str]) -> Dict[str, float]:
+    if not timings_json:
+        return {}
+    try:
+        return json.loads(timings_json)
+    except (TypeError, ValueError):
+        return {}
+
+
+def observe_timings(timings: StageTimings, *stages: str):
+    """把指定阶段的耗时记入进程内指标"""
+    for stage in stages:
+        if stage in timings.stages:
+            metrics.observe("task_stage_ms", timings.stages[stage], stage=stage)
+
+
+def aggregate_stage_timings(db: Session, hours: int = 24, limit: int = 5000) -> Dict[str, Dict[str, float]]:
+    """汇总最近完成的任务各阶段耗时的分位数（毫秒），跨进程（包括独立 worker）统计"""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    rows = db.query(Task.timings).filter(
+        Task.status == "completed",
+        Task.completed_at >= since,
+        Task.timings.isnot(None)
+    ).order_by(Task.completed_at.desc()).limit(limit).all()
+
+    samples: Dict[str, List[float]] = {}
+    for (timings_json,) in rows:
+        for stage, ms in parse_timings(timings_json).items():
+            samples.setdefault(stage, []).append(ms)
+
+    summary = {}
+    for stage in sorted(samples, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+        values = sorted(samples[stage])
+        summary[stage] = {
+            "count": len(values),
+            **{f"p{p}": metrics.percentile(values, p) for p in metrics.SUMMARY_PERCENTILES},
+            "max": values[-1],
+        }
+    return summary
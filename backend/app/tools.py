@@ -100,19 +100,13 @@ def get_place_images(place_name: str, count: int = 3) -> List[str]:
     Returns:
         图片URL列表（真实高质量照片）
     """
-    from app.image_search import search_unsplash, search_pexels, get_placeholder_images
+    from app.image_search import search_images
     
     # 优化搜索关键词：添加 "travel" 或 "landmark" 提升相关性
     enhanced_query = f"{place_name} travel landmark"
     
-    # 优先尝试 Unsplash API
-    images = search_unsplash(enhanced_query, count=count)
-    
-    # 如果 Unsplash 结果不够，补充 Pexels
-    if len(images) < count:
-        remaining = count - len(images)
-        pexels_images = search_pexels(enhanced_query, count=remaining)
-        images.extend(pexels_images)
+    # 按 IMAGE_PROVIDERS 顺序搜索（默认优先 Unsplash，不够再补充 Pexels）
+    images = search_images(enhanced_query, count=count)
     
     # 如果没有找到图片，返回空数组（不使用占位图）
     if not images:
@@ -0,0 +1,99 @@
+"""
+用户的行程数和收藏数
+历史和收藏列表的总数直接读取 users 表上的计数，不再每次加载都 COUNT。
+
+计数在写入行程和收藏的同一事务中用 "count = count + 变化量" 更新：
+经过 ORM 的新增和删除由会话的 after_flush 事件处理，不经过 ORM 的写入（INSERT ... ON CONFLICT、批量删除）需要调用
+adjust_user_counters 或 recount_user_counters。
+
+计数为空表示尚未统计（升级前的用户），此时加减不生效，首次读取时按实际数据统计一次；
+backfill_itineraries.py 可以一次性为所有用户重新统计
+"""
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .db_models import Favorite, Itinerary, User
+
+logger = logging.getLogger(__name__)
+
+
+def _adjust_statement(user_id: int, itineraries: int, favorites: int):
+    return update(User).where(User.id == user_id).values(
+        itinerary_count=User.itinerary_count + itineraries,
+        favorite_count=User.favorite_count + favorites
+    ).execution_options(synchronize_session=False)
+
+
+def adjust_user_counters(db: Session, user_id: int, itineraries: int = 0, favorites: int = 0):
+    """按变化量更新用户的计数（只写入当前事务，由调用方提交）"""
+    if itineraries or favorites:
+        db.execute(_adjust_statement(user_id, itineraries, favorites))
+
+
+@event.listens_for(Session, "after_flush")
+def _sync_user_counters(session: Session, flush_context):
+    """在新增或删除行程和收藏的同一事务中更新计数"""
+    deltas: Dict[int, Dict[str, int]] = defaultdict(lambda: {"itineraries": 0, "favorites": 0})
+    for objects, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Itinerary):
+                deltas[obj.user_id]["itineraries"] += sign
+            elif isinstance(obj, Favorite):
+                deltas[obj.user_id]["favorites"] += sign
+    # 注销账号时用户本身也被删除，更新不会匹配任何行
+    for user_id, delta in deltas.items():
+        if user_id is not None:
+            adjust_user_counters(session, user_id, **delta)
+
+
+def _recount_statement(user_ids: Iterable[int]):
+    """按实际数据统计用户的计数（收藏只计行程仍存在的）"""
+    return update(User).where(User.id.in_(list(user_ids))).values(
+        itinerary_count=select(func.count(Itinerary.id)).where(
+            Itinerary.user_id == User.id
+        ).scalar_subquery(),
+        favorite_count=select(func.count(Favorite.id)).join(
+            Itinerary, Itinerary.id == Favorite.itinerary_id
+        ).where(Favorite.user_id == User.id).scalar_subquery()
+    ).execution_options(synchronize_session=False)
+
+
+def recount_user_counters(db: Session, user_ids: Iterable[int]):
+    """重新统计用户的计数（只写入当前事务，由调用方提交）"""
+    user_ids = list(user_ids)
+    if user_ids:
+        db.execute(_recount_statement(user_ids))
+
+
+async def user_counters(db: AsyncSession, user: User) -> Tuple[int, int]:
+    """用户的 (行程数, 收藏数)；尚未统计时先统计并保存"""
+    if user.itinerary_count is not None and user.favorite_count is not None:
+        return user.itinerary_count, user.favorite_count
+    await db.execute(_recount_statement([user.id]))
+    await db.commit()
+    counts = (await db.execute(
+        select(User.itinerary_count, User.favorite_count).where(User.id == user.id)
+    )).first()
+    return (counts.itinerary_count or 0, counts.favorite_count or 0) if counts else (0, 0)
+
+
+def recount_all_user_counters(db: Session, batch_size: int = 1000) -> int:
+    """按 ID 分批为所有用户重新统计计数（可重复执行），返回用户数"""
+    count = 0
+    last_id = 0
+    while True:
+        user_ids = db.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not user_ids:
+            return count
+        recount_user_counters(db, user_ids)
+        db.commit()
+        last_id = user_ids[-1]
+        count += len(user_ids)
+        logger.info(f"🔢 [用户计数] 已统计 {count} 个用户")
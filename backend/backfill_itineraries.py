@@ -0,0 +1,45 @@
+"""
+行程派生数据回填脚本
+为已有行程补充每日计划和活动表（daily_plans / activities）和列表页的摘要列，并重新统计用户的行程数和收藏数。
+可重复执行，已处理的行程会被跳过。
+
+用法: python backfill_itineraries.py [--batch-size 200]
+"""
+import argparse
+import io
+import logging
+import sys
+
+# 设置标准输出编码为UTF-8
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+from app.database import engine, Base, SessionLocal, ensure_schema
+from app.itinerary_plans import backfill_itinerary_plans, backfill_itinerary_summaries
+from app.user_counters import recount_all_user_counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回填行程的派生数据")
+    parser.add_argument("--batch-size", type=int, default=200, help="每批处理的行数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+
+    db = SessionLocal()
+    try:
+        count = backfill_itinerary_plans(db, batch_size=args.batch_size)
+        print(f"[OK] 每日计划和活动: 已处理 {count} 个行程")
+        count = backfill_itinerary_summaries(db, batch_size=args.batch_size)
+        print(f"[OK] 行程摘要: 已处理 {count} 个行程")
+        count = recount_all_user_counters(db, batch_size=args.batch_size)
+        print(f"[OK] 行程数和收藏数: 已统计 {count} 个用户")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+行程去重脚本
+为旧行程计算 content_hash 并删除同一用户内容完全相同的重复行程（每组保留最新的一条），
+引用重复行程的任务、收藏和分享链接改为指向保留的记录。按批处理、不需要交互确认，可重复执行。
+
+用法: python dedupe_itineraries.py [--batch-size 1000]
+"""
+import argparse
+import io
+import logging
+import sys
+
+# 设置标准输出编码为UTF-8
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+from app.database import engine, Base, SessionLocal, ensure_schema
+from app.itinerary_dedupe import dedupe_itineraries
+from app.search_index import ensure_search_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="删除重复的行程")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批处理的行数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+    # 删除重复行程时同时删除其全文索引
+    ensure_search_index(engine)
+
+    db = SessionLocal()
+    try:
+        result = dedupe_itineraries(db, batch_size=args.batch_size)
+        print(f"[OK] 计算内容哈希: {result['hashed']} 条")
+        print(f"[OK] 删除重复行程: {result['deleted']} 条（发现 {result['duplicates']} 条）")
+        print(f"[OK] 写回内容哈希: {result['filled']} 条")
+        print(f"[OK] 清理未引用的行程内容: {result['purged_blobs']} 条")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,16 @@ import io
 if sys.platform == 'win32':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
-from app.database import engine, Base
-from app.db_models import User, Itinerary, EmailVerification, ShareLink, Favorite, TemporaryShare
+from app.database import engine, Base, ensure_schema
+from app.db_models import User, Itinerary, ItineraryBlob, EmailVerification, ShareLink, Favorite, TemporaryShare, Task
+from app.search_index import ensure_search_index
 
 def init_db():
     """初始化数据库，创建所有表"""
     print("正在创建数据库表...")
     Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+    ensure_search_index(engine)
     print("[OK] 数据库表创建成功！")
     print(f"[OK] 创建的表: {list(Base.metadata.tables.keys())}")
 
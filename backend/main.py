@@ -1,14 +1,19 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, status
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, EmailStr
 from typing import List, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 import uvicorn
 from dotenv import load_dotenv
 import json
 import logging
+import os
 import secrets
 import asyncio
 import uuid
@@ -42,17 +47,63 @@ def safe_filename_for_header(filename: str) -> tuple[str, str]:
     return ascii_filename, utf8_encoded
 
 
-from app.agent import TravelPlanningAgent
-from app.models import TravelRequest, TravelItinerary
-from app.database import get_db, engine, Base, settings, SessionLocal
-from app.db_models import User, Itinerary, EmailVerification, ShareLink, Favorite, TemporaryShare, Task
+def get_client_ip(request: Request) -> str:
+    """客户端 IP（配置 TRUST_FORWARDED_FOR 时取 X-Forwarded-For 的第一个地址）"""
+    if settings.TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+from app.models import TravelRequest
+from app.database import get_db, get_async_db, engine, Base, settings, SessionLocal, ensure_schema, dispose_async_engines
+from app.db_models import User, Itinerary, ItineraryDay, ItineraryActivity, EmailVerification, ShareLink, Favorite, TemporaryShare, Task
 from app.pdf_export import generate_pdf
+from app.image_search import load_local_image_index
+from app.task_queue import task_owner_key, task_priority, cancel_task
+from app.itinerary_store import store_itinerary_json, release_itinerary_json
+from app.search_index import ensure_search_index, match_subquery
+from app.itinerary_dedupe import refresh_content_hash
+from app.itinerary_plans import (
+    save_itinerary_plans,
+    update_itinerary_city,
+    remove_itinerary_plans,
+    fill_itinerary_summary,
+    day_titles
+)
+from app.user_counters import adjust_user_counters, user_counters
+from app.share_resolver import ResolvedShare, resolve_share, resolve_share_async, share_cache
+from app.retention import RetentionJob
+from app.admission import AdmissionController, AdmissionRejected, request_fingerprint, find_cached_result
+from app import metrics
+from app.timings import aggregate_stage_timings
+from app.task_events import (
+    task_events,
+    task_version_watcher,
+    format_sse,
+    EVENT_STATUS,
+    EVENT_RESULT,
+    EVENT_IMAGES,
+    EVENT_CHANGED
+)
+from app.task_pipeline import (
+    travel_agent,
+    TaskStatusResponse,
+    describe_task,
+    create_task_from_cached_result,
+    is_task_finished,
+    create_task_queue
+)
 from app.auth import (
     get_password_hash, 
     verify_password, 
     create_access_token,
     get_current_user,
     get_current_user_optional,
+    get_current_user_async,
+    get_current_user_optional_async,
+    get_current_user_id_optional,
     get_user_by_email,
     create_verification_code,
     verify_verification_code,
@@ -65,6 +116,8 @@ load_dotenv()
 
 # 确保数据库表已创建
 Base.metadata.create_all(bind=engine)
+ensure_schema(engine)
+ensure_search_index(engine)
 
 logger.info("="*70)
 logger.info("🚀 Travel-GPT Backend 正在初始化...")
@@ -149,6 +202,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],  # 前端读取准入控制返回的重试时间
 )
 
 @app.exception_handler(RequestValidationError)
@@ -160,76 +214,52 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content={"detail": exc.errors(), "body": str(exc.body)},
     )
 
-# Initialize agent
-travel_agent = TravelPlanningAgent()
+# 本地图片库（离线 Provider）：挂载静态目录，启动时构建索引
+if settings.LOCAL_IMAGE_DIR and os.path.isdir(settings.LOCAL_IMAGE_DIR):
+    app.mount("/local-images", StaticFiles(directory=settings.LOCAL_IMAGE_DIR), name="local-images")
 
-# 后台任务处理函数
-async def process_travel_plan_task(task_id: str, request_data: dict, user_id: Optional[int] = None):
-    """
-    后台异步处理旅行计划生成任务
-    """
-    db = SessionLocal()
-    try:
-        # 更新任务状态为processing
-        task = db.query(Task).filter(Task.task_id == task_id).first()
-        if not task:
-            logger.error(f"任务 {task_id} 不存在")
-            return
-        
-        task.status = "processing"
-        task.updated_at = datetime.utcnow()
-        db.commit()
-        
-        logger.info(f"🤖 [后台任务] 开始处理任务 {task_id}")
-        
-        # 解析请求数据
-        travel_request = TravelRequest(**request_data)
-        
-        # 生成行程
-        itinerary = await travel_agent.generate_itinerary(travel_request)
-        logger.info(f"✅ [后台任务] 任务 {task_id} 完成")
-        
-        # 如果用户已登录，保存到数据库
-        itinerary_id = None
-        if user_id:
-            itinerary_record = Itinerary(
-                user_id=user_id,
-                agent_name=travel_request.agentName,
-                destination=travel_request.destination,
-                days=travel_request.days,
-                budget=travel_request.budget,
-                travelers=travel_request.travelers,
-                preferences=json.dumps(travel_request.preferences, ensure_ascii=False),
-                extra_requirements=travel_request.extraRequirements,
-                itinerary_data=itinerary.model_dump_json(),
-                total_budget=itinerary.overview.totalBudget if itinerary.overview else None
-            )
-            db.add(itinerary_record)
-            db.commit()
-            db.refresh(itinerary_record)
-            itinerary_id = itinerary_record.id
-            logger.info(f"[INFO] 已保存行程: 用户 {user_id}, 目的地 {travel_request.destination}")
-        
-        # 更新任务状态为completed
-        task.status = "completed"
-        task.result_data = itinerary.model_dump_json()
-        task.completed_at = datetime.utcnow()
-        task.updated_at = datetime.utcnow()
-        db.commit()
-        
-        logger.info(f"✅ [后台任务] 任务 {task_id} 已保存结果")
-        
-    except Exception as e:
-        logger.error(f"❌ [后台任务] 任务 {task_id} 处理失败: {str(e)}")
-        # 更新任务状态为failed
-        task = db.query(Task).filter(Task.task_id == task_id).first()
-        if task:
-            task.status = "failed"
-            task.error_message = str(e)
-            task.updated_at = datetime.utcnow()
-            db.commit()
-    finally:
-        db.close()
+
+@app.on_event("startup")
+async def build_local_image_index():
+    await asyncio.to_thread(load_local_image_index)
+
+
+task_queue = create_task_queue()
+
+
+@app.on_event("startup")
+async def start_task_queue():
+    # 独立部署 worker（python worker.py）时，API 进程只负责入队和查询状态
+    if settings.TASK_WORKER_EMBEDDED:
+        await task_queue.start()
+    # 任务可能在其他进程中处理（独立 worker，或多个 uvicorn worker 进程各自内嵌的 worker），
+    # 进程内的事件收不到这些变化，始终由版本监视器唤醒长轮询和 SSE（只在有订阅者时查询）
+    await task_version_watcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_task_queue():
+    await task_queue.stop()
+    await task_version_watcher.stop()
+
+
+retention_job = RetentionJob()
+
+
+@app.on_event("startup")
+async def start_retention_job():
+    if settings.RETENTION_ENABLED:
+        await retention_job.start()
+
+
+@app.on_event("shutdown")
+async def stop_retention_job():
+    await retention_job.stop()
+
+
+@app.on_event("shutdown")
+async def close_async_database():
+    await dispose_async_engines()
 
 
 @app.get("/")
@@ -318,7 +348,9 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
         hashed_password = get_password_hash(user_data.password)
         new_user = User(
             email=user_data.email,
-            hashed_password=hashed_password
+            hashed_password=hashed_password,
+            itinerary_count=0,
+            favorite_count=0
         )
         db.add(new_user)
         db.commit()
@@ -415,8 +447,12 @@ async def delete_account(
     """注销账号（删除账号及关联数据）"""
     try:
         # 删除用户（关联的行程会自动删除，因为设置了cascade="all, delete-orphan"）
+        itinerary_ids = [itinerary.id for itinerary in current_user.itineraries]
+        remove_itinerary_plans(db, itinerary_ids)
         db.delete(current_user)
         db.commit()
+        for itinerary_id in itinerary_ids:
+            share_cache.invalidate_itinerary(itinerary_id)
         return {"message": "账号已成功注销"}
     except Exception as e:
         db.rollback()
@@ -509,9 +545,14 @@ class TaskResponse(BaseModel):
     status: str
     message: str
 
+
+admission_controller = AdmissionController()
+
+
 @app.post("/api/generate-plan", response_model=TaskResponse)
 async def generate_travel_plan(
     request: TravelRequest,
+    http_request: Request,
     db: Session = Depends(get_db),
     current_user: Optional[User] = Depends(get_current_user_optional)
 ):
@@ -519,6 +560,9 @@ async def generate_travel_plan(
     创建旅行计划生成任务（异步）
     立即返回任务ID，前端通过轮询 /api/tasks/{task_id} 获取结果
     支持登录和未登录用户，登录用户会保存历史记录
+
+    准入控制：单个用户排队任务过多时返回 429，整体排队过深或预计等待过长时返回 503，均带 Retry-After。
+    超载时如有相同需求的已完成行程，直接返回该结果（任务状态为 completed）。
     """
     logger.info("\n" + "="*80)
     logger.info("🚀 [API] 收到生成行程请求（异步模式）")
@@ -531,26 +575,52 @@ async def generate_travel_plan(
     logger.info(f"👤 用户: {'已登录' if current_user else '未登录'}")
     logger.info("="*80 + "\n")
     
+    user_id = current_user.id if current_user else None
+    owner_key = task_owner_key(user_id, get_client_ip(http_request))
+    request_data = request.model_dump()
+    fingerprint = request_fingerprint(request_data)
+    
+    # 创建任务记录（按用户/游客 IP 分组公平调度，登录用户优先）
+    task = Task(
+        task_id=str(uuid.uuid4()),
+        user_id=user_id,
+        status="pending",
+        request_data=json.dumps(request_data, ensure_ascii=False),
+        request_hash=fingerprint,
+        owner_key=owner_key,
+        priority=task_priority(user_id)
+    )
+    
+    if settings.ADMISSION_ENABLED:
+        try:
+            admission_controller.check(db, owner_key)
+        except AdmissionRejected as rejected:
+            cached = find_cached_result(db, fingerprint) if settings.ADMISSION_DEGRADED_MODE else None
+            if cached is None:
+                metrics.increment("admission_rejected_total", reason=rejected.reason)
+                logger.warning(f"🚦 拒绝生成请求: {rejected.reason}, owner={owner_key}, Retry-After={rejected.retry_after}")
+                raise HTTPException(
+                    status_code=rejected.status_code,
+                    detail=rejected.detail,
+                    headers={"Retry-After": str(rejected.retry_after)}
+                )
+            metrics.increment("admission_degraded_total", reason=rejected.reason)
+            create_task_from_cached_result(db, task, request, cached)
+            return TaskResponse(
+                task_id=task.task_id,
+                status="completed",
+                message="当前生成任务较多，已为您返回相同需求的已有行程"
+            )
+    
     try:
-        # 生成唯一任务ID
-        task_id = str(uuid.uuid4())
-        
-        # 创建任务记录
-        task = Task(
-            task_id=task_id,
-            user_id=current_user.id if current_user else None,
-            status="pending",
-            request_data=json.dumps(request.model_dump(), ensure_ascii=False)
-        )
+        task_id = task.task_id
         db.add(task)
         db.commit()
         
-        logger.info(f"✅ 任务 {task_id} 已创建，开始后台处理")
+        logger.info(f"✅ 任务 {task_id} 已入队，等待 worker 处理")
         
-        # 启动后台任务
-        request_dict = request.model_dump()
-        user_id = current_user.id if current_user else None
-        asyncio.create_task(process_travel_plan_task(task_id, request_dict, user_id))
+        # 唤醒任务队列（任务已持久化在 tasks 表中，由固定大小的 worker 池处理）
+        task_queue.notify()
         
         return TaskResponse(
             task_id=task_id,
@@ -567,182 +637,389 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """进程内运行指标（数据保留清理数量、任务阶段耗时分布等）"""
+    return metrics.snapshot()
+
+
+@app.get("/api/metrics/task-timings")
+async def get_task_timing_percentiles(
+    hours: int = 24,
+    db: Session = Depends(get_db)
+):
+    """最近完成的任务各阶段耗时的分位数（毫秒），包括独立 worker 处理的任务"""
+    hours = min(max(hours, 1), 24 * 30)
+    return {"hours": hours, "stages": aggregate_stage_timings(db, hours=hours)}
+
+
 # ============ Task Endpoints ============
-class TaskStatusResponse(BaseModel):
-    task_id: str
-    status: str  # pending, processing, completed, failed
-    result: Optional[dict] = None  # 完成后的结果数据
-    error_message: Optional[str] = None  # 失败时的错误信息
-    created_at: str
-    updated_at: str
-    completed_at: Optional[str] = None
+# 长轮询单次最长等待时间（秒）
+TASK_LONG_POLL_MAX_SECONDS = 30
+# SSE 空闲时的心跳间隔；同时兜底从数据库检查其他进程对任务的更新
+SSE_KEEPALIVE_SECONDS = 15
+
 
 @app.get("/api/tasks/{task_id}", response_model=TaskStatusResponse)
 async def get_task_status(
+    task_id: str,
+    wait: Optional[float] = None,
+    since: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Optional[User] = Depends(get_current_user_optional_async),
+    timings: bool = False
+):
+    """
+    查询任务状态和结果（支持登录和未登录用户）
+    
+    长轮询：传入 wait（秒）和 since（上次拿到的 version）时，如果任务版本仍等于 since，
+    请求会在内存中等待任务的下一次变化或超时后再返回，客户端无需频繁轮询
+    
+    传入 timings=true 时一并返回各阶段耗时（毫秒）
+    
+    estimated_completion_at / estimated_seconds 为按最近的阶段耗时估算的完成时间，随阶段推进更新，
+    客户端可据此拉长下次查询的间隔
+    """
+    current_user_id = current_user.id if current_user else None
+    
+    # 长轮询先订阅再读取，避免读取和等待之间发生的变化丢失
+    waiter = task_events.subscribe(task_id) if wait and since is not None else None
+    try:
+        task = await db.scalar(select(Task).where(Task.task_id == task_id))
+        
+        if not task:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="任务不存在"
+            )
+        
+        # 如果用户已登录，验证任务是否属于该用户（增强并发安全）
+        if current_user_id and task.user_id is not None:
+            if task.user_id != current_user_id:
+                logger.warning(f"用户 {current_user_id} 尝试访问不属于自己的任务 {task_id}（任务属于用户 {task.user_id}）")
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="无权访问此任务"
+                )
+        
+        # 验证返回的task_id与请求的task_id匹配（双重验证）
+        if task.task_id != task_id:
+            logger.error(f"任务ID不匹配！请求: {task_id}, 数据库: {task.task_id}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="任务ID验证失败"
+            )
+        
+        if (
+            waiter is not None
+            and (task.version or 0) == since
+            and not is_task_finished(task.status, task.image_status)
+        ):
+            task_events.note_version(task_id, since)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + max(0, min(wait, TASK_LONG_POLL_MAX_SECONDS))
+            while True:
+                # 等待期间结束事务，释放数据库连接
+                await db.rollback()
+                remaining = deadline - loop.time()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(waiter.get(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        remaining = 0
+                task = await db.scalar(select(Task).where(Task.task_id == task_id))
+                if not task:
+                    raise HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail="任务不存在"
+                    )
+                # 被唤醒但版本未变（例如其他请求登记的旧版本）时继续等待
+                if remaining <= 0 or (task.version or 0) != since or is_task_finished(task.status, task.image_status):
+                    break
+        
+        logger.debug(f"查询任务状态: task_id={task_id}, status={task.status}, version={task.version}, user_id={current_user_id}")
+        
+        # 排队位置和预计完成时间复用同步的查询函数
+        return await db.run_sync(lambda session: describe_task(session, task, include_timings=timings))
+    finally:
+        if waiter is not None:
+            task_events.unsubscribe(task_id, waiter)
+
+
+@app.delete("/api/tasks/{task_id}", response_model=TaskStatusResponse)
+async def cancel_generation_task(
     task_id: str,
     db: Session = Depends(get_db),
     current_user: Optional[User] = Depends(get_current_user_optional)
 ):
-    """查询任务状态和结果（支持登录和未登录用户）"""
+    """
+    取消任务（支持登录和未登录用户）
+
+    排队中或生成中的任务标记为 cancelled，并中止正在进行的 LLM 请求；文字行程已完成时只停止图片补全（已有图片保留）。
+    任务已结束时不做修改，直接返回当前状态。
+    """
     task = db.query(Task).filter(Task.task_id == task_id).first()
-    
     if not task:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="任务不存在"
         )
-    
-    # 如果用户已登录，验证任务是否属于该用户（增强并发安全）
-    if current_user and task.user_id is not None:
+    # 取消会修改任务状态：登录用户的任务只能由本人取消（游客任务不校验）
+    if task.user_id is not None:
+        if current_user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="请先登录"
+            )
         if task.user_id != current_user.id:
-            logger.warning(f"用户 {current_user.id} 尝试访问不属于自己的任务 {task_id}（任务属于用户 {task.user_id}）")
+            logger.warning(f"用户 {current_user.id} 尝试取消不属于自己的任务 {task_id}（任务属于用户 {task.user_id}）")
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="无权访问此任务"
             )
     
-    # 验证返回的task_id与请求的task_id匹配（双重验证）
-    if task.task_id != task_id:
-        logger.error(f"任务ID不匹配！请求: {task_id}, 数据库: {task.task_id}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="任务ID验证失败"
-        )
+    if cancel_task(db, task_id):
+        # 内嵌 worker 模式下立即中止本进程内的处理；独立 worker 在下一次心跳或写回结果时停止
+        task_queue.cancel_local(task_id)
+        db.refresh(task)
+        logger.info(f"🛑 任务已取消: task_id={task_id}, status={task.status}, image_status={task.image_status}")
+        task_events.publish(task_id, EVENT_STATUS, {
+            "task_id": task_id,
+            "status": task.status,
+            "image_status": task.image_status,
+            "error_message": task.error_message,
+            "version": task.version or 0,
+        })
     
-    result_data = None
-    if task.result_data:
-        try:
-            result_data = json.loads(task.result_data)
-        except:
-            result_data = None
+    return describe_task(db, task)
+
+
+def load_task_snapshot(task_id: str):
+    """读取任务当前状态，返回 (user_id, TaskStatusResponse)；任务不存在时返回 None"""
+    db = SessionLocal()
+    try:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if not task:
+            return None
+        return task.user_id, describe_task(db, task)
+    finally:
+        db.close()
+
+
+@app.get("/api/tasks/{task_id}/events")
+async def stream_task_events(
+    task_id: str,
+    request: Request,
+    user_id: Optional[int] = Depends(get_current_user_id_optional)
+):
+    """
+    以 Server-Sent Events 推送任务状态（替代轮询 /api/tasks/{task_id}）
+
+    事件类型：
+    - status:   状态变化（不含结果）
+    - result:   文字行程完成，附带完整结果（只推送一次）
+    - progress: 图片补全进度（只含计数）
+    - images:   图片补全完成，附带带图片的最终结果
+    连接建立时先推送一次当前快照；任务结束后服务端关闭连接。
+    worker 独立部署时，其他进程中的变化由版本监视器通知，这里重新读取后推送同样的事件。
+    """
+    # 先订阅再读取快照，避免两者之间发生的事件丢失
+    queue = task_events.subscribe(task_id)
+    try:
+        snapshot = await asyncio.to_thread(load_task_snapshot, task_id)
+        if snapshot is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="任务不存在"
+            )
+        owner_id, current = snapshot
+        task_events.note_version(task_id, current.version)
+        if user_id and owner_id is not None and owner_id != user_id:
+            logger.warning(f"用户 {user_id} 尝试订阅不属于自己的任务 {task_id}（任务属于用户 {owner_id}）")
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="无权访问此任务"
+            )
+    except Exception:
+        task_events.unsubscribe(task_id, queue)
+        raise
     
-    logger.debug(f"查询任务状态: task_id={task_id}, status={task.status}, user_id={current_user.id if current_user else None}")
+    async def event_stream():
+        try:
+            result_sent = current.result is not None
+            last_version = current.version
+            yield format_sse(EVENT_RESULT if result_sent else EVENT_STATUS, current.model_dump())
+            if is_task_finished(current.status, current.image_status):
+                return
+            
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    event, data = None, None
+                
+                if event is None or event == EVENT_CHANGED:
+                    # 任务在其他进程中变化（或空闲兜底检查）：重新读取当前状态
+                    snapshot = await asyncio.to_thread(load_task_snapshot, task_id)
+                    if snapshot is None:
+                        return
+                    latest = snapshot[1]
+                    if latest.version == last_version:
+                        if event is None:
+                            yield ": keep-alive\n\n"
+                        continue
+                    last_version = latest.version
+                    finished = is_task_finished(latest.status, latest.image_status)
+                    if latest.result is not None and (finished or not result_sent):
+                        event = EVENT_IMAGES if result_sent else EVENT_RESULT
+                        data = latest.model_dump()
+                    else:
+                        event = EVENT_STATUS
+                        data = latest.model_dump(exclude={"result"})
+                
+                if event in (EVENT_RESULT, EVENT_IMAGES):
+                    result_sent = True
+                last_version = data.get("version", last_version)
+                yield format_sse(event, data)
+                if is_task_finished(data.get("status"), data.get("image_status")):
+                    return
+        finally:
+            task_events.unsubscribe(task_id, queue)
     
-    return TaskStatusResponse(
-        task_id=task.task_id,
-        status=task.status,
-        result=result_data,
-        error_message=task.error_message,
-        created_at=str(task.created_at),
-        updated_at=str(task.updated_at) if task.updated_at else str(task.created_at),
-        completed_at=str(task.completed_at) if task.completed_at else None
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
 # ============ History Endpoints ============
+# 热门地点单次最多返回的数量
+POPULAR_PLACES_MAX_LIMIT = 50
+
+# 历史和收藏列表读取的列（摘要列在保存时提取，列表不读取行程内容）
+LIST_COLUMNS = (
+    Itinerary.id,
+    Itinerary.destination,
+    Itinerary.days,
+    Itinerary.budget,
+    Itinerary.created_at,
+    Itinerary.agent_name,
+    Itinerary.travelers,
+    Itinerary.total_budget,
+    Itinerary.activity_count,
+    Itinerary.cover_image,
+    Itinerary.day_titles,
+)
+
+
+def list_preview(row) -> dict:
+    """列表项的预览信息"""
+    return {
+        "agentName": row.agent_name,
+        "travelers": row.travelers,
+        "totalBudget": row.total_budget,
+        "activityCount": row.activity_count,
+        "coverImage": row.cover_image,
+        "dayTitles": day_titles(row)
+    }
+
 @app.get("/api/history")
 async def get_user_history(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 20,
     offset: int = 0,
-    search: Optional[str] = None,  # 搜索关键词（目的地、行程名称）
-    sort_by: Optional[str] = "created_at",  # 排序字段：created_at, total_budget, days
+    search: Optional[str] = None,  # 搜索关键词（目的地、行程名称、活动和隐藏宝石）
+    sort_by: Optional[str] = "created_at",  # 排序字段：created_at, total_budget, days, relevance（按搜索相关度）
     sort_order: Optional[str] = "desc",  # 排序顺序：asc, desc
     min_days: Optional[int] = None,  # 最小天数
     max_days: Optional[int] = None,  # 最大天数
     min_budget: Optional[float] = None,  # 最小预算
     max_budget: Optional[float] = None  # 最大预算
 ):
-    """获取用户的历史行程记录（支持搜索、筛选、排序）"""
+    """
+    获取用户的历史行程记录（支持搜索、筛选、排序）
+    
+    收藏的行程排在前面，组内按指定字段排序；排序和分页都在数据库中完成，只读取列表需要的摘要字段
+    搜索使用全文索引（见 app/search_index.py），按相关度排序时不再把收藏的排在前面
+    """
     try:
-        query = db.query(Itinerary).filter(Itinerary.user_id == current_user.id)
+        filters = [Itinerary.user_id == current_user.id]
         
-        # 搜索功能：按目的地或行程名称搜索
-        if search:
+        # 搜索功能：全文索引不可用时按目的地或行程名称模糊匹配
+        matches = match_subquery(current_user.id, search) if search else None
+        if search and matches is None:
             search_pattern = f"%{search}%"
-            query = query.filter(
+            filters.append(
                 (Itinerary.destination.like(search_pattern)) |
                 (Itinerary.agent_name.like(search_pattern))
             )
         
         # 筛选功能：按天数范围
         if min_days is not None:
-            query = query.filter(Itinerary.days >= min_days)
+            filters.append(Itinerary.days >= min_days)
         if max_days is not None:
-            query = query.filter(Itinerary.days <= max_days)
+            filters.append(Itinerary.days <= max_days)
         
         # 筛选功能：按预算范围
         if min_budget is not None:
-            query = query.filter(Itinerary.total_budget >= min_budget)
+            filters.append(Itinerary.total_budget >= min_budget)
         if max_budget is not None:
-            query = query.filter(Itinerary.total_budget <= max_budget)
-        
-        # 获取所有符合条件的行程（不分页，用于排序）
-        all_itineraries = query.all()
-        
-        # 获取所有行程ID
-        itinerary_ids = [item.id for item in all_itineraries]
-        
-        # 批量查询收藏状态
-        favorites = db.query(Favorite).filter(
-            Favorite.user_id == current_user.id,
-            Favorite.itinerary_id.in_(itinerary_ids)
-        ).all()
-        
-        # 创建收藏状态映射
-        favorited_ids = {fav.itinerary_id for fav in favorites}
+            filters.append(Itinerary.total_budget <= max_budget)
         
-        # 构建响应，包含收藏状态
-        items = []
-        for item in all_itineraries:
-            is_favorited = item.id in favorited_ids
-            # 获取排序字段的值
-            sort_value = None
-            if sort_by == "created_at":
-                sort_value = item.created_at.timestamp() if item.created_at else 0
-            elif sort_by == "total_budget":
-                sort_value = item.total_budget if item.total_budget else 0
-            elif sort_by == "days":
-                sort_value = item.days if item.days else 0
-            else:
-                sort_value = item.created_at.timestamp() if item.created_at else 0
-            
-            items.append({
-                "id": item.id,
-                "destination": item.destination,
-                "days": item.days,
-                "budget": item.budget,
-                "created_at": str(item.created_at),
-                "is_favorited": is_favorited,
-                "_sort_value": sort_value,  # 临时字段用于排序
-                "preview": {
-                    "agentName": item.agent_name,
-                    "travelers": item.travelers,
-                    "totalBudget": item.total_budget
-                }
-            })
-        
-        # 排序：收藏的优先，然后在每个组内按指定字段排序
-        # 排序键：(not is_favorited, sort_value)
-        # is_favorited=True时，not is_favorited=False，会排在前面（False < True）
-        # 对于sort_value，如果sort_order是desc，需要反转，所以使用负值
-        reverse_sort = (sort_order == "desc")
-        for item in items:
-            sort_value = item["_sort_value"]
-            if reverse_sort:
-                # 对于降序，使用负值，这样排序时小的（负的大值）会排在前面
-                item["_sort_key"] = (not item["is_favorited"], -sort_value)
-            else:
-                # 对于升序，直接使用原值
-                item["_sort_key"] = (not item["is_favorited"], sort_value)
-        
-        items.sort(key=lambda x: x["_sort_key"])
+        # 排序：收藏的优先，然后在每个组内按指定字段排序（空值按 0 处理），相同时按 ID
+        if sort_by == "total_budget":
+            sort_column = func.coalesce(Itinerary.total_budget, 0)
+        elif sort_by == "days":
+            sort_column = func.coalesce(Itinerary.days, 0)
+        else:
+            sort_column = Itinerary.created_at
+        is_favorited = (Favorite.id.isnot(None)).label("is_favorited")
+        if sort_by == "relevance" and matches is not None:
+            order_by = (matches.c.score.desc(), Itinerary.created_at.desc(), Itinerary.id.desc())
+        elif sort_order == "desc":
+            order_by = (is_favorited.desc(), sort_column.desc(), Itinerary.id.desc())
+        else:
+            order_by = (is_favorited.desc(), sort_column.asc(), Itinerary.id.asc())
         
-        # 移除临时排序字段
-        for item in items:
-            del item["_sort_value"]
-            del item["_sort_key"]
+        query = select(*LIST_COLUMNS, is_favorited)
+        count_query = select(func.count(Itinerary.id))
+        if matches is not None:
+            query = query.join(matches, matches.c.itinerary_id == Itinerary.id)
+            count_query = count_query.join(matches, matches.c.itinerary_id == Itinerary.id)
         
-        # 获取总数
-        total = len(items)
+        rows = (await db.execute(
+            query
+            .outerjoin(Favorite, (Favorite.itinerary_id == Itinerary.id) & (Favorite.user_id == current_user.id))
+            .where(*filters)
+            .order_by(*order_by)
+            .limit(limit)
+            .offset(offset)
+        )).all()
         
-        # 分页
-        paginated_items = items[offset:offset + limit]
+        # 获取总数：没有搜索和筛选时直接读取用户的行程数
+        if search or len(filters) > 1:
+            total = await db.scalar(count_query.where(*filters))
+        else:
+            total, _ = await user_counters(db, current_user)
         
         return {
-            "total": total,
-            "items": paginated_items
+            "total": total or 0,
+            "items": [
+                {
+                    "id": row.id,
+                    "destination": row.destination,
+                    "days": row.days,
+                    "budget": row.budget,
+                    "created_at": str(row.created_at),
+                    "is_favorited": bool(row.is_favorited),
+                    "preview": list_preview(row)
+                }
+                for row in rows
+            ]
         }
     except Exception as e:
         logger.error(f"Error fetching history: {e}")
@@ -752,14 +1029,16 @@ async def get_user_history(
 @app.get("/api/history/{itinerary_id}")
 async def get_itinerary_detail(
     itinerary_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """获取单个行程的详细信息"""
     try:
-        itinerary = db.query(Itinerary)\
-            .filter(Itinerary.id == itinerary_id, Itinerary.user_id == current_user.id)\
-            .first()
+        itinerary = await db.scalar(
+            select(Itinerary)
+            .options(selectinload(Itinerary.blob))
+            .where(Itinerary.id == itinerary_id, Itinerary.user_id == current_user.id)
+        )
         
         if not itinerary:
             raise HTTPException(status_code=404, detail="行程不存在或无权访问")
@@ -774,7 +1053,62 @@ async def get_itinerary_detail(
         "destination": itinerary.destination,
         "days": itinerary.days,
         "created_at": str(itinerary.created_at),
-        "itinerary": json.loads(itinerary.itinerary_data)
+        "itinerary": json.loads(itinerary.itinerary_json)
+    }
+
+
+@app.get("/api/history/{itinerary_id}/days")
+async def get_itinerary_days(
+    itinerary_id: int,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """获取行程每天的标题、活动数和花费（查询每日计划表，不读取行程内容）"""
+    found = await db.scalar(
+        select(Itinerary.id).where(Itinerary.id == itinerary_id, Itinerary.user_id == current_user.id)
+    )
+    if found is None:
+        raise HTTPException(status_code=404, detail="行程不存在或无权访问")
+    
+    rows = (await db.execute(
+        select(ItineraryDay.day, ItineraryDay.title, ItineraryDay.activity_count, ItineraryDay.total_cost)
+        .where(ItineraryDay.itinerary_id == itinerary_id)
+        .order_by(ItineraryDay.day)
+    )).all()
+    return {
+        "id": itinerary_id,
+        "days": [
+            {
+                "day": row.day,
+                "title": row.title,
+                "activityCount": row.activity_count,
+                "totalCost": row.total_cost
+            }
+            for row in rows
+        ]
+    }
+
+
+@app.get("/api/places/popular")
+async def get_popular_places(
+    city: str,
+    limit: int = 10,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """某个城市的行程中最常安排的活动（按活动表统计出现在多少个行程中）"""
+    limit = max(1, min(limit, POPULAR_PLACES_MAX_LIMIT))
+    itinerary_count = func.count(func.distinct(ItineraryActivity.itinerary_id)).label("itinerary_count")
+    rows = (await db.execute(
+        select(ItineraryActivity.title, itinerary_count)
+        .where(ItineraryActivity.city == city, ItineraryActivity.title.isnot(None))
+        .group_by(ItineraryActivity.title)
+        .order_by(itinerary_count.desc(), ItineraryActivity.title)
+        .limit(limit)
+    )).all()
+    return {
+        "city": city,
+        "places": [{"title": row.title, "itineraryCount": row.itinerary_count} for row in rows]
     }
 
 
@@ -800,8 +1134,9 @@ async def update_itinerary(
     # 更新字段
     if request.agent_name is not None:
         itinerary.agent_name = request.agent_name
-    if request.destination is not None:
+    if request.destination is not None and request.destination != itinerary.destination:
         itinerary.destination = request.destination
+        update_itinerary_city(db, itinerary)
     if request.days is not None:
         itinerary.days = request.days
     if request.budget is not None:
@@ -812,9 +1147,20 @@ async def update_itinerary(
         itinerary.preferences = json.dumps(request.preferences, ensure_ascii=False)
     if request.extra_requirements is not None:
         itinerary.extra_requirements = request.extra_requirements
+    # 请求参数变化后重新计算去重用的内容哈希（行程名称不参与）
+    if request.model_dump(exclude={"agent_name"}, exclude_none=True):
+        refresh_content_hash(itinerary)
     
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="已存在相同的行程"
+        )
     db.refresh(itinerary)
+    share_cache.invalidate_itinerary(itinerary_id)
     
     return {
         "id": itinerary.id,
@@ -856,8 +1202,16 @@ async def regenerate_itinerary(
                 extraRequirements=itinerary.extra_requirements or ""
             )
         
+        # 沿用旧行程中标题和目的地未变的活动图片，只为新活动搜索图片
+        try:
+            reuse_images = travel_agent.collect_reusable_images(
+                json.loads(itinerary.itinerary_json), itinerary.destination
+            )
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            reuse_images = {}
+        
         # 重新生成行程
-        new_itinerary = await travel_agent.generate_itinerary(request)
+        new_itinerary = await travel_agent.generate_itinerary(request, reuse_images=reuse_images)
         
         # 更新数据库中的行程数据
         itinerary.agent_name = request.agentName
@@ -867,13 +1221,28 @@ async def regenerate_itinerary(
         itinerary.travelers = request.travelers
         itinerary.preferences = json.dumps(request.preferences, ensure_ascii=False)
         itinerary.extra_requirements = request.extraRequirements
-        itinerary.itinerary_data = new_itinerary.model_dump_json()
+        previous_hash = itinerary.itinerary_hash
+        itinerary.blob = store_itinerary_json(db, new_itinerary.model_dump_json())
+        itinerary.itinerary_data = ""
         itinerary.total_budget = new_itinerary.overview.totalBudget if new_itinerary.overview else None
+        if previous_hash != itinerary.blob.hash:
+            release_itinerary_json(db, previous_hash)
+        content = new_itinerary.model_dump()
+        save_itinerary_plans(db, itinerary, content)
+        refresh_content_hash(itinerary, content)
+        fill_itinerary_summary(itinerary, content)
         
         db.commit()
         db.refresh(itinerary)
+        share_cache.invalidate_itinerary(itinerary_id)
         
         return new_itinerary
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="已存在相同的行程"
+        )
     except Exception as e:
         logger.error(f"重新生成行程失败: {str(e)}")
         raise HTTPException(
@@ -896,8 +1265,21 @@ async def delete_itinerary(
     if not itinerary:
         raise HTTPException(status_code=404, detail="行程不存在")
     
+    itinerary_hash = itinerary.itinerary_hash
+    # 生成该行程的任务记录保留，只解除关联
+    db.query(Task).filter(Task.itinerary_id == itinerary_id).update(
+        {Task.itinerary_id: None}, synchronize_session=False
+    )
+    # 收藏随行程一起删除（行程数由会话事件更新，批量删除的收藏需要手动更新收藏数）
+    removed_favorites = db.query(Favorite).filter(Favorite.itinerary_id == itinerary_id).delete(
+        synchronize_session=False
+    )
+    adjust_user_counters(db, current_user.id, favorites=-removed_favorites)
+    remove_itinerary_plans(db, [itinerary_id])
     db.delete(itinerary)
+    release_itinerary_json(db, itinerary_hash)
     db.commit()
+    share_cache.invalidate_itinerary(itinerary_id)
     
     return {"message": "删除成功"}
 
@@ -924,10 +1306,7 @@ async def export_itinerary_pdf(
     
     try:
         # 解析行程数据
-        if isinstance(itinerary.itinerary_data, str):
-            itinerary_data = json.loads(itinerary.itinerary_data)
-        else:
-            itinerary_data = itinerary.itinerary_data
+        itinerary_data = json.loads(itinerary.itinerary_json)
         
         # 生成PDF
         destination = itinerary.destination or "未知目的地"
@@ -964,55 +1343,14 @@ async def export_shared_itinerary_pdf(
     db: Session = Depends(get_db)
 ):
     """导出分享的行程为PDF（无需登录）"""
-    # 先尝试查找永久分享
-    share_link = db.query(ShareLink).filter(ShareLink.share_token == share_token).first()
-    
-    if share_link:
-        # 获取关联的行程
-        itinerary = db.query(Itinerary).filter(Itinerary.id == share_link.itinerary_id).first()
-        
-        if not itinerary:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="行程不存在"
-            )
-        
-        # 检查是否过期
-        if share_link.expires_at and datetime.utcnow() > share_link.expires_at:
-            raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="分享链接已过期"
-            )
-        
-        if isinstance(itinerary.itinerary_data, str):
-            itinerary_data = json.loads(itinerary.itinerary_data)
-        else:
-            itinerary_data = itinerary.itinerary_data
-        destination = itinerary.destination or "未知目的地"
-        days = itinerary.days or len(itinerary_data.get("dailyPlans", [])) or 1
-    else:
-        # 尝试查找临时分享
-        temporary_share = db.query(TemporaryShare).filter(TemporaryShare.share_token == share_token).first()
-        
-        if not temporary_share:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="分享链接不存在"
-            )
-        
-        # 检查是否过期
-        if datetime.utcnow() > temporary_share.expires_at:
-            raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="分享链接已过期"
-            )
-        
-        if isinstance(temporary_share.itinerary_data, str):
-            itinerary_data = json.loads(temporary_share.itinerary_data)
-        else:
-            itinerary_data = temporary_share.itinerary_data
+    share = shared_itinerary_or_error(resolve_share(db, share_token))
+    itinerary_data = share.itinerary_data
+    if share.is_temporary:
         destination = itinerary_data.get("destination") or "未知目的地"
         days = itinerary_data.get("days") or len(itinerary_data.get("dailyPlans", [])) or 1
+    else:
+        destination = share.destination or "未知目的地"
+        days = share.days or len(itinerary_data.get("dailyPlans", [])) or 1
     
     try:
         # 生成PDF
@@ -1081,19 +1419,43 @@ async def export_pdf_from_data(
 
 
 # ============ Share Endpoints ============
+# 生成临时分享令牌的最多尝试次数（令牌冲突时由唯一索引拒绝后重试）
+SHARE_TOKEN_ATTEMPTS = 3
+
+
+def shared_itinerary_or_error(share: Optional[ResolvedShare]) -> ResolvedShare:
+    """分享不存在、已过期或行程已删除时抛出对应的 HTTP 错误"""
+    if share is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="分享链接不存在"
+        )
+    if share.expired:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="分享链接已过期"
+        )
+    if share.itinerary_data is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="行程不存在"
+        )
+    return share
+
+
 @app.post("/api/itinerary/{itinerary_id}/share")
 async def create_share_link(
     itinerary_id: int,
     request: CreateShareLinkRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """创建分享链接"""
     # 验证行程属于当前用户
-    itinerary = db.query(Itinerary).filter(
+    itinerary = await db.scalar(select(Itinerary.id).where(
         Itinerary.id == itinerary_id,
         Itinerary.user_id == current_user.id
-    ).first()
+    ))
     
     if not itinerary:
         raise HTTPException(
@@ -1102,9 +1464,9 @@ async def create_share_link(
         )
     
     # 检查是否已存在分享链接
-    existing_share = db.query(ShareLink).filter(
+    existing_share = await db.scalar(select(ShareLink).where(
         ShareLink.itinerary_id == itinerary_id
-    ).first()
+    ))
     
     if existing_share:
         # 更新现有分享链接
@@ -1113,8 +1475,9 @@ async def create_share_link(
             existing_share.expires_at = datetime.utcnow() + timedelta(days=request.expires_days)
         else:
             existing_share.expires_at = None
-        db.commit()
-        db.refresh(existing_share)
+        await db.commit()
+        await db.refresh(existing_share)
+        share_cache.invalidate(existing_share.share_token)
         return {
             "share_token": existing_share.share_token,
             "share_url": f"/share/{existing_share.share_token}",
@@ -1125,7 +1488,7 @@ async def create_share_link(
     # 生成唯一的分享token
     while True:
         share_token = secrets.token_urlsafe(32)
-        if not db.query(ShareLink).filter(ShareLink.share_token == share_token).first():
+        if not await db.scalar(select(ShareLink.id).where(ShareLink.share_token == share_token)):
             break
     
     # 计算过期时间
@@ -1141,8 +1504,9 @@ async def create_share_link(
         expires_at=expires_at
     )
     db.add(share_link)
-    db.commit()
-    db.refresh(share_link)
+    await db.commit()
+    await db.refresh(share_link)
+    share_cache.invalidate(share_link.share_token)
     
     return {
         "share_token": share_link.share_token,
@@ -1158,25 +1522,30 @@ async def create_temporary_share(
     db: Session = Depends(get_db)
 ):
     """创建临时分享链接（用于游客用户）"""
-    # 生成唯一的分享token
-    while True:
-        share_token = secrets.token_urlsafe(32)
-        if not db.query(ShareLink).filter(ShareLink.share_token == share_token).first() and \
-           not db.query(TemporaryShare).filter(TemporaryShare.share_token == share_token).first():
-            break
-    
     # 计算过期时间
     expires_at = datetime.utcnow() + timedelta(days=request.expires_days)
+    itinerary_json = json.dumps(request.itinerary_data, ensure_ascii=False)
     
-    # 创建临时分享
-    temporary_share = TemporaryShare(
-        share_token=share_token,
-        itinerary_data=json.dumps(request.itinerary_data, ensure_ascii=False),
-        expires_at=expires_at
-    )
-    db.add(temporary_share)
-    db.commit()
+    # 创建临时分享：随机令牌几乎不会重复，不预先查询，冲突时由唯一索引拒绝后重新生成
+    for _ in range(SHARE_TOKEN_ATTEMPTS):
+        temporary_share = TemporaryShare(
+            share_token=secrets.token_urlsafe(32),
+            blob=store_itinerary_json(db, itinerary_json),
+            expires_at=expires_at
+        )
+        db.add(temporary_share)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="创建分享链接失败，请重试"
+        )
     db.refresh(temporary_share)
+    share_cache.invalidate(temporary_share.share_token)
     
     return {
         "share_token": temporary_share.share_token,
@@ -1188,98 +1557,29 @@ async def create_temporary_share(
 @app.get("/api/share/{share_token}")
 async def get_shared_itinerary(
     share_token: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """获取分享的行程（无需登录，支持永久分享和临时分享）"""
-    # 先尝试查找永久分享
-    share_link = db.query(ShareLink).filter(ShareLink.share_token == share_token).first()
-    
-    if share_link:
-        # 检查是否过期
-        if share_link.expires_at and datetime.utcnow() > share_link.expires_at:
-            raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="分享链接已过期"
-            )
-        
-        # 获取行程
-        itinerary = db.query(Itinerary).filter(Itinerary.id == share_link.itinerary_id).first()
-        
-        if not itinerary:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="行程不存在"
-            )
-        
-        # 解析行程数据
-        itinerary_data = json.loads(itinerary.itinerary_data)
-        
-        return {
-            "id": itinerary.id,
-            "destination": itinerary.destination,
-            "days": itinerary.days,
-            "created_at": str(itinerary.created_at),
-            "itinerary_data": itinerary_data,
-            "share_info": {
-                "is_public": share_link.is_public == 1,
-                "expires_at": str(share_link.expires_at) if share_link.expires_at else None,
-                "is_temporary": False
-            }
-        }
-    
-    # 尝试查找临时分享
-    temporary_share = db.query(TemporaryShare).filter(TemporaryShare.share_token == share_token).first()
-    
-    if temporary_share:
-        # 检查是否过期
-        if datetime.utcnow() > temporary_share.expires_at:
-            raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="分享链接已过期"
-            )
-        
-        # 解析行程数据
-        itinerary_data = json.loads(temporary_share.itinerary_data)
-        
-        # 从行程数据中提取基本信息
-        # 目的地可能在顶层，也可能在请求参数中（如果前端传递了）
-        destination = itinerary_data.get("destination") or "未知目的地"
-        # 天数从dailyPlans的长度推断
-        days = len(itinerary_data.get("dailyPlans", [])) or 1
-        
-        return {
-            "id": None,
-            "destination": destination,
-            "days": days,
-            "created_at": str(temporary_share.created_at),
-            "itinerary_data": itinerary_data,
-            "share_info": {
-                "is_public": True,
-                "expires_at": str(temporary_share.expires_at),
-                "is_temporary": True
-            }
-        }
-    
-    # 都没找到
-    raise HTTPException(
-        status_code=status.HTTP_404_NOT_FOUND,
-        detail="分享链接不存在"
-    )
+    share = await resolve_share_async(db, share_token)
+    return shared_itinerary_or_error(share).to_response()
 
 
 # ============ Favorite Endpoints ============
+# 批量查询收藏状态时单次最多的行程数
+FAVORITE_STATUS_MAX_IDS = 200
+
 @app.post("/api/favorites/{itinerary_id}")
 async def add_favorite(
     itinerary_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """收藏行程"""
     # 验证行程属于当前用户
-    itinerary = db.query(Itinerary).filter(
+    itinerary = await db.scalar(select(Itinerary.id).where(
         Itinerary.id == itinerary_id,
         Itinerary.user_id == current_user.id
-    ).first()
+    ))
     
     if not itinerary:
         raise HTTPException(
@@ -1288,10 +1588,10 @@ async def add_favorite(
         )
     
     # 检查是否已收藏
-    existing = db.query(Favorite).filter(
+    existing = await db.scalar(select(Favorite.id).where(
         Favorite.user_id == current_user.id,
         Favorite.itinerary_id == itinerary_id
-    ).first()
+    ))
     
     if existing:
         raise HTTPException(
@@ -1305,8 +1605,7 @@ async def add_favorite(
         itinerary_id=itinerary_id
     )
     db.add(favorite)
-    db.commit()
-    db.refresh(favorite)
+    await db.commit()
     
     return {"message": "收藏成功", "favorite_id": favorite.id}
 
@@ -1314,14 +1613,14 @@ async def add_favorite(
 @app.delete("/api/favorites/{itinerary_id}")
 async def remove_favorite(
     itinerary_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """取消收藏"""
-    favorite = db.query(Favorite).filter(
+    favorite = await db.scalar(select(Favorite).where(
         Favorite.user_id == current_user.id,
         Favorite.itinerary_id == itinerary_id
-    ).first()
+    ))
     
     if not favorite:
         raise HTTPException(
@@ -1329,63 +1628,114 @@ async def remove_favorite(
             detail="未收藏该行程"
         )
     
-    db.delete(favorite)
-    db.commit()
+    await db.delete(favorite)
+    await db.commit()
     
     return {"message": "取消收藏成功"}
 
 
 @app.get("/api/favorites")
 async def get_favorites(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 20,
-    offset: int = 0
+    offset: int = 0,
+    cursor: Optional[int] = None  # 上一页返回的 next_cursor
 ):
-    """获取收藏列表"""
-    favorites = db.query(Favorite).filter(
-        Favorite.user_id == current_user.id
-    ).order_by(Favorite.created_at.desc()).limit(limit).offset(offset).all()
+    """
+    获取收藏列表（按收藏时间倒序，只读取列表需要的摘要字段）
     
-    total = db.query(Favorite).filter(Favorite.user_id == current_user.id).count()
+    分页：传入上一页返回的 next_cursor 时按 (收藏时间, 收藏ID) 从上一页末尾继续读取；未传时按 offset 分页
+    """
+    query = select(
+        Favorite.id.label("favorite_id"),
+        Favorite.created_at.label("favorited_at"),
+        *LIST_COLUMNS,
+    ).join(Itinerary, Itinerary.id == Favorite.itinerary_id).where(Favorite.user_id == current_user.id)
     
-    # 获取收藏的行程信息
-    items = []
-    for fav in favorites:
-        itinerary = db.query(Itinerary).filter(Itinerary.id == fav.itinerary_id).first()
-        if itinerary:
-            items.append({
-                "id": itinerary.id,
-                "destination": itinerary.destination,
-                "days": itinerary.days,
-                "budget": itinerary.budget,
-                "created_at": str(itinerary.created_at),
-                "favorite_id": fav.id,
-                "favorited_at": str(fav.created_at),
-                "preview": {
-                    "agentName": itinerary.agent_name,
-                    "travelers": itinerary.travelers,
-                    "totalBudget": itinerary.total_budget
-                }
-            })
+    if cursor is not None:
+        # 在 SQL 中与游标对应的收藏比较，不把时间取回再作为参数传入
+        cursor_created_at = select(Favorite.created_at).where(
+            Favorite.id == cursor,
+            Favorite.user_id == current_user.id
+        ).scalar_subquery()
+        query = query.where(or_(
+            Favorite.created_at < cursor_created_at,
+            and_(Favorite.created_at == cursor_created_at, Favorite.id < cursor)
+        ))
+    else:
+        query = query.offset(offset)
+    
+    rows = (await db.execute(
+        query.order_by(Favorite.created_at.desc(), Favorite.id.desc()).limit(limit)
+    )).all()
+    
+    _, total = await user_counters(db, current_user)
+    
+    items = [
+        {
+            "id": row.id,
+            "destination": row.destination,
+            "days": row.days,
+            "budget": row.budget,
+            "created_at": str(row.created_at),
+            "favorite_id": row.favorite_id,
+            "favorited_at": str(row.favorited_at),
+            "preview": list_preview(row)
+        }
+        for row in rows
+    ]
     
     return {
         "total": total,
-        "items": items
+        "items": items,
+        "next_cursor": rows[-1].favorite_id if rows and len(rows) == limit else None
     }
 
 
+@app.get("/api/favorites/status")
+async def get_favorite_statuses(
+    ids: str = "",  # 逗号分隔的行程ID
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """批量检查行程是否已收藏，返回 {行程ID: 是否已收藏}"""
+    try:
+        itinerary_ids = {int(item) for item in ids.split(",") if item.strip()}
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="行程ID格式错误"
+        )
+    if len(itinerary_ids) > FAVORITE_STATUS_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"一次最多查询 {FAVORITE_STATUS_MAX_IDS} 个行程"
+        )
+    
+    favorited_ids = set()
+    if itinerary_ids:
+        favorited_ids = set((await db.scalars(
+            select(Favorite.itinerary_id).where(
+                Favorite.user_id == current_user.id,
+                Favorite.itinerary_id.in_(itinerary_ids)
+            )
+        )).all())
+    
+    return {"statuses": {str(itinerary_id): itinerary_id in favorited_ids for itinerary_id in sorted(itinerary_ids)}}
+
+
 @app.get("/api/favorites/{itinerary_id}/status")
 async def get_favorite_status(
     itinerary_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """检查行程是否已收藏"""
-    favorite = db.query(Favorite).filter(
+    favorite = await db.scalar(select(Favorite.id).where(
         Favorite.user_id == current_user.id,
         Favorite.itinerary_id == itinerary_id
-    ).first()
+    ))
     
     return {"is_favorited": favorite is not None}
 
@@ -0,0 +1,47 @@
+"""
+行程内容迁移脚本
+把旧数据中内联存储的行程 JSON（itineraries / temporary_shares / tasks）迁移到内容寻址的 itinerary_blobs 表，
+把使用其他算法压缩的内容转换为 STORAGE_COMPRESSION 指定的算法（如 zlib 转为 zstd），
+并清理不再被引用的内容。可重复执行，已迁移和已转换的行会被跳过。
+
+用法: python migrate_itinerary_blobs.py [--batch-size 200] [--skip-recompress]
+"""
+import argparse
+import io
+import logging
+import sys
+
+# 设置标准输出编码为UTF-8
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+from app.database import engine, Base, SessionLocal, ensure_schema
+from app.compression import storage_codec
+from app.itinerary_store import migrate_inline_itineraries, purge_orphaned_itinerary_blobs, recompress_itinerary_blobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移内联行程数据到内容表")
+    parser.add_argument("--batch-size", type=int, default=200, help="每批处理的行数")
+    parser.add_argument("--skip-recompress", action="store_true", help="不转换已有内容的压缩算法")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+
+    db = SessionLocal()
+    try:
+        migrated = migrate_inline_itineraries(db, batch_size=args.batch_size)
+        recompressed = 0 if args.skip_recompress else recompress_itinerary_blobs(db, batch_size=args.batch_size)
+        purged = purge_orphaned_itinerary_blobs(db)
+        print(f"[OK] 迁移完成: {migrated}")
+        print(f"[OK] 转换为 {storage_codec()} 压缩: {recompressed} 条")
+        print(f"[OK] 清理未引用的内容: {purged} 条")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
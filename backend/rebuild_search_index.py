@@ -0,0 +1,43 @@
+"""
+全文检索索引重建脚本
+为所有行程重新建立历史搜索使用的全文索引（SQLite FTS5 / PostgreSQL tsvector）。可重复执行。
+
+用法: python rebuild_search_index.py [--batch-size 200]
+"""
+import argparse
+import io
+import logging
+import sys
+
+# 设置标准输出编码为UTF-8
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+from app.database import engine, Base, SessionLocal, ensure_schema
+from app.search_index import ensure_search_index, rebuild_search_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重建行程全文检索索引")
+    parser.add_argument("--batch-size", type=int, default=200, help="每批处理的行数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+    backend = ensure_search_index(engine)
+    if backend is None:
+        print("[SKIP] 全文索引未启用或当前数据库不支持")
+        return
+
+    db = SessionLocal()
+    try:
+        count = rebuild_search_index(db, batch_size=args.batch_size)
+        print(f"[OK] 已为 {count} 个行程重建索引（{backend}）")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+独立的任务 worker
+从 tasks 表领取待处理的生成任务（数据库租约保证同一任务只被一个 worker 处理），生成行程并写回结果。
+配合 API 进程的 TASK_WORKER_EMBEDDED=false 使用，API 进程只负责入队和查询状态。
+
+多台机器部署多个 worker 时需使用 PostgreSQL（领取任务使用 SELECT ... FOR UPDATE SKIP LOCKED）；
+SQLite 仅适合同一台机器上的多个进程。
+
+用法: python worker.py [--concurrency 4]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import signal
+import sys
+
+# 设置标准输出编码为UTF-8
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+from dotenv import load_dotenv
+
+# 与 API 进程一致加载 .env：图片搜索、搜索工具和天气工具的 API Key 通过环境变量读取，需要在导入 app 模块前加载
+load_dotenv()
+
+from app.database import engine, Base, settings, ensure_schema
+from app.image_search import load_local_image_index
+from app.search_index import ensure_search_index
+from app.task_pipeline import create_task_queue
+
+logger = logging.getLogger("worker")
+
+
+async def run_worker(concurrency: int):
+    await asyncio.to_thread(load_local_image_index)
+    queue = create_task_queue(concurrency=concurrency)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows 不支持 add_signal_handler，Ctrl+C 通过 KeyboardInterrupt 退出
+            pass
+
+    await queue.start()
+    logger.info(f"🚀 [Worker] 已启动，并发数 {concurrency}，按 Ctrl+C 停止")
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("🛑 [Worker] 正在停止...")
+        await queue.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="运行独立的行程生成 worker")
+    parser.add_argument("--concurrency", type=int, default=settings.TASK_WORKER_CONCURRENCY, help="同时处理的任务数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    Base.metadata.create_all(bind=engine)
+    ensure_schema(engine)
+    ensure_search_index(engine)
+
+    try:
+        asyncio.run(run_worker(args.concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
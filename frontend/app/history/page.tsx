@@ -21,6 +21,9 @@ interface HistoryItem {
     agentName: string
     travelers: number
     totalBudget: number
+    activityCount: number | null
+    coverImage: string | null
+    dayTitles: string[]
   }
 }
 
@@ -37,7 +40,7 @@ export default function HistoryPage() {
   const [maxDays, setMaxDays] = useState<number | undefined>(undefined)
   const [minBudget, setMinBudget] = useState<number | undefined>(undefined)
   const [maxBudget, setMaxBudget] = useState<number | undefined>(undefined)
-  const [sortBy, setSortBy] = useState<"created_at" | "total_budget" | "days">("created_at")
+  const [sortBy, setSortBy] = useState<"created_at" | "total_budget" | "days" | "relevance">("created_at")
   const [sortOrder, setSortOrder] = useState<"asc" | "desc">("desc")
   const [showFilters, setShowFilters] = useState(false)
 
@@ -228,12 +231,13 @@ export default function HistoryPage() {
                   <Label className="text-sm text-muted-foreground">排序:</Label>
                   <select
                     value={sortBy}
-                    onChange={(e) => setSortBy(e.target.value as "created_at" | "total_budget" | "days")}
+                    onChange={(e) => setSortBy(e.target.value as "created_at" | "total_budget" | "days" | "relevance")}
                     className="px-3 py-1.5 text-sm border rounded-md bg-background"
                   >
                     <option value="created_at">创建时间</option>
                     <option value="total_budget">预算</option>
                     <option value="days">天数</option>
+                    <option value="relevance">相关度</option>
                   </select>
                   <Button
                     variant="ghost"
@@ -334,6 +338,14 @@ export default function HistoryPage() {
                   <Card key={item.id} className="hover:shadow-md transition-shadow cursor-pointer" onClick={() => viewItinerary(item.id)}>
                     <CardContent className="p-4 sm:p-6">
                       <div className="flex flex-col sm:flex-row sm:items-start sm:justify-between gap-3 sm:gap-4">
+                        {item.preview?.coverImage && (
+                          <img
+                            src={item.preview.coverImage}
+                            alt={item.destination}
+                            loading="lazy"
+                            className="w-full h-32 sm:w-24 sm:h-24 object-cover rounded-md flex-shrink-0"
+                          />
+                        )}
                         <div className="flex-1 min-w-0">
                           <h3 className="text-lg sm:text-xl font-bold mb-2 flex items-center gap-2">
                             <MapPin className="w-4 h-4 sm:w-5 sm:h-5 text-primary flex-shrink-0" />
@@ -358,7 +370,17 @@ export default function HistoryPage() {
                                 <span>总计: ¥{item.preview.totalBudget.toLocaleString()}</span>
                               </div>
                             )}
+                            {item.preview?.activityCount ? (
+                              <div className="flex items-center gap-1">
+                                <span>{item.preview.activityCount} 个活动</span>
+                              </div>
+                            ) : null}
                           </div>
+                          {item.preview?.dayTitles?.some(Boolean) && (
+                            <div className="text-xs sm:text-sm text-muted-foreground mb-2 truncate">
+                              {item.preview.dayTitles.filter(Boolean).join(" · ")}
+                            </div>
+                          )}
                           <div className="text-xs text-muted-foreground">
                             创建时间: {new Date(item.created_at).toLocaleString('zh-CN', {
                               year: 'numeric',
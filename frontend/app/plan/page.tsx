@@ -7,7 +7,8 @@ import { Button } from "@/components/ui/button"
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card"
 import { Loader2, Pause, Play, StopCircle, CheckCircle2, ArrowRight } from "lucide-react"
 import axios from "axios"
-import { api } from "@/lib/api"
+import { api, streamTaskEvents } from "@/lib/api"
+import type { ActivityImageInput } from "@/lib/images"
 
 interface LogEntry {
   step: string
@@ -37,7 +38,7 @@ interface ItineraryData {
       cost: number
       address: string
       reason: string
-      images?: string[]
+      images?: ActivityImageInput[]
     }[]
   }[]
   hiddenGems: {
@@ -81,6 +82,17 @@ export default function PlanPage() {
   const currentTaskIdRef = useRef<string | null>(null)
   // 用于取消轮询的标记
   const isCancelledRef = useRef(false)
+  // 文字行程尚未完成的任务ID（离开页面或停止时通知后端取消）
+  const pendingTaskIdRef = useRef<string | null>(null)
+  
+  // 通知后端取消不再需要的任务，避免继续消耗 LLM 调用
+  const cancelServerTask = (taskId: string | null) => {
+    if (!taskId) return
+    if (localStorage.getItem('planTaskId') === taskId) {
+      localStorage.removeItem('planTaskId')
+    }
+    api.cancelTask(taskId).catch((err) => console.warn('取消任务失败:', err))
+  }
   
   // 当进入最终归纳阶段时，每2秒切换提示文字
   useEffect(() => {
@@ -171,25 +183,105 @@ export default function PlanPage() {
       // 重置取消标记
       isCancelledRef.current = false
       
+      // 上一次未完成的任务（例如刷新页面后重新提交）已被新任务取代，先取消
+      cancelServerTask(localStorage.getItem('planTaskId'))
+      
       // 创建任务，获取task_id
       const taskResponse = await axios.post(`${apiUrl}/api/generate-plan`, formData, { headers })
       const taskId = taskResponse.data.task_id
       
       // 存储当前任务ID，确保并发安全
       currentTaskIdRef.current = taskId
+      pendingTaskIdRef.current = taskId
+      localStorage.setItem('planTaskId', taskId)
+      
+      // 创建任务期间用户已离开页面：立即取消
+      if (isCancelledRef.current) {
+        cancelServerTask(taskId)
+        return
+      }
       
       console.log('任务已创建，task_id:', taskId)
       
-      // 轮询任务状态
+      // 处理结束状态：失败时抛错，完成时返回文字行程结果
+      const completeTask = (taskStatus: any): any => {
+        // 任务已结束，离开页面时无需再取消
+        pendingTaskIdRef.current = null
+        localStorage.removeItem('planTaskId')
+        if (taskStatus.status === 'cancelled') {
+          throw new Error('任务已取消')
+        }
+        if (taskStatus.status === 'failed') {
+          throw new Error(taskStatus.error_message || '任务处理失败')
+        }
+        // 验证返回的任务ID是否匹配（确保是当前用户的任务）
+        if (taskStatus.task_id !== taskId) {
+          throw new Error('任务ID不匹配，可能存在并发问题')
+        }
+        // 文字行程已完成，图片在后台继续补全，结果页会继续跟踪
+        if (taskStatus.image_status === 'pending' || taskStatus.image_status === 'processing') {
+          localStorage.setItem('imageTaskId', taskId)
+        } else {
+          localStorage.removeItem('imageTaskId')
+        }
+        // 任务完成，进度设置为100%
+        setProgress(100)
+        return taskStatus.result
+      }
+      
+      // 通过 SSE 等待任务结束（服务端推送状态，无需轮询）
+      const waitForTaskEvents = async (): Promise<any> => {
+        const controller = new AbortController()
+        let finalStatus: any = null
+        let ticks = 0
+        // 进度从35%逐渐增加到95%，与轮询模式保持一致
+        const ticker = setInterval(() => {
+          if (isCancelledRef.current || currentTaskIdRef.current !== taskId) {
+            controller.abort()
+            return
+          }
+          ticks++
+          setProgress(Math.min(35 + ticks * (60 / 150), 95))
+        }, 2000)
+        
+        try {
+          await streamTaskEvents(taskId, (event, data) => {
+            console.log('任务事件:', event, data.status ?? '', 'task_id:', taskId)
+            if ((data.status === 'completed' && data.result) || data.status === 'failed' || data.status === 'cancelled') {
+              finalStatus = data
+              return false
+            }
+          }, controller.signal)
+        } finally {
+          clearInterval(ticker)
+          controller.abort()
+        }
+        
+        if (isCancelledRef.current || currentTaskIdRef.current !== taskId) {
+          throw new Error('任务已取消')
+        }
+        if (!finalStatus) {
+          throw new Error('任务事件流意外中断')
+        }
+        return finalStatus
+      }
+      
+      // 轮询任务状态（SSE 不可用时的后备方案）
       const pollTaskStatus = async (): Promise<any> => {
-        const maxAttempts = 150 // 最多轮询5分钟（每2秒一次，5分钟=300秒/2=150次）
+        const maxWaitMs = 5 * 60 * 1000 // 最多等待5分钟
+        const startedAt = Date.now()
         let attempts = 0
+        // 长轮询：带上上次拿到的版本号，服务端在任务变化（或超时）后才返回
+        let version: number | null = null
+        // 服务端估算的剩余秒数（按最近任务的阶段耗时），用于显示进度和出错后的重试间隔
+        let estimatedSeconds: number | null = null
+        let estimatedAt = startedAt
         
         // 进度范围：35% (初始完成) -> 95% (轮询中) -> 100% (完成)
         const progressStart = 35  // 轮询开始时的进度
         const progressEnd = 95    // 轮询结束时的进度（完成前）
         
-        while (attempts < maxAttempts) {
+        while (Date.now() - startedAt < maxWaitMs) {
           // 检查是否已取消（用户可能离开了页面或开始了新任务）
           if (isCancelledRef.current) {
             throw new Error('任务已取消')
@@ -200,37 +292,35 @@ export default function PlanPage() {
             throw new Error('检测到新任务，已取消当前任务')
           }
           
-          // 更新进度：从35%逐渐增加到95%
-          const progressIncrement = (progressEnd - progressStart) / maxAttempts
-          const currentProgress = Math.min(progressStart + (attempts * progressIncrement), progressEnd)
+          // 更新进度：从35%逐渐增加到95%（有预计完成时间时按预计时间推进）
+          const elapsedMs = Date.now() - startedAt
+          const elapsedRatio = estimatedSeconds === null
+            ? elapsedMs / maxWaitMs
+            : elapsedMs / (elapsedMs + Math.max(estimatedSeconds * 1000 - (Date.now() - estimatedAt), 1000))
+          const currentProgress = Math.min(progressStart + elapsedRatio * (progressEnd - progressStart), progressEnd)
           setProgress(currentProgress)
           
           try {
-            const statusResponse = await axios.get(`${apiUrl}/api/tasks/${taskId}`, { headers })
+            const params = version === null ? {} : { wait: 25, since: version }
+            const statusResponse = await axios.get(`${apiUrl}/api/tasks/${taskId}`, { headers, params })
             const taskStatus = statusResponse.data
+            version = taskStatus.version ?? null
+            if (typeof taskStatus.estimated_seconds === 'number') {
+              estimatedSeconds = taskStatus.estimated_seconds
+              estimatedAt = Date.now()
+            }
             
             // 再次验证任务ID（双重检查）
             if (currentTaskIdRef.current !== taskId) {
               throw new Error('检测到新任务，已取消当前任务')
             }
             
-            console.log(`任务状态 (${attempts + 1}/${maxAttempts}):`, taskStatus.status, 'task_id:', taskId, `进度: ${currentProgress.toFixed(1)}%`)
+            console.log(`任务状态 (第${attempts + 1}次查询):`, taskStatus.status, 'task_id:', taskId, `进度: ${currentProgress.toFixed(1)}%`)
             
-            if (taskStatus.status === 'completed') {
-              // 验证返回的任务ID是否匹配（确保是当前用户的任务）
-              if (taskStatus.task_id !== taskId) {
-                throw new Error('任务ID不匹配，可能存在并发问题')
-              }
-              // 任务完成，进度设置为100%
-              setProgress(100)
-              // 任务完成，返回结果
-              return taskStatus.result
-            } else if (taskStatus.status === 'failed') {
-              // 任务失败
-              throw new Error(taskStatus.error_message || '任务处理失败')
+            if (taskStatus.status === 'completed' || taskStatus.status === 'failed' || taskStatus.status === 'cancelled') {
+              return completeTask(taskStatus)
             } else {
-              // 任务还在处理中，继续等待
-              await new Promise(resolve => setTimeout(resolve, 2000)) // 等待2秒
+              // 任务还在处理中，下一次请求由服务端等待任务变化
               attempts++
             }
           } catch (err: any) {
@@ -242,8 +332,9 @@ export default function PlanPage() {
             if (err.response?.status === 404) {
               throw new Error('任务不存在')
             }
-            // 网络错误，继续重试
-            await new Promise(resolve => setTimeout(resolve, 2000)) // 等待2秒
+            // 网络错误，继续重试（预计还要较久时拉长间隔，最多10秒）
+            const retryMs = estimatedSeconds === null ? 2000 : Math.min(Math.max(estimatedSeconds * 100, 2000), 10000)
+            await new Promise(resolve => setTimeout(resolve, retryMs))
             attempts++
           }
         }
@@ -251,8 +342,20 @@ export default function PlanPage() {
         throw new Error('任务处理超时，请稍后重试')
       }
       
-      // 开始轮询
-      const result = await pollTaskStatus()
+      // 优先使用 SSE，连接失败时退回轮询
+      let finalStatus: any = null
+      try {
+        finalStatus = await waitForTaskEvents()
+      } catch (err: any) {
+        if (isCancelledRef.current || currentTaskIdRef.current !== taskId) {
+          throw new Error('任务已取消')
+        }
+        if (err.status === 404) {
+          throw new Error('任务不存在')
+        }
+        console.warn('任务事件流不可用，改为轮询:', err)
+      }
+      const result = finalStatus ? completeTask(finalStatus) : await pollTaskStatus()
       
       // 再次验证任务ID（确保结果属于当前任务）
       if (currentTaskIdRef.current !== taskId) {
@@ -314,6 +417,16 @@ export default function PlanPage() {
 
     } catch (err: any) {
       console.error('Planning error:', err)
+      // 服务繁忙（准入控制拒绝）：提示后端建议的重试时间
+      const httpStatus = err.response?.status
+      if (httpStatus === 429 || httpStatus === 503) {
+        const retryAfter = Number(err.response.headers?.['retry-after'])
+        const detail = err.response.data?.detail || '服务繁忙，请稍后再试'
+        setError(retryAfter > 0 ? `${detail}（约 ${retryAfter} 秒后可重试）` : detail)
+        setIsRunning(false)
+        setIsFinalizing(false)
+        return
+      }
       setError(err.message || '生成行程时出错，请重试')
       setIsRunning(false)
       setIsFinalizing(false)
@@ -325,7 +438,9 @@ export default function PlanPage() {
   }
 
   const handleStop = () => {
-    // 取消当前任务
+    // 取消当前任务（后端同时停止生成）
+    cancelServerTask(pendingTaskIdRef.current)
+    pendingTaskIdRef.current = null
     isCancelledRef.current = true
     currentTaskIdRef.current = null
     setIsRunning(false)
@@ -335,7 +450,9 @@ export default function PlanPage() {
   // 组件卸载时清理
   useEffect(() => {
     return () => {
-      // 组件卸载时取消任务
+      // 组件卸载时取消任务（文字行程未完成时通知后端停止生成）
+      cancelServerTask(pendingTaskIdRef.current)
+      pendingTaskIdRef.current = null
       isCancelledRef.current = true
       currentTaskIdRef.current = null
     }
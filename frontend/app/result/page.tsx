@@ -39,7 +39,8 @@ import {
 } from "lucide-react"
 import { PieChart, Pie, Cell, ResponsiveContainer, Tooltip } from "recharts"
 import Image from "next/image"
-import { api } from "@/lib/api"
+import { api, streamTaskEvents } from "@/lib/api"
+import { ActivityImage, filterValidImages, variantLoader } from "@/lib/images"
 import axios from "axios"
 
 interface Activity {
@@ -50,7 +51,7 @@ interface Activity {
   cost: number
   address: string
   reason: string
-  images?: string[]
+  images?: ActivityImage[]
 }
 
 interface DailyPlan {
@@ -85,27 +86,6 @@ interface ItineraryData {
 
 const COLORS = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8', '#F7DC6F']
 
-// 允许的图片域名
-const ALLOWED_IMAGE_DOMAINS = [
-  'images.unsplash.com',
-  'source.unsplash.com',
-  'images.pexels.com',
-]
-
-const isValidImageUrl = (url: string): boolean => {
-  try {
-    const urlObj = new URL(url)
-    return ALLOWED_IMAGE_DOMAINS.some(domain => urlObj.hostname === domain)
-  } catch {
-    return false
-  }
-}
-
-const filterValidImages = (images?: string[]): string[] => {
-  if (!images || images.length === 0) return []
-  return images.filter(isValidImageUrl)
-}
-
 // 内部组件：使用 useSearchParams
 function ResultPageContent() {
   const router = useRouter()
@@ -143,6 +123,90 @@ function ResultPageContent() {
     loadItinerary()
   }, [searchParams, user, token])
 
+  // 图片补全在文字行程完成后异步进行，这里跟踪进度并在图片到达后刷新行程
+  useEffect(() => {
+    const imageTaskId = localStorage.getItem('imageTaskId')
+    if (!imageTaskId) return
+
+    let cancelled = false
+    const controller = new AbortController()
+
+    // 只替换每日行程（图片所在位置），保留目的地等附加信息
+    const applyResult = (result: any) => {
+      if (!result?.dailyPlans) return
+      const dailyPlans = result.dailyPlans.map((day: DailyPlan) => ({
+        ...day,
+        activities: day.activities.map((activity: Activity) => ({
+          ...activity,
+          images: filterValidImages(activity.images)
+        }))
+      }))
+      setItinerary(prev => prev ? { ...prev, dailyPlans } : prev)
+    }
+
+    // 优先通过 SSE 接收图片补全结果（服务端只在完成时推送一次带图片的结果）
+    const followImages = async () => {
+      try {
+        let finished = false
+        await streamTaskEvents(imageTaskId, (event, data) => {
+          if (data.result) {
+            applyResult(data.result)
+          }
+          if (data.status === 'failed' || data.status === 'cancelled' || data.image_status === 'completed' || data.image_status === 'failed' || data.image_status === 'cancelled') {
+            finished = true
+            return false
+          }
+        }, controller.signal)
+        if (finished) {
+          localStorage.removeItem('imageTaskId')
+          return
+        }
+      } catch (err: any) {
+        if (cancelled) return
+        if (err.status === 404 || err.status === 403) {
+          localStorage.removeItem('imageTaskId')
+          return
+        }
+      }
+      if (!cancelled) {
+        await pollImages()
+      }
+    }
+
+    // SSE 不可用时退回轮询
+    const pollImages = async () => {
+      // 长轮询：带上版本号，服务端在任务变化（或超时）后才返回
+      let version: number | undefined
+      while (!cancelled) {
+        try {
+          const taskStatus = await api.getTaskStatus(imageTaskId, version)
+          if (cancelled) return
+          if (taskStatus.version !== version) {
+            applyResult(taskStatus.result)
+          }
+          version = taskStatus.version
+          if (taskStatus.image_status !== 'pending' && taskStatus.image_status !== 'processing') {
+            localStorage.removeItem('imageTaskId')
+            return
+          }
+          continue
+        } catch (err: any) {
+          if (err.response?.status === 404 || err.response?.status === 403) {
+            localStorage.removeItem('imageTaskId')
+            return
+          }
+        }
+        await new Promise(resolve => setTimeout(resolve, 3000))
+      }
+    }
+    followImages()
+
+    return () => {
+      cancelled = true
+      controller.abort()
+    }
+  }, [])
+
   const loadItinerary = async () => {
     try {
       setIsLoading(true)
@@ -608,7 +672,8 @@ function ResultPageContent() {
                             {activity.images.slice(0, 4).map((img, imgIdx) => (
                               <div key={imgIdx} className="relative aspect-square rounded-lg overflow-hidden">
                                 <Image
-                                  src={img}
+                                  src={img.url}
+                                  loader={variantLoader(img)}
                                   alt={activity.title}
                                   fill
                                   className="object-cover"
@@ -18,6 +18,7 @@ import {
 import { PieChart, Pie, Cell, ResponsiveContainer, Tooltip } from "recharts"
 import Image from "next/image"
 import { api } from "@/lib/api"
+import { ActivityImage, filterValidImages, variantLoader } from "@/lib/images"
 
 interface Activity {
   time: string
@@ -27,7 +28,7 @@ interface Activity {
   cost: number
   address: string
   reason: string
-  images?: string[]
+  images?: ActivityImage[]
 }
 
 interface DailyPlan {
@@ -62,27 +63,6 @@ interface ItineraryData {
 
 const COLORS = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8', '#F7DC6F']
 
-// 允许的图片域名
-const ALLOWED_IMAGE_DOMAINS = [
-  'images.unsplash.com',
-  'source.unsplash.com',
-  'images.pexels.com',
-]
-
-const isValidImageUrl = (url: string): boolean => {
-  try {
-    const urlObj = new URL(url)
-    return ALLOWED_IMAGE_DOMAINS.some(domain => urlObj.hostname === domain)
-  } catch {
-    return false
-  }
-}
-
-const filterValidImages = (images?: string[]): string[] => {
-  if (!images || images.length === 0) return []
-  return images.filter(isValidImageUrl)
-}
-
 export default function SharePage() {
   const router = useRouter()
   const params = useParams()
@@ -342,7 +322,8 @@ export default function SharePage() {
                             {activity.images.slice(0, 4).map((img, imgIdx) => (
                               <div key={imgIdx} className="relative aspect-square rounded-lg overflow-hidden">
                                 <Image
-                                  src={img}
+                                  src={img.url}
+                                  loader={variantLoader(img)}
                                   alt={activity.title}
                                   fill
                                   className="object-cover"
@@ -30,7 +30,100 @@ export interface ShareLinkResponse {
   expires_at: string | null
 }
 
+export interface TaskStatusResponse {
+  task_id: string
+  status: string
+  result: any | null
+  error_message: string | null
+  created_at: string
+  updated_at: string
+  completed_at: string | null
+  itinerary_id: number | null
+  image_status: string | null
+  image_progress: number
+  image_total: number
+  version: number
+  queue_position: number | null
+  // 预计完成时间（UTC）和剩余秒数：排队中/生成中为文字行程，图片补全中为图片全部完成
+  estimated_completion_at?: string | null
+  estimated_seconds?: number | null
+}
+
+// SSE 事件类型：status 状态变化、result 文字行程结果、progress 图片进度、images 带图片的最终结果
+export type TaskEventType = 'status' | 'result' | 'progress' | 'images'
+
+/**
+ * 订阅任务事件（GET /api/tasks/{taskId}/events）
+ * 使用 fetch 读取事件流以便携带 Authorization 头；onEvent 返回 false 时主动结束订阅
+ * 服务端在任务结束后关闭连接，此时 Promise 正常结束
+ */
+export const streamTaskEvents = async (
+  taskId: string,
+  onEvent: (event: TaskEventType, data: Partial<TaskStatusResponse>) => boolean | void,
+  signal?: AbortSignal
+): Promise<void> => {
+  const headers: Record<string, string> = { Accept: 'text/event-stream' }
+  const token = localStorage.getItem('auth_token')
+  if (token) {
+    headers.Authorization = `Bearer ${token}`
+  }
+
+  const response = await fetch(`${API_BASE_URL}/api/tasks/${taskId}/events`, { headers, signal })
+  if (!response.ok || !response.body) {
+    const error: any = new Error(`订阅任务事件失败: ${response.status}`)
+    error.status = response.status
+    throw error
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  try {
+    while (true) {
+      const { done, value } = await reader.read()
+      if (done) return
+      buffer += decoder.decode(value, { stream: true })
+
+      let boundary = buffer.indexOf('\n\n')
+      while (boundary !== -1) {
+        const block = buffer.slice(0, boundary)
+        buffer = buffer.slice(boundary + 2)
+        boundary = buffer.indexOf('\n\n')
+
+        let event = 'message'
+        const dataLines: string[] = []
+        for (const line of block.split('\n')) {
+          if (line.startsWith('event:')) {
+            event = line.slice(6).trim()
+          } else if (line.startsWith('data:')) {
+            dataLines.push(line.slice(5).trim())
+          }
+        }
+        // 只有注释的块是服务端心跳
+        if (dataLines.length === 0) continue
+        if (onEvent(event as TaskEventType, JSON.parse(dataLines.join('\n'))) === false) return
+      }
+    }
+  } finally {
+    reader.cancel().catch(() => {})
+  }
+}
+
 export const api = {
+  // 任务相关
+  // 传入 since（上次拿到的 version）和 wait（秒）时为长轮询：任务变化或超时后才返回
+  getTaskStatus: async (taskId: string, since?: number, wait: number = 25): Promise<TaskStatusResponse> => {
+    const params = since === undefined ? {} : { since, wait }
+    const response = await apiClient.get(`/api/tasks/${taskId}`, { params })
+    return response.data
+  },
+
+  // 取消任务：排队中或生成中的任务停止生成，已结束的任务不受影响
+  cancelTask: async (taskId: string): Promise<TaskStatusResponse> => {
+    const response = await apiClient.delete(`/api/tasks/${taskId}`)
+    return response.data
+  },
+
   // 分享相关
   createShareLink: async (itineraryId: number, isPublic: boolean = true, expiresDays?: number): Promise<ShareLinkResponse> => {
     const response = await apiClient.post(`/api/itinerary/${itineraryId}/share`, {
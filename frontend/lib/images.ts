@@ -0,0 +1,61 @@
+/**
+ * 活动图片工具函数
+ * 兼容旧的纯字符串URL和新的图片对象（默认URL + 多尺寸版本）
+ */
+import type { ImageLoaderProps } from 'next/image'
+
+export interface ActivityImage {
+  url: string
+  source?: string
+  variants?: Record<string, string>  // small/medium/large -> URL
+}
+
+export type ActivityImageInput = string | ActivityImage
+
+// 与后端 IMAGE_VARIANT_WIDTHS 保持一致
+const VARIANT_WIDTHS: [string, number][] = [
+  ['small', 400],
+  ['medium', 800],
+  ['large', 1080],
+]
+
+const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:18890'
+
+// 允许的图片域名（后端自身用于提供本地图片库的照片）
+const ALLOWED_IMAGE_DOMAINS = [
+  'images.unsplash.com',
+  'source.unsplash.com',
+  'images.pexels.com',
+  new URL(API_BASE_URL).hostname,
+]
+
+const isValidImageUrl = (url: string): boolean => {
+  try {
+    const urlObj = new URL(url)
+    return ALLOWED_IMAGE_DOMAINS.some(domain => urlObj.hostname === domain)
+  } catch {
+    return false
+  }
+}
+
+export const normalizeImage = (image: ActivityImageInput): ActivityImage =>
+  typeof image === 'string' ? { url: image } : image
+
+export const filterValidImages = (images?: ActivityImageInput[]): ActivityImage[] => {
+  if (!images || images.length === 0) return []
+  return images.map(normalizeImage).filter(image => isValidImageUrl(image.url))
+}
+
+/**
+ * 为 next/image 生成 loader：按请求宽度选择最接近的尺寸版本，
+ * 浏览器据此得到 srcset，不再统一下载最大图
+ */
+export const variantLoader = (image: ActivityImage) => ({ width }: ImageLoaderProps): string => {
+  const variants = image.variants || {}
+  for (const [name, variantWidth] of VARIANT_WIDTHS) {
+    if (variants[name] && width <= variantWidth) {
+      return variants[name]
+    }
+  }
+  return variants.large || image.url
+}